@@ -0,0 +1,9 @@
+# offline benchmark suite for the database and library scanning hot paths
+#   - run it from the repo root with: python -m benchmarks --tracks 10000 --output bench.json
+#   - the modules in src/ import each other by bare name (import souldb as SoulDB) so we put src/ on the path here
+import os
+import sys
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
@@ -0,0 +1,95 @@
+import argparse
+import platform
+import datetime
+import sqlite3
+import subprocess
+import shutil
+import json
+import sys
+
+import benchmarks
+from benchmarks.scenarios import SCENARIOS, BenchmarkConfig, run_scenario
+
+def get_git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True, cwd=benchmarks.SRC_DIR).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_comparison(results: list[dict], baseline_filepath: str):
+    with open(baseline_filepath, "r") as file:
+        baseline = {result["name"]: result for result in json.load(file)["results"]}
+
+    print(f"\n{'scenario':50} {'baseline (s)':>14} {'current (s)':>14} {'speedup':>10}")
+    for result in results:
+        baseline_result = baseline.get(result["name"])
+        if baseline_result is None:
+            print(f"{result['name']:50} {'-':>14} {result['median_s']:>14.4f} {'-':>10}")
+            continue
+
+        speedup = baseline_result["median_s"] / result["median_s"] if result["median_s"] > 0 else float("inf")
+        print(f"{result['name']:50} {baseline_result['median_s']:>14.4f} {result['median_s']:>14.4f} {speedup:>9.2f}x")
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs the SoulRipper benchmarks against a synthetic library and reports the timings as JSON")
+    parser.add_argument("--tracks", type=int, default=10_000, help="Number of tracks in the synthetic database")
+    parser.add_argument("--artists", type=int, default=1_000, help="Number of distinct artists")
+    parser.add_argument("--playlists", type=int, default=50, help="Number of playlists in the synthetic database")
+    parser.add_argument("--playlist-size", type=int, default=200, help="Number of tracks in each playlist")
+    parser.add_argument("--files", type=int, default=1_000, help="Number of tagged audio files for the library scan scenarios")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of timed runs per scenario")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the synthetic library")
+    parser.add_argument("--scenario", action="append", help="Only run scenarios whose name starts with this prefix, can be given more than once")
+    parser.add_argument("--output", type=str, help="Write the JSON report to this file instead of stdout")
+    parser.add_argument("--compare", type=str, help="A previous JSON report to print speedups against")
+    parser.add_argument("--keep", action="store_true", help="Keep the generated library and databases")
+    args = parser.parse_args()
+
+    config = BenchmarkConfig(
+        num_tracks=args.tracks,
+        num_artists=args.artists,
+        num_playlists=args.playlists,
+        playlist_size=args.playlist_size,
+        num_files=args.files,
+        repeat=args.repeat,
+        seed=args.seed,
+    )
+
+    scenarios = [
+        scenario for scenario in SCENARIOS
+        if args.scenario is None or any(scenario.name.startswith(prefix) for prefix in args.scenario)
+    ]
+
+    results = []
+    try:
+        for scenario in scenarios:
+            result = run_scenario(scenario, config)
+            print(f"{scenario.name:50} median {result['median_s']:.4f}s", file=sys.stderr)
+            results.append(result)
+    finally:
+        if not args.keep:
+            shutil.rmtree(config.work_dir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "git_commit": get_git_commit(),
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "config": {key: value for key, value in vars(config).items() if key != "work_dir"},
+        },
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
+
+    if args.compare:
+        print_comparison(results, args.compare)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+# measures how much memory a large liked songs sync holds on to - the raw spotify pages while they are being converted, and the TrackData list that is kept afterwards
+#   python -m benchmarks.memory --tracks 100000
+from dataclasses import dataclass
+import argparse
+import tracemalloc
+import json
+import gc
+
+from spotify_client import SpotifyClient
+from benchmarks.spotify_fixtures import make_playlist_items
+
+@dataclass
+class BaselineTrackData:
+    # TrackData as it was before it was slotted and interned: a plain dataclass with a __dict__ per instance and a list of artists. it has the same
+    # fields as TrackData today so the comparison only measures the representation
+    filepath: str = None
+    spotify_id: str = None
+    title: str = None
+    artists: list[(str, str)] = None
+    album: str = None
+    release_date: str = None
+    date_liked_spotify: str = None
+    explicit: bool = None
+    comments: str = None
+    duration_ms: int = None
+    isrc: str = None
+
+def make_raw_pages(num_items: int, num_artists: int, seed: int, page_size: int = 50) -> list[str]:
+    # the pages are kept as json text, like the http responses spotipy decodes, so that decoding them is part of what gets measured
+    items = make_playlist_items(num_items, num_artists, seed)
+    return [json.dumps(items[offset:offset + page_size]) for offset in range(0, len(items), page_size)]
+
+def convert_baseline(raw_pages: list[str]):
+    # the old way end to end: every page is decoded and kept, then converted into the old dict backed TrackData
+    all_items = []
+    for page in raw_pages:
+        all_items.extend(json.loads(page))
+
+    return [
+        BaselineTrackData(
+            spotify_id=item["track"]["id"],
+            title=item["track"]["name"],
+            artists=[(artist["name"], artist["id"]) for artist in item["track"]["artists"]],
+            album=item["track"]["album"]["name"],
+            release_date=item["track"]["album"]["release_date"],
+            date_liked_spotify=item["added_at"],
+            explicit=item["track"]["explicit"],
+            duration_ms=item["track"].get("duration_ms"),
+            isrc=(item["track"].get("external_ids") or {}).get("isrc"),
+        )
+        for item in all_items
+    ]
+
+def convert_all_pages(raw_pages: list[str]):
+    # every page is decoded and kept before anything is converted, but into the slotted TrackData
+    all_items = []
+    for page in raw_pages:
+        all_items.extend(json.loads(page))
+    return SpotifyClient.get_track_data_from_playlist(all_items)
+
+def convert_streamed_pages(raw_pages: list[str]):
+    # what iter_liked_tracks() does: each page can be freed as soon as its tracks are converted
+    return SpotifyClient.get_track_data_from_playlist(item for page in raw_pages for item in json.loads(page))
+
+def measure(convert, raw_pages: list[str]) -> dict:
+    gc.collect()
+    tracemalloc.start()
+    track_data_list = convert(raw_pages)
+    gc.collect()
+    retained_bytes, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "num_tracks": len(track_data_list),
+        "peak_bytes": peak_bytes,
+        "retained_bytes": retained_bytes,
+        "retained_bytes_per_track": round(retained_bytes / max(len(track_data_list), 1), 1),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Measures the memory used to turn a synthetic liked songs library into TrackData")
+    parser.add_argument("--tracks", type=int, default=100_000, help="Number of liked songs")
+    parser.add_argument("--artists", type=int, default=5_000, help="Number of distinct artists")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the synthetic library")
+    args = parser.parse_args()
+
+    raw_pages = make_raw_pages(args.tracks, args.artists, args.seed)
+    report = {
+        "baseline": measure(convert_baseline, raw_pages),
+        "all_pages": measure(convert_all_pages, raw_pages),
+        "streamed_pages": measure(convert_streamed_pages, raw_pages),
+    }
+    print(json.dumps(report, indent=4))
+
+if __name__ == "__main__":
+    main()
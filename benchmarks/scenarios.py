@@ -0,0 +1,205 @@
+# timed benchmark scenarios - each scenario has an untimed setup step that builds a fresh database and a timed run step that calls the code being measured
+from dataclasses import dataclass, field
+from typing import Callable
+import contextlib
+import statistics
+import tempfile
+import time
+import os
+
+import sqlalchemy as sqla
+
+import souldb as SoulDB
+import main as SoulRipper
+import analytics
+from spotify_client import SpotifyClient
+from benchmarks import synthetic_library, spotify_fixtures
+
+@dataclass
+class BenchmarkConfig:
+    num_tracks: int = 10_000
+    num_artists: int = 1_000
+    num_playlists: int = 50
+    playlist_size: int = 200
+    num_files: int = 1_000
+    repeat: int = 3
+    seed: int = 0
+    work_dir: str = field(default_factory=tempfile.mkdtemp)
+
+@dataclass
+class Scenario:
+    name: str
+    setup: Callable[[BenchmarkConfig], dict]
+    run: Callable[[dict], object]
+
+def create_session(db_path: str):
+    """
+    Creates a fresh sqlite database with the same tables, search index, and stats tables that main() sets up
+
+    Args:
+        db_path (str): the path of the database file, it is deleted first if it exists
+
+    Returns:
+        Session: a session bound to the new database
+    """
+    if os.path.exists(db_path):
+        os.remove(db_path)
+
+    db_engine = SoulDB.create_db_engine(f"sqlite:///{db_path}")
+    SoulDB.init_db(db_engine)
+
+    return sqla.orm.sessionmaker(bind=db_engine)()
+
+def _music_dir(config: BenchmarkConfig) -> str:
+    # the audio files are the slowest thing to generate so they are written once and shared by every scan scenario
+    music_dir = os.path.join(config.work_dir, "music")
+    if not os.path.exists(music_dir):
+        track_data_list = synthetic_library.make_track_data(config.num_files, config.num_artists, config.seed)
+        synthetic_library.write_audio_files(music_dir, track_data_list)
+    return music_dir
+
+def _populated_db_path(config: BenchmarkConfig) -> str:
+    db_path = os.path.join(config.work_dir, "populated.db")
+    if not os.path.exists(db_path):
+        sql_session = create_session(db_path)
+        with _quiet():
+            synthetic_library.populate_database(sql_session, config.num_tracks, config.num_artists, config.num_playlists, config.playlist_size, config.seed)
+        sql_session.close()
+    return db_path
+
+def _open_populated_session(config: BenchmarkConfig) -> dict:
+    db_engine = SoulDB.create_db_engine(f"sqlite:///{_populated_db_path(config)}")
+    return {"sql_session": sqla.orm.sessionmaker(bind=db_engine)()}
+
+@contextlib.contextmanager
+def _quiet():
+    # the code under test prints a lot, we send it to /dev/null so the terminal isn't the bottleneck
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+# ===========================================
+#               scenario steps
+# ===========================================
+
+def setup_scan_cold(config: BenchmarkConfig) -> dict:
+    music_dir = _music_dir(config)
+    return {"sql_session": create_session(os.path.join(config.work_dir, "scan.db")), "music_dir": music_dir}
+
+def setup_scan_rescan(config: BenchmarkConfig) -> dict:
+    state = setup_scan_cold(config)
+    with _quiet():
+        SoulRipper.scan_music_library(state["sql_session"], state["music_dir"])
+    return state
+
+def run_scan(state: dict):
+    SoulRipper.scan_music_library(state["sql_session"], state["music_dir"])
+
+def setup_bulk_add_tracks(config: BenchmarkConfig) -> dict:
+    return {
+        "sql_session": create_session(os.path.join(config.work_dir, "bulk.db")),
+        "track_data": set(synthetic_library.make_track_data(config.num_tracks, config.num_artists, config.seed)),
+    }
+
+def run_bulk_add_tracks(state: dict):
+    SoulDB.Tracks.bulk_add_tracks(state["sql_session"], state["track_data"])
+    state["sql_session"].commit()
+
+def setup_add_track_data_to_playlist(config: BenchmarkConfig) -> dict:
+    sql_session = create_session(os.path.join(config.work_dir, "playlist.db"))
+    playlist_items = spotify_fixtures.make_playlist_items(config.num_tracks, config.num_artists, config.seed)
+    playlist_metadata = spotify_fixtures.make_playlists(1, config.seed)[0]
+    playlist_row = SoulDB.Playlists.add_playlist(sql_session, playlist_metadata["id"], playlist_metadata["name"], playlist_metadata["description"])
+    sql_session.commit()
+
+    return {"sql_session": sql_session, "playlist_items": playlist_items, "playlist_row": playlist_row}
+
+def run_add_track_data_to_playlist(state: dict):
+    # converting the raw spotify json is part of every sync so it is included in the timing
+    track_data_list = SpotifyClient.get_track_data_from_playlist(state["playlist_items"])
+    SoulRipper.add_track_data_to_playlist(state["sql_session"], track_data_list, state["playlist_row"])
+    state["sql_session"].commit()
+
+def _query_scenario(query_function: Callable, *args) -> Scenario:
+    return Scenario(
+        name=f"queries.{query_function.__name__}",
+        setup=_open_populated_session,
+        run=lambda state: query_function(state["sql_session"], *args),
+    )
+
+def setup_analytics(config: BenchmarkConfig) -> dict:
+    state = _open_populated_session(config)
+    state["arrays"] = analytics.load_library_arrays(state["sql_session"])
+    return state
+
+def _analytics_scenario(analytics_function: Callable, *args) -> Scenario:
+    # the arrays are loaded in the untimed setup, what's timed is the computation a warm cache (e.g. in the daemon) still has to do
+    return Scenario(
+        name=f"analytics.{analytics_function.__name__}",
+        setup=setup_analytics,
+        run=lambda state: analytics_function(state["arrays"], *args),
+    )
+
+def setup_analytics_cached(config: BenchmarkConfig) -> dict:
+    state = _open_populated_session(config)
+    state["library_analytics"] = analytics.LibraryAnalytics()
+    state["library_analytics"].get_arrays(state["sql_session"])
+    return state
+
+def run_analytics_cached(state: dict):
+    # a cache hit is one version lookup
+    state["library_analytics"].get_arrays(state["sql_session"])
+
+SCENARIOS = [
+    Scenario("scan_music_library.cold", setup_scan_cold, run_scan),
+    Scenario("scan_music_library.rescan", setup_scan_rescan, run_scan),
+    Scenario("bulk_add_tracks", setup_bulk_add_tracks, run_bulk_add_tracks),
+    Scenario("add_track_data_to_playlist", setup_add_track_data_to_playlist, run_add_track_data_to_playlist),
+    _query_scenario(SoulRipper.get_favorite_artists),
+    _query_scenario(SoulRipper.get_favorite_tracks),
+    _query_scenario(SoulRipper.get_average_tracks_per_playlist),
+    _query_scenario(SoulRipper.get_playlists_with_above_avg_track_count),
+    _query_scenario(SoulRipper.get_top_3_tracks_per_artist),
+    _query_scenario(SoulRipper.get_num_unique_albums),
+    _query_scenario(SoulRipper.search_for_track, "heart night"),
+    Scenario("analytics.load_library_arrays", _open_populated_session, lambda state: analytics.load_library_arrays(state["sql_session"])),
+    _analytics_scenario(analytics.get_favorite_artists),
+    _analytics_scenario(analytics.get_favorite_tracks),
+    _analytics_scenario(analytics.get_average_tracks_per_playlist),
+    _analytics_scenario(analytics.get_playlists_with_above_avg_track_count),
+    _analytics_scenario(analytics.get_top_tracks_per_artist),
+    _analytics_scenario(analytics.get_artist_tracks_per_year),
+    _analytics_scenario(analytics.get_most_similar_playlists),
+    Scenario("analytics.cached_get_arrays", setup_analytics_cached, run_analytics_cached),
+]
+
+def run_scenario(scenario: Scenario, config: BenchmarkConfig) -> dict:
+    """
+    Runs a scenario config.repeat times, each run gets a fresh setup
+
+    Args:
+        scenario (Scenario): the scenario to run
+        config (BenchmarkConfig): the benchmark configuration
+
+    Returns:
+        dict: the timings of every run and their summary statistics in seconds
+    """
+    times = []
+    for _ in range(config.repeat):
+        with _quiet():
+            state = scenario.setup(config)
+
+        with _quiet():
+            start_time = time.perf_counter()
+            scenario.run(state)
+            times.append(time.perf_counter() - start_time)
+
+        state["sql_session"].close()
+
+    return {
+        "name": scenario.name,
+        "runs": len(times),
+        "times_s": times,
+        "min_s": min(times),
+        "median_s": statistics.median(times),
+        "mean_s": statistics.fmean(times),
+    }
@@ -0,0 +1,66 @@
+# fake Spotify API payloads shaped like the responses from spotipy so that the sync code paths can be benchmarked without a network connection
+import random
+
+from benchmarks.synthetic_library import make_artist_names, make_title
+
+def make_spotify_id(rng: random.Random) -> str:
+    alphabet = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    return "".join(rng.choice(alphabet) for _ in range(22))
+
+def make_playlist_items(num_items: int, num_artists: int = 1000, seed: int = 0, duplicate_ratio: float = 0.1) -> list[dict]:
+    """
+    Creates playlist items in the format returned by spotipy's playlist_items() and current_user_saved_tracks()
+
+    Args:
+        num_items (int): the number of items in the playlist
+        num_artists (int): the size of the artist pool the tracks are drawn from
+        seed (int): the random seed, the same seed always produces the same payload
+        duplicate_ratio (float): the fraction of items that repeat an earlier track, like songs that appear in several playlists
+
+    Returns:
+        list[dict]: the playlist items
+    """
+    rng = random.Random(seed)
+    artist_names = make_artist_names(num_artists)
+    artist_ids = [make_spotify_id(rng) for _ in range(num_artists)]
+
+    items = []
+    for index in range(num_items):
+        if len(items) > 0 and rng.random() < duplicate_ratio:
+            items.append(rng.choice(items))
+            continue
+
+        artist_indexes = rng.sample(range(num_artists), k=rng.choice([1, 1, 1, 2, 3]))
+        items.append({
+            "added_at": f"20{rng.randint(10, 25)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}T12:00:00Z",
+            "track": {
+                "id": make_spotify_id(rng),
+                "name": make_title(rng, index),
+                "artists": [{"name": artist_names[i], "id": artist_ids[i]} for i in artist_indexes],
+                "album": {
+                    "name": f"Album {rng.randint(0, num_items // 10 + 1)}",
+                    "release_date": f"{rng.randint(1960, 2025)}-01-01",
+                },
+                "explicit": rng.random() < 0.2,
+                "duration_ms": rng.randint(90_000, 420_000),
+            },
+        })
+
+    return items
+
+def make_playlists(num_playlists: int, seed: int = 0) -> list[dict]:
+    """
+    Creates playlist metadata in the format returned by spotipy's user_playlists()
+
+    Args:
+        num_playlists (int): the number of playlists
+        seed (int): the random seed
+
+    Returns:
+        list[dict]: the playlist metadata
+    """
+    rng = random.Random(seed)
+    return [
+        {"id": make_spotify_id(rng), "name": f"Playlist {index}", "description": f"synthetic playlist {index}"}
+        for index in range(num_playlists)
+    ]
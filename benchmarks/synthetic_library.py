@@ -0,0 +1,126 @@
+# generates synthetic music libraries - TrackData, populated databases, and tagged audio files - of any size for the benchmarks
+import random
+import struct
+import os
+
+import souldb as SoulDB
+
+_WORDS = [
+    "midnight", "city", "lights", "love", "dream", "fire", "rain", "gold", "heart", "night", "summer", "blue",
+    "ghost", "river", "static", "velvet", "echo", "neon", "shadow", "sugar", "storm", "silver", "wild", "moon",
+]
+
+def make_artist_names(num_artists: int) -> list[str]:
+    return [f"Artist {index:05d}" for index in range(num_artists)]
+
+def make_title(rng: random.Random, index: int) -> str:
+    return f"{' '.join(rng.choice(_WORDS).title() for _ in range(rng.randint(1, 4)))} {index}"
+
+def make_track_data(num_tracks: int, num_artists: int = 1000, seed: int = 0) -> list[SoulDB.TrackData]:
+    """
+    Creates TrackData for a synthetic library, half of the tracks have spotify ids and half look like local files
+
+    Args:
+        num_tracks (int): the number of tracks
+        num_artists (int): the size of the artist pool the tracks are drawn from
+        seed (int): the random seed
+
+    Returns:
+        list[SoulDB.TrackData]: the track data
+    """
+    rng = random.Random(seed)
+    artist_names = make_artist_names(num_artists)
+
+    track_data_list = []
+    for index in range(num_tracks):
+        artists = [(artist_names[i], f"artist{i}") for i in rng.sample(range(num_artists), k=rng.choice([1, 1, 2]))]
+        has_spotify_id = index % 2 == 0
+
+        track_data_list.append(SoulDB.TrackData(
+            spotify_id=f"track{index}" if has_spotify_id else None,
+            filepath=None if has_spotify_id else f"/music/synthetic/{index}.flac",
+            title=make_title(rng, index),
+            artists=artists,
+            album=f"Album {index // 12}",
+            release_date=f"{rng.randint(1960, 2025)}-01-01",
+            explicit=rng.random() < 0.2,
+        ))
+
+    return track_data_list
+
+def populate_database(sql_session, num_tracks: int, num_artists: int = 1000, num_playlists: int = 50, playlist_size: int = 200, seed: int = 0):
+    """
+    Fills a database with a synthetic library of tracks, artists, and playlists
+
+    Args:
+        sql_session: the sqlalchemy session
+        num_tracks (int): the number of tracks
+        num_artists (int): the size of the artist pool
+        num_playlists (int): the number of playlists
+        playlist_size (int): the number of tracks in each playlist
+        seed (int): the random seed
+    """
+    rng = random.Random(seed)
+
+    SoulDB.Tracks.bulk_add_tracks(sql_session, make_track_data(num_tracks, num_artists, seed))
+    track_ids = [track_id for (track_id,) in sql_session.query(SoulDB.Tracks.id)]
+
+    for index in range(num_playlists):
+        playlist = SoulDB.Playlists.add_playlist(sql_session, f"playlist{index}", f"Playlist {index}", None)
+        sql_session.add_all([
+            SoulDB.PlaylistTracks(playlist_id=playlist.id, track_id=track_id, added_at="2024-01-01T12:00:00Z")
+            for track_id in rng.sample(track_ids, k=min(playlist_size, len(track_ids)))
+        ])
+
+    sql_session.commit()
+
+# a FLAC file with just the STREAMINFO and VORBIS_COMMENT metadata blocks and no audio frames is enough for mutagen to read its tags
+def _flac_bytes(tags: dict[str, str]) -> bytes:
+    sample_rate, channels, bits_per_sample = 44100, 2, 16
+    stream_info = (
+        struct.pack(">HH", 4096, 4096)
+        + b"\0" * 6
+        + ((sample_rate << 44) | ((channels - 1) << 41) | ((bits_per_sample - 1) << 36)).to_bytes(8, "big")
+        + b"\0" * 16
+    )
+
+    vendor = b"soulripper-benchmarks"
+    comments = [f"{key}={value}".encode("utf-8") for key, value in tags.items()]
+    vorbis_comment = struct.pack("<I", len(vendor)) + vendor + struct.pack("<I", len(comments))
+    for comment in comments:
+        vorbis_comment += struct.pack("<I", len(comment)) + comment
+
+    return (
+        b"fLaC"
+        + bytes([0x00]) + len(stream_info).to_bytes(3, "big") + stream_info
+        + bytes([0x84]) + len(vorbis_comment).to_bytes(3, "big") + vorbis_comment
+    )
+
+def write_audio_files(music_dir: str, track_data_list: list[SoulDB.TrackData], tracks_per_dir: int = 100) -> list[str]:
+    """
+    Writes a tagged dummy FLAC file for each track, spread across subdirectories like a real library
+
+    Args:
+        music_dir (str): the root directory of the synthetic library
+        track_data_list (list[SoulDB.TrackData]): the tracks to write files for
+        tracks_per_dir (int): the number of files in each subdirectory
+
+    Returns:
+        list[str]: the paths of the written files
+    """
+    filepaths = []
+    for index, track_data in enumerate(track_data_list):
+        directory = os.path.join(music_dir, f"dir{index // tracks_per_dir:04d}")
+        os.makedirs(directory, exist_ok=True)
+
+        filepath = os.path.join(directory, f"{index:06d}.flac")
+        with open(filepath, "wb") as file:
+            file.write(_flac_bytes({
+                "title": track_data.title,
+                "artist": ", ".join(name for name, _ in track_data.artists),
+                "album": track_data.album,
+                "date": track_data.release_date,
+            }))
+        filepaths.append(filepath)
+
+    return filepaths
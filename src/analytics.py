@@ -0,0 +1,251 @@
+# library statistics computed with numpy instead of sql
+#   - load_library_arrays() reads tracks, artists, playlists, track_artists and playlist_tracks once and turns every id into an index into a sorted id
+#     array, so the association tables become plain integer arrays
+#   - the statistics are then bincounts, sorts and a matrix product over those arrays. a new statistic doesn't cost another pass over the database, which
+#     matters for the ones sql is bad at like per year counts for every artist or the overlap between every pair of playlists
+#   - LibraryAnalytics keeps the arrays around until souldb.get_library_version() says the library changed, the daemon keeps them warm between requests
+from dataclasses import dataclass
+import threading
+
+import numpy as np
+import sqlalchemy as sqla
+
+import souldb as SoulDB
+
+@dataclass
+class LibraryArrays:
+    version: int | None
+    # the ids of each table in ascending order, the other arrays refer to rows by their position in these ("codes")
+    track_ids: np.ndarray
+    artist_ids: np.ndarray
+    playlist_ids: np.ndarray
+    track_titles: np.ndarray
+    track_albums: np.ndarray
+    # the year from release_date, 0 when it's unknown
+    track_years: np.ndarray
+    track_has_file: np.ndarray
+    artist_names: np.ndarray
+    playlist_names: np.ndarray
+    # one entry per track_artists row
+    track_artist_tracks: np.ndarray
+    track_artist_artists: np.ndarray
+    # one entry per playlist_tracks row
+    playlist_track_playlists: np.ndarray
+    playlist_track_tracks: np.ndarray
+
+def _to_codes(ids: list[int], sorted_ids: np.ndarray) -> np.ndarray:
+    return np.searchsorted(sorted_ids, np.array(ids, dtype=np.int64)).astype(np.int32)
+
+def _parse_year(release_date: str | None) -> int:
+    # spotify release dates are "YYYY", "YYYY-MM" or "YYYY-MM-DD"
+    if release_date and release_date[:4].isdigit():
+        return int(release_date[:4])
+    return 0
+
+def load_library_arrays(sql_session, version: int | None = None) -> LibraryArrays:
+    """
+    Reads the library into integer coded numpy arrays with one query per table
+
+    Args:
+        sql_session: the sqlalchemy session
+        version (int|None): the library version the arrays are for, see souldb.get_library_version()
+
+    Returns:
+        LibraryArrays: the arrays
+    """
+    track_rows = sql_session.execute(sqla.text("SELECT id, title, album, release_date, filepath FROM tracks ORDER BY id")).all()
+    artist_rows = sql_session.execute(sqla.text("SELECT id, name FROM artists ORDER BY id")).all()
+    playlist_rows = sql_session.execute(sqla.text("SELECT id, name FROM playlists ORDER BY id")).all()
+    track_artist_rows = sql_session.execute(sqla.text("SELECT track_id, artist_id FROM track_artists")).all()
+    playlist_track_rows = sql_session.execute(sqla.text("SELECT playlist_id, track_id FROM playlist_tracks")).all()
+
+    track_ids = np.array([row[0] for row in track_rows], dtype=np.int64)
+    artist_ids = np.array([row[0] for row in artist_rows], dtype=np.int64)
+    playlist_ids = np.array([row[0] for row in playlist_rows], dtype=np.int64)
+
+    return LibraryArrays(
+        version=version,
+        track_ids=track_ids,
+        artist_ids=artist_ids,
+        playlist_ids=playlist_ids,
+        track_titles=np.array([row[1] for row in track_rows], dtype=object),
+        track_albums=np.array([row[2] for row in track_rows], dtype=object),
+        track_years=np.fromiter((_parse_year(row[3]) for row in track_rows), dtype=np.int32, count=len(track_rows)),
+        track_has_file=np.fromiter((bool(row[4]) for row in track_rows), dtype=bool, count=len(track_rows)),
+        artist_names=np.array([row[1] for row in artist_rows], dtype=object),
+        playlist_names=np.array([row[1] for row in playlist_rows], dtype=object),
+        track_artist_tracks=_to_codes([row[0] for row in track_artist_rows], track_ids),
+        track_artist_artists=_to_codes([row[1] for row in track_artist_rows], artist_ids),
+        playlist_track_playlists=_to_codes([row[0] for row in playlist_track_rows], playlist_ids),
+        playlist_track_tracks=_to_codes([row[1] for row in playlist_track_rows], track_ids),
+    )
+
+# ===========================================
+#               group by / top k
+# ===========================================
+
+def top_k(values: np.ndarray, k: int) -> np.ndarray:
+    """
+    Returns:
+        np.ndarray: the positions of the k largest values, largest first
+    """
+    if k >= len(values):
+        return np.argsort(-values, kind="stable")
+    candidates = np.argpartition(-values, k)[:k]
+    return candidates[np.argsort(-values[candidates], kind="stable")]
+
+def get_artist_track_counts(arrays: LibraryArrays) -> np.ndarray:
+    return np.bincount(arrays.track_artist_artists, minlength=len(arrays.artist_ids))
+
+def get_track_playlist_counts(arrays: LibraryArrays) -> np.ndarray:
+    return np.bincount(arrays.playlist_track_tracks, minlength=len(arrays.track_ids))
+
+def get_playlist_track_counts(arrays: LibraryArrays) -> np.ndarray:
+    return np.bincount(arrays.playlist_track_playlists, minlength=len(arrays.playlist_ids))
+
+def get_favorite_artists(arrays: LibraryArrays, k: int = 10) -> list[tuple[str, int]]:
+    counts = get_artist_track_counts(arrays)
+    return [(arrays.artist_names[index], int(counts[index])) for index in top_k(counts, k)]
+
+def get_favorite_tracks(arrays: LibraryArrays, k: int = 10) -> list[tuple[str, int]]:
+    counts = get_track_playlist_counts(arrays)
+    return [(arrays.track_titles[index], int(counts[index])) for index in top_k(counts, k)]
+
+def get_average_tracks_per_playlist(arrays: LibraryArrays) -> float | None:
+    counts = get_playlist_track_counts(arrays)
+    nonempty_counts = counts[counts > 0]
+    return float(nonempty_counts.mean()) if len(nonempty_counts) > 0 else None
+
+def get_playlists_with_above_avg_track_count(arrays: LibraryArrays) -> list[tuple[str, int]]:
+    average = get_average_tracks_per_playlist(arrays)
+    if average is None:
+        return []
+
+    counts = get_playlist_track_counts(arrays)
+    above_average = np.flatnonzero(counts > average)
+    above_average = above_average[np.argsort(-counts[above_average], kind="stable")]
+    return [(arrays.playlist_names[index], int(counts[index])) for index in above_average]
+
+def get_top_tracks_per_artist(arrays: LibraryArrays, k: int = 3) -> list[tuple[str, str, int]]:
+    """
+    The vectorized version of main.get_top_3_tracks_per_artist(): sort the track_artists rows by artist and playlist count, then keep the first k rows
+    of every artist
+
+    Returns:
+        list[tuple[str, str, int]]: (artist name, track title, number of playlists) ordered by artist name and then number of playlists
+    """
+    playlist_counts = get_track_playlist_counts(arrays)[arrays.track_artist_tracks]
+    order = np.lexsort((-playlist_counts, arrays.track_artist_artists))
+    sorted_artists = arrays.track_artist_artists[order]
+
+    # each row's position within its artist's group is its distance from the first row of the group
+    group_starts = np.searchsorted(sorted_artists, sorted_artists, side="left")
+    kept = order[np.arange(len(order)) - group_starts < k]
+
+    artist_name_ranks = np.empty(len(arrays.artist_ids), dtype=np.int64)
+    artist_name_ranks[np.argsort(arrays.artist_names.astype(str), kind="stable")] = np.arange(len(arrays.artist_ids))
+    kept = kept[np.lexsort((-playlist_counts[kept], artist_name_ranks[arrays.track_artist_artists[kept]]))]
+
+    return [
+        (arrays.artist_names[arrays.track_artist_artists[row]], arrays.track_titles[arrays.track_artist_tracks[row]], int(playlist_counts[row]))
+        for row in kept
+    ]
+
+def get_tracks_per_year(arrays: LibraryArrays) -> dict[int, int]:
+    years, counts = np.unique(arrays.track_years[arrays.track_years > 0], return_counts=True)
+    return dict(zip(years.tolist(), counts.tolist()))
+
+def get_artist_tracks_per_year(arrays: LibraryArrays, num_artists: int = 10) -> tuple[list[str], list[int], np.ndarray]:
+    """
+    Counts the tracks of the artists with the most tracks by release year, i.e. how each favorite artist shows up in the library over time
+
+    Returns:
+        tuple[list[str], list[int], np.ndarray]: the artist names, the years, and a matrix with a row per artist and a column per year
+    """
+    artists = top_k(get_artist_track_counts(arrays), num_artists)
+    track_years = arrays.track_years[arrays.track_artist_tracks]
+
+    is_relevant = np.isin(arrays.track_artist_artists, artists) & (track_years > 0)
+    years, year_codes = np.unique(track_years[is_relevant], return_inverse=True)
+
+    artist_rows = np.full(len(arrays.artist_ids), -1, dtype=np.int64)
+    artist_rows[artists] = np.arange(len(artists))
+    matrix = np.zeros((len(artists), len(years)), dtype=np.int64)
+    np.add.at(matrix, (artist_rows[arrays.track_artist_artists[is_relevant]], year_codes), 1)
+
+    return [arrays.artist_names[index] for index in artists], years.tolist(), matrix
+
+# ===========================================
+#               playlist overlap
+# ===========================================
+
+def get_playlist_jaccard(arrays: LibraryArrays, block_size: int = None) -> np.ndarray:
+    """
+    Computes the jaccard similarity (shared tracks / tracks in either) of every pair of playlists. The playlist x track membership matrix is multiplied
+    with itself a block of tracks at a time so memory stays bounded for big libraries
+
+    Args:
+        block_size (int): the number of tracks per block, by default sized so that a block is about 64MB
+
+    Returns:
+        np.ndarray: a symmetric num_playlists x num_playlists matrix, 0 for pairs where both playlists are empty
+    """
+    num_playlists = len(arrays.playlist_ids)
+    # a track can be in the same playlist twice, it only counts once here
+    pairs = np.unique(arrays.playlist_track_playlists.astype(np.int64) * len(arrays.track_ids) + arrays.playlist_track_tracks)
+    playlist_codes, track_codes = np.divmod(pairs, max(len(arrays.track_ids), 1))
+
+    # only tracks that are in a playlist get a column
+    used_tracks, track_columns = np.unique(track_codes, return_inverse=True)
+    block_size = block_size or max(1024, (16 * 1024 * 1024) // max(num_playlists, 1))
+
+    intersections = np.zeros((num_playlists, num_playlists), dtype=np.float64)
+    for block_start in range(0, len(used_tracks), block_size):
+        in_block = (track_columns >= block_start) & (track_columns < block_start + block_size)
+        membership = np.zeros((num_playlists, min(block_size, len(used_tracks) - block_start)), dtype=np.float32)
+        membership[playlist_codes[in_block], track_columns[in_block] - block_start] = 1
+        intersections += membership @ membership.T
+
+    sizes = np.diag(intersections).copy()
+    unions = sizes[:, None] + sizes[None, :] - intersections
+    return np.divide(intersections, unions, out=np.zeros_like(intersections), where=unions > 0)
+
+def get_most_similar_playlists(arrays: LibraryArrays, k: int = 10) -> list[tuple[str, str, float]]:
+    """
+    Returns:
+        list[tuple[str, str, float]]: the k pairs of different playlists with the highest jaccard similarity, most similar first
+    """
+    jaccard = get_playlist_jaccard(arrays)
+    first, second = np.triu_indices(len(arrays.playlist_ids), k=1)
+    similarities = jaccard[first, second]
+    return [
+        (arrays.playlist_names[first[index]], arrays.playlist_names[second[index]], float(similarities[index]))
+        for index in top_k(similarities, k)
+        if similarities[index] > 0
+    ]
+
+# ===========================================
+#                   cache
+# ===========================================
+
+class LibraryAnalytics:
+    """
+    Caches the LibraryArrays of a database until its library version changes. Databases without a version (anything but sqlite) are reloaded every time
+    """
+    def __init__(self):
+        self._arrays: LibraryArrays | None = None
+        self._db_url: str | None = None
+        self._lock = threading.Lock()
+
+    def get_arrays(self, sql_session) -> LibraryArrays:
+        # the version is read before the tables, if the library changes while we load the next call sees a newer version and loads again
+        version = SoulDB.get_library_version(sql_session)
+        db_url = str(sql_session.get_bind().url)
+
+        with self._lock:
+            if self._arrays is None or version is None or self._arrays.version != version or self._db_url != db_url:
+                self._arrays = load_library_arrays(sql_session, version)
+                self._db_url = db_url
+            return self._arrays
+
+LIBRARY_ANALYTICS = LibraryAnalytics()
@@ -0,0 +1,279 @@
+# estimates the tempo and musical key of the downloaded files
+#   - ffmpeg decodes each file to mono float samples that are read from its stdout a block at a time, so a long mix never has to fit in memory
+#   - the tempo comes from the autocorrelation of an onset envelope (how much the spectrum jumps between short frames), weighted towards ~120 bpm so we
+#     don't pick half or double the tempo
+#   - the key comes from a chromagram (energy per pitch class) correlated with the Krumhansl-Schmuckler major and minor key profiles
+#   - files are decoded and analyzed in a process pool. the results are cached in souldb.AudioAnalysis by the sha256 of the file, so a file that was
+#     moved, or is in the library twice, is only analyzed once
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import subprocess
+import tempfile
+import hashlib
+import os
+
+import numpy as np
+import sqlalchemy as sqla
+
+import souldb as SoulDB
+
+# bump this when the dsp changes so the cached results are recomputed
+ANALYSIS_VERSION = 1
+
+SAMPLE_RATE = 11025
+DEFAULT_MAX_SECONDS = 240
+READ_BLOCK_SAMPLES = SAMPLE_RATE * 10
+
+# short frames for the onset envelope (~86 per second), long frames for the chromagram so neighbouring semitones land in different bins
+ONSET_FFT_SIZE = 512
+ONSET_HOP = 128
+CHROMA_FFT_SIZE = 4096
+CHROMA_HOP = 2048
+CHROMA_MIN_FREQUENCY = 55
+CHROMA_MAX_FREQUENCY = 2000
+
+MIN_BPM = 60
+MAX_BPM = 200
+PREFERRED_BPM = 120
+
+PITCH_CLASSES = ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B"]
+MAJOR_PROFILE = np.array([6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88])
+MINOR_PROFILE = np.array([6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17])
+
+def hash_file(filepath: str) -> str:
+    file_hash = hashlib.sha256()
+    with open(filepath, "rb") as file:
+        while chunk := file.read(1024 * 1024):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+def iter_pcm_blocks(filepath: str, max_seconds: float = DEFAULT_MAX_SECONDS):
+    """
+    Decodes a file with ffmpeg
+
+    Yields:
+        np.ndarray: mono float32 samples at SAMPLE_RATE, READ_BLOCK_SAMPLES at a time
+    """
+    command = ["ffmpeg", "-v", "error", "-nostdin", "-i", filepath, "-vn", "-ac", "1", "-ar", str(SAMPLE_RATE)]
+    if max_seconds:
+        command += ["-t", str(max_seconds)]
+    command += ["-f", "f32le", "-"]
+
+    # stderr goes to a temp file rather than a pipe, a broken file can log more errors than a pipe holds while we are only reading stdout
+    with tempfile.TemporaryFile() as stderr_file:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr_file)
+        try:
+            while True:
+                data = process.stdout.read(READ_BLOCK_SAMPLES * 4)
+                if not data:
+                    break
+                yield np.frombuffer(data[:len(data) - len(data) % 4], dtype=np.float32)
+
+            # a file ffmpeg can't decode just yields nothing, it has to fail here or its empty result would be cached as the analysis
+            if process.wait() != 0:
+                stderr_file.seek(0)
+                error_lines = stderr_file.read().decode(errors="replace").strip().splitlines()
+                raise RuntimeError(f"ffmpeg exited with status {process.returncode} for {filepath}: {error_lines[-1] if error_lines else 'no error output'}")
+        finally:
+            process.stdout.close()
+            process.kill()
+            process.wait()
+
+class StreamingStft:
+    """
+    Turns blocks of samples into magnitude spectra of overlapping hann windowed frames, the samples that don't fill a frame yet are kept for the next block
+    """
+    def __init__(self, fft_size: int, hop: int):
+        self.fft_size = fft_size
+        self.hop = hop
+        self.window = np.hanning(fft_size).astype(np.float32)
+        self._buffer = np.zeros(0, dtype=np.float32)
+
+    def push(self, samples: np.ndarray) -> np.ndarray:
+        """
+        Returns:
+            np.ndarray: a (num_frames, fft_size // 2 + 1) array, num_frames can be 0
+        """
+        self._buffer = np.concatenate([self._buffer, samples])
+        num_frames = 0 if len(self._buffer) < self.fft_size else (len(self._buffer) - self.fft_size) // self.hop + 1
+        if num_frames == 0:
+            return np.zeros((0, self.fft_size // 2 + 1), dtype=np.float32)
+
+        frames = np.lib.stride_tricks.sliding_window_view(self._buffer, self.fft_size)[::self.hop][:num_frames]
+        magnitudes = np.abs(np.fft.rfft(frames * self.window, axis=1)).astype(np.float32)
+        self._buffer = self._buffer[num_frames * self.hop:]
+        return magnitudes
+
+def get_pitch_class_matrix(fft_size: int = CHROMA_FFT_SIZE, sample_rate: int = SAMPLE_RATE) -> np.ndarray:
+    """
+    Returns:
+        np.ndarray: a (fft_size // 2 + 1, 12) matrix that sums the fft bins between CHROMA_MIN_FREQUENCY and CHROMA_MAX_FREQUENCY into pitch classes, C first
+    """
+    frequencies = np.fft.rfftfreq(fft_size, 1 / sample_rate)
+    in_range = (frequencies >= CHROMA_MIN_FREQUENCY) & (frequencies <= CHROMA_MAX_FREQUENCY)
+
+    matrix = np.zeros((len(frequencies), 12), dtype=np.float32)
+    midi_notes = np.round(69 + 12 * np.log2(frequencies[in_range] / 440)).astype(int)
+    matrix[np.flatnonzero(in_range), midi_notes % 12] = 1
+    return matrix
+
+def estimate_bpm(onset_envelope: np.ndarray, frames_per_second: float) -> float | None:
+    """
+    Picks the autocorrelation peak of the onset envelope between MIN_BPM and MAX_BPM, weighted with a log normal prior around PREFERRED_BPM
+    """
+    if len(onset_envelope) < frames_per_second * 4:
+        return None
+
+    envelope = onset_envelope - onset_envelope.mean()
+    spectrum = np.fft.rfft(envelope, n=2 * len(envelope))
+    autocorrelation = np.fft.irfft(spectrum * np.conj(spectrum))[:len(envelope)]
+    if autocorrelation[0] <= 0:
+        return None
+
+    lags = np.arange(int(60 * frames_per_second / MAX_BPM), int(60 * frames_per_second / MIN_BPM) + 1)
+    bpms = 60 * frames_per_second / lags
+    weights = np.exp(-0.5 * np.log2(bpms / PREFERRED_BPM) ** 2)
+    scores = autocorrelation[lags] / autocorrelation[0] * weights
+
+    best = int(np.argmax(scores))
+    lag = float(lags[best])
+    # parabolic interpolation between the neighbouring lags, a whole frame is ~1.5 bpm at 120 bpm
+    if 0 < best < len(scores) - 1:
+        left, center, right = autocorrelation[lags[best - 1]], autocorrelation[lags[best]], autocorrelation[lags[best + 1]]
+        denominator = left - 2 * center + right
+        if denominator != 0:
+            lag += 0.5 * (left - right) / denominator
+
+    return round(float(60 * frames_per_second / lag), 1)
+
+def estimate_key(chroma: np.ndarray) -> str | None:
+    """
+    Correlates a chroma vector with the 24 rotated key profiles
+
+    Returns:
+        str|None: e.g. "C" or "F#m", the same notation VirtualDJ uses. None for silence
+    """
+    if chroma.sum() <= 0:
+        return None
+
+    rotations = (np.arange(12)[None, :] - np.arange(12)[:, None]) % 12
+    profiles = np.concatenate([MAJOR_PROFILE[rotations], MINOR_PROFILE[rotations]])
+    profiles = (profiles - profiles.mean(axis=1, keepdims=True)) / profiles.std(axis=1, keepdims=True)
+    normalized_chroma = (chroma - chroma.mean()) / (chroma.std() or 1)
+
+    best = int(np.argmax(profiles @ normalized_chroma))
+    return PITCH_CLASSES[best % 12] + ("m" if best >= 12 else "")
+
+def analyze_samples(blocks) -> tuple[float | None, str | None]:
+    """
+    Estimates the tempo and key from blocks of samples at SAMPLE_RATE
+
+    Returns:
+        tuple[float|None, str|None]: the bpm and key
+    """
+    onset_stft = StreamingStft(ONSET_FFT_SIZE, ONSET_HOP)
+    chroma_stft = StreamingStft(CHROMA_FFT_SIZE, CHROMA_HOP)
+    pitch_class_matrix = get_pitch_class_matrix()
+
+    onset_envelope = []
+    previous_log_magnitudes = None
+    chroma = np.zeros(12, dtype=np.float64)
+
+    for block in blocks:
+        log_magnitudes = np.log1p(100 * onset_stft.push(block))
+        if len(log_magnitudes) > 0:
+            if previous_log_magnitudes is not None:
+                log_magnitudes_with_previous = np.concatenate([previous_log_magnitudes[None, :], log_magnitudes])
+            else:
+                log_magnitudes_with_previous = np.concatenate([log_magnitudes[:1], log_magnitudes])
+            # spectral flux, only increases in energy count as onsets
+            onset_envelope.append(np.maximum(np.diff(log_magnitudes_with_previous, axis=0), 0).sum(axis=1))
+            previous_log_magnitudes = log_magnitudes[-1]
+
+        chroma += (chroma_stft.push(block) @ pitch_class_matrix).sum(axis=0)
+
+    onset_envelope = np.concatenate(onset_envelope) if onset_envelope else np.zeros(0)
+    return estimate_bpm(onset_envelope, SAMPLE_RATE / ONSET_HOP), estimate_key(chroma)
+
+def analyze_file(filepath: str, max_seconds: float = DEFAULT_MAX_SECONDS) -> tuple[float | None, str | None]:
+    # runs in the process pool
+    return analyze_samples(iter_pcm_blocks(filepath, max_seconds))
+
+def analyze_library(sql_session, max_workers: int = None, max_seconds: float = DEFAULT_MAX_SECONDS, force: bool = False, chunk_size: int = 100) -> dict[str, int]:
+    """
+    Fills in the bpm and key of downloaded tracks. Tracks that already have both (e.g. from a VirtualDJ import) are skipped unless force is set
+
+    Args:
+        sql_session: the sqlalchemy session
+        max_workers (int): the number of analysis processes, defaults to the number of cpus
+        max_seconds (float): only this much of the start of each file is analyzed
+        force (bool): analyze tracks that already have a bpm and key, the cache is still used
+        chunk_size (int): the number of finished tracks per commit
+
+    Returns:
+        dict[str, int]: the number of tracks that were analyzed, taken from the cache, and that failed
+    """
+    query = sql_session.query(SoulDB.Tracks.id, SoulDB.Tracks.filepath).filter(SoulDB.Tracks.filepath.isnot(None), SoulDB.Tracks.filepath != "")
+    if not force:
+        query = query.filter(sqla.or_(SoulDB.Tracks.bpm.is_(None), SoulDB.Tracks.key.is_(None)))
+    track_ids_by_filepath: dict[str, list[int]] = {}
+    for track_id, filepath in query:
+        if os.path.exists(filepath):
+            track_ids_by_filepath.setdefault(filepath, []).append(track_id)
+
+    counts = {"analyzed": 0, "cached": 0, "failed": 0}
+    if len(track_ids_by_filepath) == 0:
+        print("No tracks to analyze")
+        return counts
+
+    # hashing is disk bound and hashlib releases the gil, so threads are enough
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        hashes_by_filepath = dict(zip(track_ids_by_filepath, executor.map(hash_file, track_ids_by_filepath)))
+
+    cached_results = SoulDB.AudioAnalysis.get_results(sql_session, set(hashes_by_filepath.values()), ANALYSIS_VERSION)
+    updates = []
+
+    def add_updates(filepath: str, bpm: float | None, key: str | None):
+        for track_id in track_ids_by_filepath[filepath]:
+            updates.append({"id": track_id, "bpm": bpm, "key": key, "content_hash": hashes_by_filepath[filepath]})
+        if len(updates) >= chunk_size:
+            flush_updates()
+
+    def flush_updates():
+        if len(updates) > 0:
+            sql_session.execute(sqla.update(SoulDB.Tracks), updates)
+        sql_session.commit()
+        updates.clear()
+
+    files_to_analyze = []
+    for filepath, content_hash in hashes_by_filepath.items():
+        cached_result = cached_results.get(content_hash)
+        if cached_result is not None:
+            add_updates(filepath, cached_result.bpm, cached_result.key)
+            counts["cached"] += 1
+        else:
+            files_to_analyze.append(filepath)
+
+    # a file that is in the library twice is only analyzed once
+    files_by_hash = {}
+    for filepath in files_to_analyze:
+        files_by_hash.setdefault(hashes_by_filepath[filepath], []).append(filepath)
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(analyze_file, filepaths[0], max_seconds): content_hash for content_hash, filepaths in files_by_hash.items()}
+        for future in as_completed(futures):
+            content_hash = futures[future]
+            try:
+                bpm, key = future.result()
+            except Exception as e:
+                print(f"Error analyzing {files_by_hash[content_hash][0]}: {e}")
+                counts["failed"] += len(files_by_hash[content_hash])
+                continue
+
+            SoulDB.AudioAnalysis.add_result(sql_session, content_hash, bpm, key, ANALYSIS_VERSION)
+            for filepath in files_by_hash[content_hash]:
+                add_updates(filepath, bpm, key)
+                counts["analyzed"] += 1
+
+    flush_updates()
+    print(f"Analyzed {counts['analyzed']} tracks, {counts['cached']} from the cache, {counts['failed']} failed")
+    return counts
@@ -0,0 +1,262 @@
+# long running daemon mode
+#   - every cli invocation pays for a fresh interpreter, spotify oauth handshake, sqlalchemy engine, and library scan. the daemon pays for those once and keeps them warm
+#   - it serves a small json api on localhost, the cli checks for a running daemon first and sends it the command instead of doing the work itself
+#   - jobs that write to the database (downloads, syncs, scans) run one at a time on a single worker thread that owns the main session,
+#     read only queries (search, stats) run on the http threads with their own short lived sessions
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, urlencode
+from dataclasses import dataclass, field
+from typing import Callable
+import urllib.request
+import urllib.error
+import threading
+import traceback
+import itertools
+import queue
+import json
+import time
+import os
+
+import sqlalchemy as sqla
+
+DEFAULT_DAEMON_HOST = "127.0.0.1"
+DEFAULT_DAEMON_PORT = 5040
+
+@dataclass
+class Job:
+    id: int
+    kind: str
+    params: dict
+    state: str = "queued"
+    result: object = None
+    error: str = None
+    created_at: float = field(default_factory=time.time)
+    started_at: float = None
+    finished_at: float = None
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "params": self.params,
+            "state": self.state,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+class SoulRipperDaemon:
+    def __init__(self, context, job_handlers: dict[str, Callable], query_handlers: dict[str, Callable], host: str = DEFAULT_DAEMON_HOST, port: int = DEFAULT_DAEMON_PORT):
+        """
+        Args:
+            context (AppContext): the application context whose clients, engine, and session stay alive for the lifetime of the daemon
+            job_handlers (dict[str, Callable]): job kind -> handler(context, params) for work that writes to the database, run one at a time on the worker thread
+            query_handlers (dict[str, Callable]): query name -> handler(sql_session, params) for read only queries, run on the http threads
+            host (str): the interface to listen on, this should stay on localhost since the api has no authentication
+            port (int): the port to listen on
+        """
+        self.context = context
+        self.job_handlers = job_handlers
+        self.query_handlers = query_handlers
+        self.host = host
+        self.port = port
+        self.started_at = time.time()
+
+        self.jobs: dict[int, Job] = {}
+        self.job_queue: queue.Queue[Job] = queue.Queue()
+        self.current_job: Job = None
+        self._job_ids = itertools.count(1)
+        self._jobs_lock = threading.Lock()
+        self._stopped = threading.Event()
+
+        self.http_server: ThreadingHTTPServer = None
+
+    def warm_up(self):
+        """
+        Builds everything the jobs need up front so the first request doesn't pay for it. Spotify and slskd are allowed to fail here, the jobs will retry them lazily
+        """
+        self.context.get_scanned_session()
+        self.read_sessionmaker = sqla.orm.sessionmaker(bind=self.context.db_engine)
+
+        for client_name in ("spotify_client", "slskd_client"):
+            try:
+                getattr(self.context, client_name)
+            except Exception as e:
+                print(f"Could not initialize {client_name} while warming up the daemon, it will be retried when a job needs it: {e}")
+
+    def submit(self, kind: str, params: dict) -> Job:
+        if kind not in self.job_handlers:
+            raise KeyError(f"Unknown job kind: {kind}")
+
+        with self._jobs_lock:
+            job = Job(id=next(self._job_ids), kind=kind, params=params)
+            self.jobs[job.id] = job
+
+        self.job_queue.put(job)
+        return job
+
+    def run_query(self, name: str, params: dict):
+        if name not in self.query_handlers:
+            raise KeyError(f"Unknown query: {name}")
+
+        with self.read_sessionmaker() as sql_session:
+            return self.query_handlers[name](sql_session, params)
+
+    def status(self) -> dict:
+        return {
+            "pid": os.getpid(),
+            "uptime_s": round(time.time() - self.started_at, 1),
+            "queue_length": self.job_queue.qsize(),
+            "current_job": self.current_job.to_dict() if self.current_job else None,
+            "num_jobs": len(self.jobs),
+        }
+
+    def _worker(self):
+        while not self._stopped.is_set():
+            try:
+                job = self.job_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+
+            self.current_job = job
+            job.state = "running"
+            job.started_at = time.time()
+            print(f"Daemon running job {job.id}: {job.kind} {job.params}")
+
+            try:
+                job.result = self.job_handlers[job.kind](self.context, job.params)
+                job.state = "done"
+            except Exception as e:
+                # a failed job shouldn't leave the shared session unusable for the next one
+                self.context.sql_session.rollback()
+                job.error = "".join(traceback.format_exception_only(type(e), e)).strip()
+                job.state = "failed"
+                traceback.print_exc()
+            finally:
+                job.finished_at = time.time()
+                self.current_job = None
+
+    def serve_forever(self):
+        self.warm_up()
+
+        worker_thread = threading.Thread(target=self._worker, name="soulripper-daemon-worker", daemon=True)
+        worker_thread.start()
+
+        self.http_server = ThreadingHTTPServer((self.host, self.port), _make_request_handler(self))
+        print(f"SoulRipper daemon listening on http://{self.host}:{self.port}")
+
+        try:
+            self.http_server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._stopped.set()
+            self.http_server.server_close()
+            worker_thread.join(timeout=5)
+
+    def shutdown(self):
+        # serve_forever() returns once the http server stops, shutdown() has to be called from another thread
+        threading.Thread(target=self.http_server.shutdown, daemon=True).start()
+
+def _make_request_handler(daemon: SoulRipperDaemon):
+    class DaemonRequestHandler(BaseHTTPRequestHandler):
+        # routes:
+        #   GET  /status            daemon status and queue length
+        #   GET  /jobs              every job the daemon has seen
+        #   GET  /jobs/<id>         a single job
+        #   POST /jobs/<kind>       queue a job, the json body is its params
+        #   GET  /query/<name>      run a read only query, the url params are its params
+        #   POST /shutdown          stop the daemon
+        def do_GET(self):
+            url = urlparse(self.path)
+            path_parts = [part for part in url.path.split("/") if part]
+            params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+
+            match path_parts:
+                case ["status"]:
+                    self._send_json(200, daemon.status())
+                case ["jobs"]:
+                    self._send_json(200, [job.to_dict() for job in list(daemon.jobs.values())])
+                case ["jobs", job_id] if job_id.isdigit() and int(job_id) in daemon.jobs:
+                    self._send_json(200, daemon.jobs[int(job_id)].to_dict())
+                case ["query", name] if name in daemon.query_handlers:
+                    try:
+                        self._send_json(200, daemon.run_query(name, params))
+                    except Exception as e:
+                        self._send_json(500, {"error": str(e)})
+                case _:
+                    self._send_json(404, {"error": f"Not found: {url.path}"})
+
+        def do_POST(self):
+            path_parts = [part for part in urlparse(self.path).path.split("/") if part]
+            content_length = int(self.headers.get("Content-Length", 0))
+            try:
+                params = json.loads(self.rfile.read(content_length) or b"{}")
+            except json.JSONDecodeError as e:
+                self._send_json(400, {"error": f"Invalid json body: {e}"})
+                return
+
+            match path_parts:
+                case ["jobs", kind] if kind in daemon.job_handlers:
+                    self._send_json(202, daemon.submit(kind, params).to_dict())
+                case ["shutdown"]:
+                    self._send_json(200, {"stopping": True})
+                    daemon.shutdown()
+                case _:
+                    self._send_json(404, {"error": f"Not found: {self.path}"})
+
+        def _send_json(self, status: int, data):
+            body = json.dumps(data, default=str).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # the default handler logs every request to stderr which drowns out the job output
+            pass
+
+    return DaemonRequestHandler
+
+class DaemonClient:
+    def __init__(self, host: str = DEFAULT_DAEMON_HOST, port: int = DEFAULT_DAEMON_PORT, timeout: float = 10):
+        self.base_url = f"http://{host}:{port}"
+        self.timeout = timeout
+
+    def is_running(self) -> bool:
+        # a short timeout keeps the cli fast when there is no daemon
+        try:
+            self._request("GET", "/status", timeout=0.2)
+            return True
+        except (urllib.error.URLError, ConnectionError, TimeoutError, OSError):
+            return False
+
+    def submit_job(self, kind: str, params: dict) -> dict:
+        return self._request("POST", f"/jobs/{kind}", params)
+
+    def get_job(self, job_id: int) -> dict:
+        return self._request("GET", f"/jobs/{job_id}")
+
+    def query(self, name: str, params: dict):
+        query_string = urlencode({key: value for key, value in params.items() if value is not None})
+        return self._request("GET", f"/query/{name}?{query_string}")
+
+    def wait_for_job(self, job_id: int, poll_interval: float = 1.0) -> dict:
+        while True:
+            job = self.get_job(job_id)
+            if job["state"] in ("done", "failed"):
+                return job
+            time.sleep(poll_interval)
+
+    def _request(self, method: str, path: str, data: dict = None, timeout: float = None):
+        body = json.dumps(data).encode("utf-8") if data is not None else None
+        request = urllib.request.Request(self.base_url + path, data=body, method=method, headers={"Content-Type": "application/json"})
+
+        try:
+            with urllib.request.urlopen(request, timeout=timeout or self.timeout) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            raise RuntimeError(f"Daemon returned {e.code} for {method} {path}: {e.read().decode(errors='replace')}") from e
@@ -0,0 +1,250 @@
+# one live view of every search and transfer that is running, shared by all of the download threads
+#   - the threads only update plain status objects, a single refresh thread redraws the rich Live display at most refresh_per_second times a second and
+#     only when something changed. before this every track had its own Console and Progress bar, which fought over the terminal when several ran at once
+#   - when stdout isn't a terminal (docker logs, a pipe, a log file) there is nothing to redraw, so a summary is printed as plain lines every log_interval
+#     seconds instead, and only while something is running
+#   - rich is slow to import so it is only imported once the first live display starts
+from dataclasses import dataclass, field
+from contextlib import contextmanager
+import itertools
+import threading
+import time
+import sys
+
+# the live table only shows this many rows, the rest are counted in the summary
+MAX_ROWS = 20
+
+@dataclass
+class SearchStatus:
+    query: str
+    started_at: float = field(default_factory=time.monotonic)
+    num_files: int = 0
+
+@dataclass
+class TransferStatus:
+    filename: str
+    username: str
+    started_at: float = field(default_factory=time.monotonic)
+    size: int = None
+    bytes_transferred: int = 0
+    percent_complete: float = 0.0
+    # bytes per second as reported by slskd, None until it has one
+    average_speed: float = None
+    succeeded: bool = False
+
+    @property
+    def speed(self) -> float:
+        if self.average_speed:
+            return self.average_speed
+        elapsed = time.monotonic() - self.started_at
+        return self.bytes_transferred / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def remaining_bytes(self) -> int | None:
+        return max(self.size - self.bytes_transferred, 0) if self.size else None
+
+    @property
+    def eta_seconds(self) -> float | None:
+        speed = self.speed
+        remaining_bytes = self.remaining_bytes
+        return remaining_bytes / speed if remaining_bytes is not None and speed > 0 else None
+
+def format_bytes(num_bytes: float) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(num_bytes) < 1024 or unit == "GB":
+            return f"{num_bytes:.1f} {unit}" if unit != "B" else f"{num_bytes:.0f} B"
+        num_bytes /= 1024
+
+def format_seconds(seconds: float | None) -> str:
+    if seconds is None:
+        return "-:--"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
+class TransferDashboard:
+    def __init__(self, refresh_per_second: float = 4, log_interval: float = 30):
+        """
+        Args:
+            refresh_per_second (float): the most times per second the live display is redrawn
+            log_interval (float): seconds between summary lines when stdout isn't a terminal
+        """
+        self.refresh_per_second = refresh_per_second
+        self.log_interval = log_interval
+
+        self._searches: dict[int, SearchStatus] = {}
+        self._transfers: dict[int, TransferStatus] = {}
+        self._num_queued = 0
+        self._num_succeeded = 0
+        self._num_failed = 0
+        self._ids = itertools.count()
+        self._changed = False
+
+        self._lock = threading.Lock()
+        self._num_users = 0
+        self._stopped = threading.Event()
+        self._thread: threading.Thread = None
+
+    def configure(self, refresh_per_second: float = None, log_interval: float = None):
+        if refresh_per_second:
+            self.refresh_per_second = refresh_per_second
+        if log_interval:
+            self.log_interval = log_interval
+
+    # ===========================================
+    #           updates from the downloaders
+    # ===========================================
+
+    @contextmanager
+    def search(self, query: str):
+        """
+        Shows a search on the dashboard for as long as the with block runs
+
+        Yields:
+            SearchStatus: update num_files on it as results come in
+        """
+        search_id, status = next(self._ids), SearchStatus(query)
+        with self._lock:
+            self._searches[search_id] = status
+            self._changed = True
+        try:
+            yield status
+        finally:
+            with self._lock:
+                del self._searches[search_id]
+                self._changed = True
+
+    @contextmanager
+    def transfer(self, filename: str, username: str):
+        """
+        Shows a transfer on the dashboard for as long as the with block runs. The transfer counts as failed unless the block sets status.succeeded = True
+
+        Yields:
+            TransferStatus: update it with update_transfer()
+        """
+        transfer_id, status = next(self._ids), TransferStatus(filename, username)
+        with self._lock:
+            self._transfers[transfer_id] = status
+            self._changed = True
+        try:
+            yield status
+        finally:
+            with self._lock:
+                del self._transfers[transfer_id]
+                if status.succeeded:
+                    self._num_succeeded += 1
+                else:
+                    self._num_failed += 1
+                self._changed = True
+
+    def update_transfer(self, status: TransferStatus, slskd_download: dict):
+        """
+        Copies the progress out of a slskd transfer, see slskd.transfers.get_download()
+        """
+        status.size = slskd_download.get("size") or status.size
+        status.bytes_transferred = slskd_download.get("bytesTransferred", status.bytes_transferred)
+        status.percent_complete = slskd_download.get("percentComplete", status.percent_complete)
+        status.average_speed = slskd_download.get("averageSpeed") or status.average_speed
+        self._changed = True
+
+    def add_queued(self, num_tracks: int):
+        with self._lock:
+            self._num_queued += num_tracks
+            self._changed = True
+
+    # ===========================================
+    #                  display
+    # ===========================================
+
+    @contextmanager
+    def running(self):
+        """
+        Keeps the display running for the with block, nested blocks (e.g. download_track() inside download_tracks()) share the outer display
+        """
+        with self._lock:
+            self._num_users += 1
+            if self._num_users == 1:
+                # every display gets its own stop event so one that is still shutting down can't be woken back up by the next one
+                self._stopped = threading.Event()
+                self._thread = threading.Thread(target=self._display_loop, args=(self._stopped,), name="soulripper-dashboard", daemon=True)
+                self._thread.start()
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._num_users -= 1
+                thread, stopped = (self._thread, self._stopped) if self._num_users == 0 else (None, None)
+                if thread is not None:
+                    stopped.set()
+            if thread is not None:
+                thread.join()
+                # the counts are per run, unless another run already started
+                with self._lock:
+                    if self._num_users == 0:
+                        self._num_succeeded = 0
+                        self._num_failed = 0
+
+    def _snapshot(self) -> tuple[list[SearchStatus], list[TransferStatus], int, int, int]:
+        with self._lock:
+            self._changed = False
+            return list(self._searches.values()), list(self._transfers.values()), self._num_queued, self._num_succeeded, self._num_failed
+
+    def get_summary(self) -> str:
+        searches, transfers, num_queued, num_succeeded, num_failed = self._snapshot()
+        total_speed = sum(transfer.speed for transfer in transfers)
+        remaining_bytes = sum(transfer.remaining_bytes or 0 for transfer in transfers)
+        eta = remaining_bytes / total_speed if total_speed > 0 else None
+        return (
+            f"{len(transfers)} transferring at {format_bytes(total_speed)}/s (ETA {format_seconds(eta)}), {len(searches)} searching, "
+            f"{num_queued} queued, {num_succeeded} done, {num_failed} failed"
+        )
+
+    def _display_loop(self, stopped: threading.Event):
+        if sys.stdout.isatty():
+            self._live_loop(stopped)
+        else:
+            self._log_loop(stopped)
+
+    def _live_loop(self, stopped: threading.Event):
+        from rich.live import Live
+
+        # auto_refresh is off, this thread decides when to redraw
+        with Live(self._render(), refresh_per_second=self.refresh_per_second, auto_refresh=False, transient=True) as live:
+            while not stopped.wait(1 / self.refresh_per_second):
+                # nothing is redrawn while nothing changed, e.g. when every transfer is waiting in a remote queue
+                if self._changed:
+                    live.update(self._render(), refresh=True)
+        print(self.get_summary())
+
+    def _log_loop(self, stopped: threading.Event):
+        while not stopped.wait(self.log_interval):
+            if len(self._searches) == 0 and len(self._transfers) == 0:
+                continue
+
+            _, transfers, _, _, _ = self._snapshot()
+            print(f"[downloads] {self.get_summary()}")
+            for transfer in transfers[:MAX_ROWS]:
+                print(f"[downloads]   {transfer.filename} from {transfer.username}: {transfer.percent_complete:.0f}% at {format_bytes(transfer.speed)}/s, ETA {format_seconds(transfer.eta_seconds)}")
+
+    def _render(self):
+        from rich.console import Group
+        from rich.table import Table
+        from rich.text import Text
+
+        searches, transfers, _, _, _ = self._snapshot()
+        table = Table(expand=True, box=None, header_style="light_steel_blue")
+        table.add_column("", width=9)
+        table.add_column("Track", ratio=1, overflow="ellipsis", no_wrap=True, style="bright_white")
+        table.add_column("Peer", width=16, overflow="ellipsis", no_wrap=True)
+        table.add_column("Progress", justify="right", width=8, style="green")
+        table.add_column("Speed", justify="right", width=11)
+        table.add_column("ETA", justify="right", width=8)
+
+        for transfer in sorted(transfers, key=lambda transfer: transfer.started_at)[:MAX_ROWS]:
+            table.add_row("download", transfer.filename, transfer.username, f"{transfer.percent_complete:.0f}%", f"{format_bytes(transfer.speed)}/s", format_seconds(transfer.eta_seconds))
+        for search in sorted(searches, key=lambda search: search.started_at)[:max(MAX_ROWS - len(transfers), 0)]:
+            table.add_row("search", search.query, "", f"{search.num_files} files", "", "")
+
+        return Group(table, Text(self.get_summary(), style="light_steel_blue"))
+
+DASHBOARD = TransferDashboard()
@@ -0,0 +1,168 @@
+# moves finished downloads from slskd's download folder into the output folder, copying the bytes only when there is no way around it
+#   - the methods are tried cheapest first: rename, hardlink, reflink (FICLONE), and finally a copy with large buffers
+#   - docker bind mounts of the same disk are different mounts, so rename and link fail with EXDEV even though the data is on one filesystem. a reflink
+#     only needs the same filesystem, so on btrfs/xfs it still places a FLAC in constant time
+#   - a copy goes to a temp file next to the destination that is fsynced, size checked, and renamed into place before the source is deleted, so a crash
+#     or a full disk never leaves a truncated track behind or loses the only copy
+#   - FilePlacer runs the placements on its own threads so the download workers can release their peer and start the next transfer right away
+from concurrent.futures import ThreadPoolExecutor, Future
+import threading
+import tempfile
+import os
+
+from metrics import METRICS
+
+# <linux/fs.h> _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+COPY_BUFFER_SIZE = 8 * 1024 * 1024
+
+def _rename(source_path: str, dest_path: str):
+    os.replace(source_path, dest_path)
+
+def _hardlink(source_path: str, dest_path: str):
+    # link to a temp name first since os.link() won't replace an existing file
+    temp_path = _get_temp_path(dest_path)
+    os.link(source_path, temp_path)
+    try:
+        os.replace(temp_path, dest_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    os.remove(source_path)
+
+def _reflink(source_path: str, dest_path: str):
+    import fcntl
+
+    def clone(source_file, dest_file):
+        fcntl.ioctl(dest_file.fileno(), FICLONE, source_file.fileno())
+
+    _write_through_temp_file(source_path, dest_path, clone)
+
+def _copy(source_path: str, dest_path: str):
+    def copy(source_file, dest_file):
+        # copy_file_range keeps the data in the kernel and lets nfs/smb copy on the server, the buffered loop is for filesystems that don't support it
+        try:
+            while os.copy_file_range(source_file.fileno(), dest_file.fileno(), COPY_BUFFER_SIZE) > 0:
+                pass
+            return
+        except (AttributeError, OSError):
+            source_file.seek(0)
+            dest_file.seek(0)
+            dest_file.truncate()
+
+        buffer = bytearray(COPY_BUFFER_SIZE)
+        view = memoryview(buffer)
+        while (num_read := source_file.readinto(buffer)) > 0:
+            dest_file.write(view[:num_read])
+
+    _write_through_temp_file(source_path, dest_path, copy)
+
+PLACEMENT_METHODS = {
+    "rename": _rename,
+    "hardlink": _hardlink,
+    "reflink": _reflink,
+    "copy": _copy,
+}
+
+def _get_temp_path(dest_path: str) -> str:
+    return os.path.join(os.path.dirname(dest_path), f".{os.path.basename(dest_path)}.{os.getpid()}.{threading.get_ident()}.part")
+
+def _write_through_temp_file(source_path: str, dest_path: str, write_function):
+    file_descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(dest_path), prefix=f".{os.path.basename(dest_path)}.", suffix=".part")
+    try:
+        with open(source_path, "rb") as source_file, os.fdopen(file_descriptor, "wb") as dest_file:
+            write_function(source_file, dest_file)
+            dest_file.flush()
+            os.fsync(dest_file.fileno())
+
+            expected_size = os.fstat(source_file.fileno()).st_size
+            actual_size = os.fstat(dest_file.fileno()).st_size
+            if actual_size != expected_size:
+                raise OSError(f"Placed {actual_size} of {expected_size} bytes of {source_path}")
+        os.replace(temp_path, dest_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    os.remove(source_path)
+
+def place_file(source_path: str, dest_path: str) -> str:
+    """
+    Moves a file to dest_path with the cheapest method that works, replacing whatever is already there
+
+    Args:
+        source_path (str): the finished download
+        dest_path (str): where it should end up
+
+    Returns:
+        str: the method that placed the file, one of PLACEMENT_METHODS
+    """
+    expected_size = os.stat(source_path).st_size
+    os.makedirs(os.path.dirname(os.path.abspath(dest_path)), exist_ok=True)
+
+    with METRICS.span("file_move", source=source_path, destination=dest_path, size=expected_size) as move_span:
+        last_error = None
+        for method_name, method in PLACEMENT_METHODS.items():
+            try:
+                method(source_path, dest_path)
+            except OSError as e:
+                # EXDEV, EPERM, EOPNOTSUPP, etc just mean this method doesn't work between these two paths
+                last_error = e
+                continue
+
+            actual_size = os.stat(dest_path).st_size
+            if actual_size != expected_size:
+                raise OSError(f"{dest_path} is {actual_size} bytes after a {method_name}, expected {expected_size}")
+
+            move_span["method"] = method_name
+            METRICS.increment("soulripper_file_placements_total", method=method_name)
+            return method_name
+
+        move_span["outcome"] = "failed"
+        raise last_error
+
+class FilePlacer:
+    """
+    Places files on a small thread pool. submit() returns straight away and wait() blocks until the file is in place, so a download worker can hand its
+    file off and the thread that consumes the results does the waiting
+    """
+    def __init__(self, max_workers: int = 2):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="soulripper-placer")
+        self._pending: dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, source_path: str, dest_path: str) -> str:
+        """
+        Returns:
+            str: dest_path, pass it to wait() before using the file
+        """
+        with self._lock:
+            self._pending[dest_path] = self._executor.submit(place_file, source_path, dest_path)
+        return dest_path
+
+    def is_pending(self, dest_path: str) -> bool:
+        with self._lock:
+            return dest_path in self._pending
+
+    def wait(self, dest_path: str | None) -> str | None:
+        """
+        Returns:
+            str|None: dest_path once the file is in place, None if placing it failed. Paths that weren't submitted are returned as is
+        """
+        with self._lock:
+            future = self._pending.get(dest_path)
+        if future is None:
+            return dest_path
+
+        try:
+            future.result()
+            return dest_path
+        except Exception as e:
+            print(f"Error moving the download to {dest_path}: {e}")
+            return None
+        finally:
+            with self._lock:
+                if self._pending.get(dest_path) is future:
+                    del self._pending[dest_path]
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
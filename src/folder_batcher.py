@@ -0,0 +1,143 @@
+# downloads several wanted tracks from the same peer folder with one enqueue
+#   - playlists often have a few tracks from the same album, and the peer we pick for one of them usually has the whole album in that folder
+#   - when a batch worker picks a candidate, it browses the candidate's folder and claims every other track in the batch that is still waiting for a worker
+#     and has a matching file there. all of the files are enqueued together so the claimed tracks skip their own search and peer handshake
+#   - a claimed track's worker just waits for the claim. if the claimed file fails the track goes back to pending and its worker searches for it like normal
+from dataclasses import dataclass, field
+import threading
+import time
+import re
+
+from peer_scheduler import AUDIO_EXTENSIONS, CANCEL_POLL_SECONDS, get_file_extension, get_quality_tier
+from search_queries import split_search_query
+
+# returned by FolderClaim.wait() when the claimed file failed and the track has to be searched for after all
+RETRY = object()
+
+@dataclass
+class FolderClaim:
+    search_query: str
+    username: str
+    file: dict
+    _done: threading.Event = field(default_factory=threading.Event)
+    _download_path: object = None
+
+    def is_resolved(self) -> bool:
+        return self._done.is_set()
+
+    def wait(self, timeout: float = None, cancel_event: threading.Event = None):
+        """
+        Args:
+            timeout (float): the maximum number of seconds to wait, None waits until the claim is resolved
+            cancel_event (threading.Event): when set the wait is given up
+
+        Returns:
+            str|RETRY: the path of the downloaded file, or RETRY if the download failed, the wait timed out or it was cancelled
+        """
+        if cancel_event is None:
+            self._done.wait(timeout)
+        else:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while not self._done.is_set() and not cancel_event.is_set():
+                if deadline is not None and time.monotonic() >= deadline:
+                    break
+                self._done.wait(CANCEL_POLL_SECONDS if deadline is None else min(max(deadline - time.monotonic(), 0), CANCEL_POLL_SECONDS))
+        return self._download_path if self._done.is_set() else RETRY
+
+def get_words(text: str) -> set[str]:
+    return set(re.findall(r"\w+", text.lower()))
+
+def get_folder(filename: str) -> str:
+    return filename.replace("/", "\\").rpartition("\\")[0]
+
+def find_matching_file(search_query: str, folder_files: list[dict]) -> dict | None:
+    """
+    Finds the file in a folder that is most likely the track for a search query: every word of the title has to be in the filename, and one of the
+    artists has to be in the full path (a lot of album folders are named "<artist> - <album>" and leave the artist out of the filenames)
+
+    Returns:
+        dict|None: the best quality matching file
+    """
+    title, artists = split_search_query(search_query)
+    title_words = get_words(title)
+    if len(title_words) == 0:
+        return None
+
+    matches = []
+    for file in folder_files:
+        if get_file_extension(file["filename"]) not in AUDIO_EXTENSIONS:
+            continue
+
+        filename_words = get_words(file["filename"].replace("/", "\\").rpartition("\\")[2])
+        path_words = get_words(file["filename"])
+        if title_words <= filename_words and (len(artists) == 0 or any(get_words(artist) <= path_words for artist in artists)):
+            matches.append(file)
+
+    if len(matches) == 0:
+        return None
+    return min(matches, key=lambda file: (get_quality_tier(file, get_file_extension(file["filename"])), -(file.get("size") or 0)))
+
+class FolderBatcher:
+    """
+    Keeps track of which tracks in a batch download are still waiting for a worker, so that a worker downloading from a folder can take them along
+    """
+    def __init__(self, search_queries: list[str]):
+        self._pending_queries = set(search_queries)
+        self._claims: dict[str, FolderClaim] = {}
+        self._lock = threading.Lock()
+
+    def begin(self, search_query: str) -> FolderClaim | None:
+        """
+        Called by a worker before it searches for a track
+
+        Returns:
+            FolderClaim|None: the claim to wait for if another worker is already downloading the track from a folder, otherwise None and the track is
+            no longer pending so nobody else will claim it
+        """
+        with self._lock:
+            claim = self._claims.get(search_query)
+            if claim is None:
+                self._pending_queries.discard(search_query)
+            return claim
+
+    def claim_folder(self, username: str, folder_files: list[dict], exclude_filename: str) -> list[FolderClaim]:
+        """
+        Claims every pending track that has a matching file in the folder
+
+        Args:
+            username (str): the peer that shares the folder
+            folder_files (list[dict]): the files in the folder, with full paths
+            exclude_filename (str): the file the calling worker is downloading for its own track
+
+        Returns:
+            list[FolderClaim]: the claimed tracks, the caller has to enqueue their files and resolve() every claim
+        """
+        folder_files = [file for file in folder_files if file["filename"] != exclude_filename]
+
+        with self._lock:
+            claims = []
+            for search_query in list(self._pending_queries):
+                matching_file = find_matching_file(search_query, folder_files)
+                if matching_file is None:
+                    continue
+
+                claim = FolderClaim(search_query, username, matching_file)
+                self._claims[search_query] = claim
+                self._pending_queries.discard(search_query)
+                folder_files.remove(matching_file)
+                claims.append(claim)
+
+            return claims
+
+    def resolve(self, claim: FolderClaim, download_path: str | None):
+        """
+        Finishes a claim, a failed download (None) puts the track back to pending so its worker searches for it
+        """
+        with self._lock:
+            # successful claims stay around for workers that haven't started yet, they get the path straight away from begin()
+            if download_path is None:
+                del self._claims[claim.search_query]
+                self._pending_queries.add(claim.search_query)
+
+        claim._download_path = download_path if download_path is not None else RETRY
+        claim._done.set()
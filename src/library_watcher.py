@@ -0,0 +1,319 @@
+# keeps the tracks table in sync with the music directory without rescanning it
+#   - on filesystems with event support (ext4, btrfs, etc) we subscribe to inotify events through watchdog
+#   - drvfs (windows drives in wsl), 9p, network, and fuse mounts don't deliver events for changes made outside of linux, so there we fall back to a
+#     periodic stamp scan that compares (mtime, size) snapshots of the directory tree
+#   - events are debounced and applied in batches so copying an album into the folder is one commit, not one per file
+from dataclasses import dataclass
+from typing import Callable
+import threading
+import time
+import os
+
+import souldb as SoulDB
+
+# TODO: these extensions should be configured with the config file, they match scan_music_library()
+AUDIO_EXTENSIONS = (".mp3", ".flac", ".wav")
+
+# filesystems where inotify doesn't see changes made by other machines/kernels
+NO_EVENT_FILESYSTEMS = {"drvfs", "9p", "v9fs", "nfs", "nfs4", "cifs", "smb3", "smbfs", "fuse", "fuseblk", "vboxsf", "virtiofs"}
+
+@dataclass
+class LibraryEvent:
+    kind: str            # "created", "deleted", or "moved"
+    path: str
+    dest_path: str = None
+    is_directory: bool = False
+
+def is_audio_file(path: str) -> bool:
+    return path.lower().endswith(AUDIO_EXTENSIONS)
+
+def get_filesystem_type(path: str) -> str | None:
+    """
+    Finds the filesystem type of the mount that contains path by looking for the longest matching mount point in /proc/mounts
+    """
+    path = os.path.realpath(path)
+    best_mount_point, best_fs_type = "", None
+
+    try:
+        with open("/proc/mounts", "r") as mounts:
+            for line in mounts:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount_point = fields[1].replace("\\040", " ")
+                if (path == mount_point or path.startswith(mount_point.rstrip("/") + "/")) and len(mount_point) > len(best_mount_point):
+                    best_mount_point, best_fs_type = mount_point, fields[2]
+    except OSError:
+        return None
+
+    return best_fs_type
+
+def take_stamp_snapshot(music_dir: str) -> dict[str, tuple[int, int]]:
+    """
+    Walks the music directory and records (mtime_ns, size) for every audio file. Comparing two snapshots is how the polling fallback finds changes
+
+    Returns:
+        dict[str, tuple[int, int]]: absolute filepath -> (mtime_ns, size)
+    """
+    snapshot = {}
+    directories = [os.path.abspath(music_dir)]
+
+    while len(directories) > 0:
+        try:
+            entries = os.scandir(directories.pop())
+        except OSError:
+            continue
+
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        directories.append(entry.path)
+                    elif is_audio_file(entry.name):
+                        stat = entry.stat()
+                        snapshot[entry.path] = (stat.st_mtime_ns, stat.st_size)
+                except OSError:
+                    continue
+
+    return snapshot
+
+def diff_stamp_snapshots(old_snapshot: dict, new_snapshot: dict) -> list[LibraryEvent]:
+    """
+    Turns the difference between two snapshots into events. A deleted and a created file with the same (mtime, size) stamp are treated as a move,
+    since that's what a rename looks like from the outside
+    """
+    deleted_paths = [path for path in old_snapshot if path not in new_snapshot]
+    created_paths = [path for path in new_snapshot if path not in old_snapshot]
+
+    created_by_stamp: dict[tuple, list[str]] = {}
+    for path in created_paths:
+        created_by_stamp.setdefault(new_snapshot[path], []).append(path)
+
+    events = []
+    moved_to = set()
+    for path in deleted_paths:
+        candidates = created_by_stamp.get(old_snapshot[path])
+        if candidates:
+            dest_path = candidates.pop()
+            moved_to.add(dest_path)
+            events.append(LibraryEvent("moved", path, dest_path))
+        else:
+            events.append(LibraryEvent("deleted", path))
+
+    events.extend(LibraryEvent("created", path) for path in created_paths if path not in moved_to)
+    return events
+
+class LibraryWatcher:
+    def __init__(self, music_dir: str, sessionmaker, extract_metadata: Callable[[str], SoulDB.TrackData], mode: str = "auto", debounce_seconds: float = 2.0, max_delay_seconds: float = 30.0, poll_interval: float = 60.0, batch_size: int = 500):
+        """
+        Args:
+            music_dir (str): the directory to watch, usually the output path
+            sessionmaker: sqlalchemy sessionmaker, the watcher uses its own session on its own thread
+            extract_metadata (Callable): reads a file's tags into a TrackData (main.extract_file_metadata)
+            mode (str): "events" for inotify, "poll" for the stamp scan, or "auto" to pick based on the filesystem
+            debounce_seconds (float): how long the directory has to be quiet before pending events are applied
+            max_delay_seconds (float): pending events are applied after this long even if events keep coming in
+            poll_interval (float): seconds between stamp scans in poll mode
+            batch_size (int): the maximum number of events per commit
+        """
+        self.music_dir = os.path.abspath(music_dir)
+        self.sessionmaker = sessionmaker
+        self.extract_metadata = extract_metadata
+        self.mode = self._resolve_mode(mode)
+        self.debounce_seconds = debounce_seconds
+        self.max_delay_seconds = max_delay_seconds
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+
+        self._pending_events: list[LibraryEvent] = []
+        self._first_pending_at: float = None
+        self._last_event_at: float = None
+        self._lock = threading.Lock()
+        self._wake_up = threading.Event()
+        self._stopped = threading.Event()
+        self._threads: list[threading.Thread] = []
+        self._observer = None
+
+    def _resolve_mode(self, mode: str) -> str:
+        if mode != "auto":
+            return mode
+
+        try:
+            import watchdog  # noqa: F401
+        except ImportError:
+            print("watchdog is not installed, the library watcher will poll for changes instead")
+            return "poll"
+
+        filesystem_type = get_filesystem_type(self.music_dir)
+        if filesystem_type in NO_EVENT_FILESYSTEMS:
+            print(f"{self.music_dir} is on a {filesystem_type} filesystem which doesn't support change events, the library watcher will poll for changes instead")
+            return "poll"
+
+        return "events"
+
+    def start(self):
+        print(f"Watching {self.music_dir} for changes ({self.mode} mode)")
+
+        if self.mode == "events":
+            self._start_observer()
+        else:
+            self._threads.append(threading.Thread(target=self._poll_loop, name="soulripper-library-poller", daemon=True))
+
+        self._threads.append(threading.Thread(target=self._apply_loop, name="soulripper-library-watcher", daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._wake_up.set()
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join(timeout=5)
+        for thread in self._threads:
+            thread.join(timeout=5)
+
+        # apply whatever was still waiting for the debounce
+        self.flush()
+
+    def _start_observer(self):
+        from watchdog.observers import Observer
+        from watchdog.events import FileSystemEventHandler
+
+        watcher = self
+
+        class LibraryEventHandler(FileSystemEventHandler):
+            def on_created(self, event):
+                watcher.record(LibraryEvent("created", event.src_path, is_directory=event.is_directory))
+
+            def on_closed(self, event):
+                # a file that was just written is "created" again when it's closed so that we read its tags once they're all there
+                if not event.is_directory:
+                    watcher.record(LibraryEvent("created", event.src_path))
+
+            def on_deleted(self, event):
+                watcher.record(LibraryEvent("deleted", event.src_path, is_directory=event.is_directory))
+
+            def on_moved(self, event):
+                watcher.record(LibraryEvent("moved", event.src_path, event.dest_path, is_directory=event.is_directory))
+
+        self._observer = Observer()
+        self._observer.schedule(LibraryEventHandler(), self.music_dir, recursive=True)
+        self._observer.start()
+
+    def _poll_loop(self):
+        snapshot = take_stamp_snapshot(self.music_dir)
+        while not self._stopped.wait(self.poll_interval):
+            new_snapshot = take_stamp_snapshot(self.music_dir)
+            for event in diff_stamp_snapshots(snapshot, new_snapshot):
+                self.record(event)
+            snapshot = new_snapshot
+
+    def record(self, event: LibraryEvent):
+        # directories matter for moves and deletes (everything inside moves with them) and creates (a folder moved in from outside shows up as one event)
+        if not event.is_directory and not (is_audio_file(event.path) or (event.dest_path and is_audio_file(event.dest_path))):
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            if len(self._pending_events) == 0:
+                self._first_pending_at = now
+            self._last_event_at = now
+            self._pending_events.append(event)
+        self._wake_up.set()
+
+    def _apply_loop(self):
+        while not self._stopped.is_set():
+            self._wake_up.wait(timeout=1.0)
+            self._wake_up.clear()
+
+            with self._lock:
+                if len(self._pending_events) == 0:
+                    continue
+                now = time.monotonic()
+                is_quiet = now - self._last_event_at >= self.debounce_seconds
+                is_overdue = now - self._first_pending_at >= self.max_delay_seconds
+
+            if is_quiet or is_overdue:
+                self.flush()
+            else:
+                # check again once the debounce window could have passed
+                self._stopped.wait(self.debounce_seconds)
+                self._wake_up.set()
+
+    def flush(self) -> int:
+        """
+        Applies every pending event to the database in order, committing every batch_size events
+
+        Returns:
+            int: the number of events applied
+        """
+        with self._lock:
+            events, self._pending_events = self._pending_events, []
+
+        if len(events) == 0:
+            return 0
+
+        # an event that fails (e.g. a file that was deleted again before we read its tags) is skipped, the next scan picks it up
+        with self.sessionmaker() as sql_session, SoulDB.UnitOfWork(sql_session, batch_size=self.batch_size) as unit_of_work:
+            for event in events:
+                with unit_of_work.item(f"{event.kind} {event.path}"):
+                    self._apply_event(sql_session, event)
+
+        num_applied = len(events) - unit_of_work.num_failed
+        print(f"Applied {num_applied} library change(s) from {self.music_dir}")
+        return num_applied
+
+    def _apply_event(self, sql_session, event: LibraryEvent):
+        match event.kind:
+            case "created" if event.is_directory:
+                for root, _, files in os.walk(event.path):
+                    for file in files:
+                        self._add_file(sql_session, os.path.join(root, file))
+            case "created":
+                self._add_file(sql_session, event.path)
+            case "deleted":
+                self._remove_path(sql_session, event.path, event.is_directory)
+            case "moved":
+                self._move_path(sql_session, event.path, event.dest_path, event.is_directory)
+
+    def _add_file(self, sql_session, filepath: str):
+        filepath = os.path.abspath(filepath)
+        if not is_audio_file(filepath) or not os.path.isfile(filepath):
+            return
+
+        if sql_session.query(SoulDB.Tracks.id).filter_by(filepath=filepath).first() is not None:
+            return
+
+        track_data = self.extract_metadata(filepath)
+        if track_data is None:
+            track_data = SoulDB.TrackData(filepath=filepath, comments="WARNING: Error while extracting metadata. This likely means the file is corrupted or empty")
+
+        SoulDB.Tracks.add_track(sql_session, track_data)
+
+    def _tracks_under(self, sql_session, path: str, is_directory: bool):
+        path = os.path.abspath(path)
+        if is_directory:
+            prefix = path.rstrip("/") + "/"
+            return sql_session.query(SoulDB.Tracks).filter(SoulDB.Tracks.filepath.startswith(prefix, autoescape=True)).all()
+        return sql_session.query(SoulDB.Tracks).filter_by(filepath=path).all()
+
+    def _remove_path(self, sql_session, path: str, is_directory: bool):
+        for track in self._tracks_under(sql_session, path, is_directory):
+            # tracks that came from spotify stay in the library (and their playlists), they just need to be downloaded again
+            if track.spotify_id is not None:
+                track.filepath = None
+            else:
+                sql_session.delete(track)
+        sql_session.flush()
+
+    def _move_path(self, sql_session, src_path: str, dest_path: str, is_directory: bool):
+        src_path, dest_path = os.path.abspath(src_path), os.path.abspath(dest_path)
+        moved_tracks = self._tracks_under(sql_session, src_path, is_directory)
+
+        for track in moved_tracks:
+            track.filepath = dest_path + track.filepath[len(src_path):] if is_directory else dest_path
+        sql_session.flush()
+
+        # a file moved in from somewhere we weren't tracking is new to us
+        if len(moved_tracks) == 0:
+            self._apply_event(sql_session, LibraryEvent("created", dest_path, is_directory=is_directory))
@@ -1,20 +1,33 @@
+from __future__ import annotations
 from sqlalchemy.orm import Session
+from functools import cached_property
+from types import SimpleNamespace
+from typing import Tuple, TYPE_CHECKING
 import sqlalchemy as sqla
-from spotify_client import SpotifyClient
-from typing import Tuple
 import subprocess
+import threading
+import tempfile
+import shutil
+import signal
+import socket
+import queue
 import time
 import re
 import os
 import json
 import yaml
 import argparse
-import mutagen
 import dotenv
-import time
 
-from slskd_utils import SlskdUtils
+from metrics import METRICS, instrument_session_factory
+from search_queries import build_search_query, normalize_search_query
 import souldb as SoulDB
+import track_repository
+
+# spotipy, slskd_api, and rich are slow to import so the modules that use them are only imported when a command actually needs them (see AppContext)
+if TYPE_CHECKING:
+    from spotify_client import SpotifyClient
+    from slskd_utils import SlskdUtils
 
 # TODO's (~ roughly in order of importance):
 #   - REFACTOR DOWNLOADING FUNCTIONS (in progress)
@@ -70,7 +83,6 @@ import souldb as SoulDB
 #   - error handling in download functions and probably other places
 #       - we can write error logging to the comment field of a track
 #           - we should prollt create a seperate column for this
-#   - virtualdj xml playlist integration (i already have code for this from a previous project i tihnk)
 #   - parallelize downloads
 #       - threading :D, i think slskd can also parallelize downloads, but it may be better to use threading, idk tho
 #   - the print statements in lower level functions should be changed to logging/debug statements
@@ -81,90 +93,505 @@ import souldb as SoulDB
 
 #   - this list is getting long as shit lmfao
 
-# TODO: we should clean up main - move some shit into helper functions, also still need to restructure this file </3
+DEFAULT_CONFIG_FILEPATH = "/home/soulripper/config.yaml"
+DEFAULT_DB_URL = "sqlite:///assets/soul.db"
+
 def main():
-    # collect commandline arguments
-    parser = argparse.ArgumentParser(description="")
-    parser.add_argument("pos_output_path", nargs="?", default=os.getcwd(), help="The output directory in which your files will be downloaded")
-    parser.add_argument("--output-path", type=str, dest="output_path", help="The output directory in which your files will be downloaded")
-    parser.add_argument("--search-query", type=str, dest="search_query", help="The output directory in which your files will be downloaded")
-    parser.add_argument("--playlist-url", type=str, dest="playlist_url", help="URL of Spotify playlist")
-    parser.add_argument("--download-liked", action="store_true", help="Will download the database with all your liked songs from Spotify")
-    parser.add_argument("--download-all-playlists", action="store_true", help="Will download the database with all your playlists from Spotify")
+    parser = build_arg_parser()
+    args = parser.parse_args()
+
+    if args.command is None:
+        parser.print_help()
+        return
+
+    # if a daemon is running it already has everything warmed up, so we hand the command to it instead of doing the work here
+    if not args.no_daemon and args.command in DAEMON_DELEGATED_COMMANDS:
+        from daemon import DaemonClient
+        daemon_client = DaemonClient(*load_daemon_config(args.config))
+        if daemon_client.is_running():
+            delegate_to_daemon(daemon_client, args)
+            return
+
+    context = AppContext(
+        config_filepath=args.config,
+        output_path=args.output_path,
+        debug=args.debug,
+        max_retries=args.max_retries,
+    )
+    args.handler(context, args)
+
+def build_arg_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Download your Spotify library from Soulseek and YouTube and keep it in a local database")
+    parser.add_argument("-o", "--output-path", type=str, dest="output_path", help="The output directory in which your files will be downloaded (defaults to output_path in config.yaml, then the current directory)")
+    parser.add_argument("--config", type=str, default=DEFAULT_CONFIG_FILEPATH, help="Path to the config.yaml file")
     parser.add_argument("--debug", action="store_true", help="Enable debug statements")
-    parser.add_argument("--drop-database", action="store_true", help="Drop the database before running the program")
     parser.add_argument("--max-retries", type=int, default=5, help="The maximum number of retries for downloading a track")
-    parser.add_argument("--add-track", type=str, help="Add a track to the database - provide the filepath")
-    parser.add_argument("--yt", action="store_true", help="Download exclusively from Youtube")
-    args = parser.parse_args()
-    OUTPUT_PATH = os.path.abspath(args.output_path or args.pos_output_path)
-    SEARCH_QUERY = args.search_query
-    SPOTIFY_PLAYLIST_URL = args.playlist_url
-    DOWNLOAD_LIKED = args.download_liked
-    DOWNLOAD_ALL_PLAYLISTS = args.download_all_playlists
-    DEBUG = args.debug
-    DROP_DATABASE = args.drop_database
-    # TODO: refactor code to use this value (i think its used in download_track only - will need to be passed down thru other functions tho - need to refactor this file for shared variables)
-    MAX_RETRIES = args.max_retries
-    NEW_TRACK_FILEPATH = args.add_track
-    YOUTUBE_ONLY = args.yt
-
-    CONFIG_FILEPATH = "/home/soulripper/config.yaml"
-    load_config_file(CONFIG_FILEPATH)
-
-    dotenv.load_dotenv()
-    os.makedirs(OUTPUT_PATH, exist_ok=True)
-
-    # connect to spotify API
-    spotify_client = SpotifyClient(config_filepath=CONFIG_FILEPATH)
-
-    # we communicate with slskd through port 5030, you can visit localhost:5030 to see the web front end. its at slskd:5030 in the docker container though
-    SLSKD_API_KEY = os.getenv("SLSKD_API_KEY")
-    slskd_client = SlskdUtils(SLSKD_API_KEY)
-
-    # create the engine with the local soul.db file and create a session
-    db_engine = sqla.create_engine("sqlite:///assets/soul.db", echo=DEBUG)
-    sessionmaker = sqla.orm.sessionmaker(bind=db_engine)
-    sql_session: Session = sessionmaker()
-
-    # if the flag was provided drop everything in the database
-    if DROP_DATABASE:
-        if not DEBUG:
-            input("Warning: This will drop all tables in the database. Press enter to continue...")
-
-        metadata = sqla.MetaData()
-        metadata.reflect(bind=db_engine)
-        metadata.drop_all(db_engine)
-
-    # initialize the tables defined in souldb.py
-    SoulDB.Base.metadata.create_all(db_engine)
-
-    # populate the database with metadata found from files in the users output directory
-    scan_music_library(sql_session, OUTPUT_PATH)
-
-    if NEW_TRACK_FILEPATH:
-        add_new_track_to_db(sql_session, NEW_TRACK_FILEPATH)
-
-    # if a search query is provided, download the track
-    if SEARCH_QUERY:
-        output_path = download_from_search_query(slskd_client, SEARCH_QUERY, OUTPUT_PATH, YOUTUBE_ONLY)
-        # TODO: get metadata and insert into database
+    parser.add_argument("--no-daemon", action="store_true", help="Run the command in this process even if a daemon is running")
+    parser.add_argument("--wait", action="store_true", help="When a daemon runs the command, wait for it to finish and print the result")
+    subparsers = parser.add_subparsers(dest="command", metavar="command")
+
+    download_parser = subparsers.add_parser("download", help="Download a single track from a search query")
+    download_parser.add_argument("search_query", type=str, help="The song to download, e.g. 'Luv (Sic) - Nujabes'")
+    download_parser.add_argument("--yt", action="store_true", help="Download exclusively from Youtube")
+    download_parser.set_defaults(handler=command_download)
+
+    liked_parser = subparsers.add_parser("liked", help="Add your liked songs from Spotify to the database and download the missing ones")
+    liked_parser.add_argument("--yt", action="store_true", help="Download exclusively from Youtube")
+    liked_parser.set_defaults(handler=command_liked)
+
+    playlists_parser = subparsers.add_parser("playlists", help="Add all of your playlists from Spotify to the database")
+    playlists_parser.set_defaults(handler=command_playlists)
+
+    playlist_parser = subparsers.add_parser("playlist", help="Download a Spotify playlist from its URL")
+    playlist_parser.add_argument("playlist_url", type=str, help="URL of Spotify playlist")
+    playlist_parser.set_defaults(handler=command_playlist)
+
+    add_track_parser = subparsers.add_parser("add-track", help="Add a track to the database")
+    add_track_parser.add_argument("filepath", type=str, help="The filepath of the track")
+    add_track_parser.set_defaults(handler=command_add_track)
+
+    scan_parser = subparsers.add_parser("scan", help="Add every audio file in the output directory to the database")
+    scan_parser.set_defaults(handler=command_scan)
+
+    search_parser = subparsers.add_parser("search", help="Search the database by title, album, or artist")
+    search_parser.add_argument("query", type=str, help="The search query, every word is matched as a prefix")
+    search_parser.add_argument("--limit", type=int, default=25, help="The maximum number of results")
+    search_parser.set_defaults(handler=command_search)
+
+    stats_parser = subparsers.add_parser("stats", help="Display some statistics about your library")
+    stats_parser.set_defaults(handler=command_stats)
+
+    analytics_parser = subparsers.add_parser("analytics", help="Display per year, artist over time, and playlist overlap statistics about your library")
+    analytics_parser.set_defaults(handler=command_analytics)
 
+    interactive_parser = subparsers.add_parser("interactive", help="Start the interactive menu")
+    interactive_parser.set_defaults(handler=command_interactive)
+
+    drop_parser = subparsers.add_parser("drop-database", help="Drop every table in the database")
+    drop_parser.set_defaults(handler=command_drop_database)
+
+    daemon_parser = subparsers.add_parser("daemon", help="Run as a long lived daemon that keeps the clients and database warm and serves a local api")
+    daemon_parser.set_defaults(handler=command_daemon)
+
+    watch_parser = subparsers.add_parser("watch", help="Keep the database in sync with changes to the output directory until stopped")
+    watch_parser.set_defaults(handler=command_watch)
+
+    pin_parser = subparsers.add_parser("pin", help="Download tracks before everything else that is missing")
+    pin_parser.add_argument("track_ids", type=int, nargs="+", help="The ids of the tracks, as shown by the search command")
+    pin_parser.add_argument("--priority", type=int, default=1, help="Tracks with a higher priority are downloaded first, 0 unpins")
+    pin_parser.set_defaults(handler=command_pin)
+
+    retry_parser = subparsers.add_parser("retry", help="Let the workers try tracks again that failed to download, including the ones that failed too often")
+    retry_parser.add_argument("--playlist-id", type=int, help="Only retry tracks in this playlist")
+    retry_parser.set_defaults(handler=command_retry)
+
+    enrich_parser = subparsers.add_parser("enrich", help="Look up genres, duration, and isrc on Spotify for the tracks and artists that don't have them yet")
+    enrich_parser.set_defaults(handler=command_enrich)
+
+    pending_parser = subparsers.add_parser("pending", help="List the tracks that are still missing a file in the order they will be downloaded")
+    pending_parser.add_argument("--playlist-id", type=int, help="Only list tracks in this playlist")
+    pending_parser.add_argument("--limit", type=int, default=50, help="Maximum number of tracks to list, 0 lists all of them")
+    pending_parser.set_defaults(handler=command_pending)
+
+    analyze_parser = subparsers.add_parser("analyze", help="Estimate the bpm and key of downloaded tracks that don't have them yet")
+    analyze_parser.add_argument("--workers", type=int, help="Number of analysis processes (defaults to analysis.workers in config.yaml, then the number of cpus)")
+    analyze_parser.add_argument("--force", action="store_true", help="Also analyze tracks that already have a bpm and key, cached results are still reused")
+    analyze_parser.set_defaults(handler=command_analyze)
+
+    export_m3u_parser = subparsers.add_parser("export-m3u", help="Write every playlist as an .m3u8 file, only changed playlists are rewritten")
+    export_m3u_parser.add_argument("output_dir", type=str, nargs="?", help="The folder to write to (defaults to playlist_export.output_path in config.yaml)")
+    export_m3u_parser.set_defaults(handler=command_export_m3u)
+
+    vdj_import_parser = subparsers.add_parser("vdj-import", help="Copy key and bpm from a VirtualDJ database.xml to the matching tracks")
+    vdj_import_parser.add_argument("database_filepath", type=str, help="Path to VirtualDJ's database.xml")
+    vdj_import_parser.add_argument("--path-map", action="append", help="Map a VirtualDJ path prefix to a local one, e.g. 'D:\\=/mnt/d/', can be given more than once")
+    vdj_import_parser.set_defaults(handler=command_vdj_import)
+
+    vdj_export_parser = subparsers.add_parser("vdj-export", help="Write playlists as VirtualDJ .vdjfolder files")
+    vdj_export_parser.add_argument("output_dir", type=str, help="The folder to write to, e.g. VirtualDJ's Playlists folder")
+    vdj_export_parser.add_argument("--playlist", action="append", help="Only export the playlist with this name, can be given more than once")
+    vdj_export_parser.add_argument("--path-map", action="append", help="Map a VirtualDJ path prefix to a local one, e.g. 'D:\\=/mnt/d/', can be given more than once")
+    vdj_export_parser.set_defaults(handler=command_vdj_export)
+
+    worker_parser = subparsers.add_parser("worker", help="Keep downloading tracks that are missing a file, several workers can share a postgres database")
+    worker_parser.add_argument("--yt", action="store_true", help="Download exclusively from Youtube")
+    worker_parser.add_argument("--once", action="store_true", help="Exit once there are no tracks left to claim instead of waiting for new ones")
+    worker_parser.set_defaults(handler=command_worker)
+
+    return parser
+
+# ===========================================
+#            application context
+# ===========================================
+
+class AppContext:
+    """
+    Holds everything a command might need, each piece is built the first time a command uses it. This way local commands like search never log in to
+    Spotify, connect to slskd, or scan the library
+    """
+    def __init__(self, config_filepath: str = DEFAULT_CONFIG_FILEPATH, output_path: str = None, debug: bool = False, max_retries: int = 5, db_url: str = None):
+        self.config_filepath = config_filepath
+        self.debug = debug
+        self.max_retries = max_retries
+        self._library_scanned = False
+
+        # SOULRIPPER_DB_URL lets docker compose point every container at the same postgres database without editing the config file
+        dotenv.load_dotenv()
+        self.database_config = load_config_section(config_filepath, "database")
+        self.db_url = db_url or os.getenv("SOULRIPPER_DB_URL") or self.database_config.get("url") or DEFAULT_DB_URL
+        # how many downloads/scanned files are written per commit, see SoulDB.UnitOfWork
+        SoulDB.UnitOfWork.configure(self.database_config.get("commit_batch_size"), self.database_config.get("commit_batch_seconds"))
+
+        # TODO: refactor code to use max_retries (i think its used in download_track only - will need to be passed down thru other functions tho)
+        config_output_path, _, self.youtube_only, log_enabled, log_filepath, metrics_filepath = load_config_file(config_filepath)
+        self._output_path = output_path or config_output_path or os.getcwd()
+
+        # seconds to give soulseek before racing it against youtube, None never races
+        self.hedge_delay = load_config_section(config_filepath, "download_behavior").get("hedge_delay")
+        # the order missing tracks are downloaded in, see SoulDB.DOWNLOAD_PRIORITIES
+        self.download_priorities = tuple(load_config_section(config_filepath, "download_behavior").get("priority") or SoulDB.DOWNLOAD_PRIORITIES)
+
+        # when logging is enabled every timed stage is appended to the log file as a json line and the counters/histograms are written to the metrics file on exit
+        METRICS.configure(log_enabled, log_filepath, metrics_filepath)
+
+    @cached_property
+    def output_path(self) -> str:
+        output_path = os.path.abspath(os.path.expanduser(self._output_path))
+        os.makedirs(output_path, exist_ok=True)
+        return output_path
+
+    @cached_property
+    def spotify_client(self) -> SpotifyClient:
+        # connect to spotify API
+        from spotify_client import SpotifyClient
+        return SpotifyClient(config_filepath=self.config_filepath)
+
+    @cached_property
+    def slskd_client(self) -> SlskdUtils:
+        # we communicate with slskd through port 5030, you can visit localhost:5030 to see the web front end. its at slskd:5030 in the docker container though
+        from slskd_utils import SlskdUtils
+        from peer_scheduler import PeerReputation
+        from dashboard import DASHBOARD
+        download_config = load_config_section(self.config_filepath, "download_behavior")
+        DASHBOARD.configure(download_config.get("dashboard_refresh_rate"), download_config.get("dashboard_log_interval"))
+        return SlskdUtils(
+            os.getenv("SLSKD_API_KEY"),
+            max_concurrent_downloads=download_config.get("max_concurrent_downloads", 1),
+            max_transfers_per_peer=download_config.get("max_transfers_per_peer", 1),
+            # the download threads record peer stats with their own sessions, separate from the main one
+            peer_reputation=PeerReputation(sqla.orm.sessionmaker(bind=self.db_engine)),
+            batch_folder_downloads=download_config.get("batch_folder_downloads", True),
+        )
+
+    @cached_property
+    def db_engine(self) -> sqla.Engine:
+        # create the engine with the local soul.db file (or the configured database) and initialize the tables defined in souldb.py
+        db_engine = self.create_db_engine()
+        SoulDB.init_db(db_engine)
+        return db_engine
+
+    def create_db_engine(self) -> sqla.Engine:
+        return SoulDB.create_db_engine(
+            self.db_url,
+            echo=self.debug,
+            pool_size=self.database_config.get("pool_size", 5),
+            max_overflow=self.database_config.get("max_overflow", 10),
+        )
+
+    @cached_property
+    def sql_session(self) -> Session:
+        sessionmaker = sqla.orm.sessionmaker(bind=self.db_engine)
+        instrument_session_factory(sessionmaker)
+        return sessionmaker()
+
+    def get_scanned_session(self) -> Session:
+        """
+        Returns the session after populating the database with the files in the output directory, the scan only happens once per run
+        """
+        if not self._library_scanned:
+            scan_music_library(self.sql_session, self.output_path)
+            self._library_scanned = True
+        return self.sql_session
+
+# ===========================================
+#                 commands
+# ===========================================
+
+def command_download(context: AppContext, args):
+    slskd_client = None if args.yt else context.slskd_client
+    download_from_search_query(slskd_client, args.search_query, context.output_path, args.yt, context.hedge_delay)
+    # TODO: get metadata and insert into database
+
+def command_liked(context: AppContext, args):
+    slskd_client = None if args.yt else context.slskd_client
+    download_liked_songs(slskd_client, context.spotify_client, context.get_scanned_session(), context.output_path, args.yt, context.hedge_delay, context.download_priorities)
+    run_post_sync_stages(context)
+
+def command_playlists(context: AppContext, args):
     # get all playlists from spotify and add them to the database
-    if DOWNLOAD_ALL_PLAYLISTS:
-        all_playlists_metadata = spotify_client.get_all_playlists()
-        for playlist_metadata in all_playlists_metadata:
-            update_db_with_spotify_playlist(sql_session, spotify_client, playlist_metadata)
-
-    # if the update liked flag is provided, download all liked songs from spotify
-    if DOWNLOAD_LIKED:
-        download_liked_songs(slskd_client, spotify_client, sql_session, OUTPUT_PATH, YOUTUBE_ONLY)
-    
-    # if a playlist url is provided, download the playlist
-    if SPOTIFY_PLAYLIST_URL:
-        # TODO: refactor this function
-        # download_playlist(slskd_client, spotify_client, sql_session, SPOTIFY_PLAYLIST_URL, OUTPUT_PATH)
+    all_playlists_metadata = context.spotify_client.get_all_playlists()
+    for playlist_metadata in all_playlists_metadata:
+        update_db_with_spotify_playlist(context.sql_session, context.spotify_client, playlist_metadata)
+    run_post_sync_stages(context)
+
+def command_export_m3u(context: AppContext, args):
+    output_dir = args.output_dir or load_config_section(context.config_filepath, "playlist_export").get("output_path")
+    if output_dir is None:
+        print("No output folder given and playlist_export.output_path isn't set in the config file")
+        return
+
+    import playlist_export
+    playlist_export.export_playlists(context.sql_session, os.path.expanduser(output_dir))
+
+def command_pin(context: AppContext, args):
+    num_pinned = context.sql_session.query(SoulDB.Tracks).filter(SoulDB.Tracks.id.in_(args.track_ids)).update({"download_priority": args.priority})
+    context.sql_session.commit()
+    print(f"Set the download priority of {num_pinned} tracks to {args.priority}")
+
+def command_retry(context: AppContext, args):
+    num_released = SoulDB.release_failed_downloads(context.sql_session, args.playlist_id, reset_attempts=True)
+    print(f"{num_released} failed tracks will be downloaded again")
+
+def command_enrich(context: AppContext, args):
+    import spotify_enrichment
+    spotify_enrichment.enrich_library(context.sql_session, context.spotify_client)
+
+def command_pending(context: AppContext, args):
+    num_listed = 0
+    for track_id, track_data in track_repository.iter_pending_track_data(context.sql_session, args.playlist_id, context.download_priorities):
+        if args.limit and num_listed >= args.limit:
+            break
+        print(f"{track_id}: {build_track_search_query(track_data)}")
+        num_listed += 1
+
+    if num_listed == 0:
+        print("No tracks are waiting to be downloaded")
+
+def command_analyze(context: AppContext, args):
+    analysis_config = load_config_section(context.config_filepath, "analysis")
+    import audio_analysis
+    audio_analysis.analyze_library(
+        context.get_scanned_session(),
+        max_workers=args.workers or analysis_config.get("workers"),
+        max_seconds=analysis_config.get("max_seconds", audio_analysis.DEFAULT_MAX_SECONDS),
+        force=args.force,
+    )
+
+def run_post_sync_stages(context: AppContext):
+    # spotify details, bpm/key analysis of the new files, and the .m3u8 copies. they all skip whatever hasn't changed so they are cheap to run after every sync
+    if load_config_section(context.config_filepath, "enrichment").get("after_sync", True):
+        import spotify_enrichment
+        spotify_enrichment.enrich_library(context.sql_session, context.spotify_client)
+
+    analysis_config = load_config_section(context.config_filepath, "analysis")
+    if analysis_config.get("after_sync", False):
+        import audio_analysis
+        audio_analysis.analyze_library(
+            context.sql_session,
+            max_workers=analysis_config.get("workers"),
+            max_seconds=analysis_config.get("max_seconds", audio_analysis.DEFAULT_MAX_SECONDS),
+        )
+
+    output_dir = load_config_section(context.config_filepath, "playlist_export").get("output_path")
+    if output_dir is not None:
+        import playlist_export
+        playlist_export.export_playlists(context.sql_session, os.path.expanduser(output_dir))
+
+def command_playlist(context: AppContext, args):
+    # TODO: refactor this function
+    # download_playlist(context.slskd_client, context.spotify_client, context.get_scanned_session(), args.playlist_url, context.output_path)
+    print("Downloading a single playlist is not implemented yet")
+
+def command_add_track(context: AppContext, args):
+    add_new_track_to_db(context.sql_session, args.filepath)
+
+def command_scan(context: AppContext, args):
+    context.get_scanned_session()
+
+def command_search(context: AppContext, args):
+    results = search_for_track(context.sql_session, args.query, args.limit)
+    if len(results) == 0:
+        print("No matching tracks found...")
+        return
+
+    for track in results:
+        print_track(track)
+
+def command_stats(context: AppContext, args):
+    for query_function in LIBRARY_STATS_QUERIES:
+        query_function(context.sql_session)
+
+def command_analytics(context: AppContext, args):
+    pprint(get_library_analytics(context.sql_session))
+
+def command_vdj_import(context: AppContext, args):
+    import virtualdj
+    virtualdj.import_database(context.sql_session, args.database_filepath, virtualdj.parse_path_map(args.path_map))
+
+def command_vdj_export(context: AppContext, args):
+    import virtualdj
+    virtualdj.export_playlists(context.sql_session, args.output_dir, args.playlist, virtualdj.parse_path_map(args.path_map))
+
+def command_interactive(context: AppContext, args):
+    execute_user_interaction(context)
+
+def command_daemon(context: AppContext, args):
+    from daemon import SoulRipperDaemon
+    host, port = load_daemon_config(context.config_filepath)
+    soulripper_daemon = SoulRipperDaemon(context, DAEMON_JOB_HANDLERS, DAEMON_QUERY_HANDLERS, host, port)
+
+    # the daemon keeps the database in sync with manual changes to the music folder while it runs
+    library_watcher = None
+    if load_config_section(context.config_filepath, "watcher").get("enabled", True):
+        context.get_scanned_session()
+        library_watcher = create_library_watcher(context)
+        library_watcher.start()
+
+    try:
+        soulripper_daemon.serve_forever()
+    finally:
+        if library_watcher is not None:
+            library_watcher.stop()
+
+def command_watch(context: AppContext, args):
+    # start from an up to date database, after this only the changes are applied
+    context.get_scanned_session()
+    library_watcher = create_library_watcher(context)
+    library_watcher.start()
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
         pass
+    finally:
+        library_watcher.stop()
+
+def create_library_watcher(context: AppContext):
+    from library_watcher import LibraryWatcher
+
+    watcher_config = load_config_section(context.config_filepath, "watcher")
+    return LibraryWatcher(
+        context.output_path,
+        sqla.orm.sessionmaker(bind=context.db_engine),
+        extract_file_metadata,
+        mode=watcher_config.get("mode", "auto"),
+        debounce_seconds=watcher_config.get("debounce_seconds", 2),
+        poll_interval=watcher_config.get("poll_interval", 60),
+    )
+
+def command_drop_database(context: AppContext, args):
+    if not context.debug:
+        input("Warning: This will drop all tables in the database. Press enter to continue...")
+
+    # this uses its own engine since context.db_engine would create all the tables first
+    db_engine = context.create_db_engine()
+    metadata = sqla.MetaData()
+    metadata.reflect(bind=db_engine)
+    metadata.drop_all(db_engine)
+
+def command_worker(context: AppContext, args):
+    worker_config = load_config_section(context.config_filepath, "worker")
+    slskd_client = None if args.yt else context.slskd_client
+    worker_id = get_worker_id()
+    print(f"Worker {worker_id} is downloading from {context.db_engine.url.render_as_string(hide_password=True)}")
+
+    try:
+        while True:
+            num_downloaded = download_pending_tracks(
+                slskd_client,
+                context.sql_session,
+                context.output_path,
+                args.yt,
+                context.hedge_delay,
+                worker_id=worker_id,
+                batch_size=worker_config.get("batch_size", 50),
+                lease_seconds=worker_config.get("lease_seconds", SoulDB.CLAIM_LEASE_SECONDS),
+                max_attempts=worker_config.get("max_attempts", SoulDB.MAX_DOWNLOAD_ATTEMPTS),
+                priorities=context.download_priorities,
+            )
+            print(f"Downloaded {num_downloaded} tracks, no more tracks to claim")
+            if args.once:
+                break
+            time.sleep(worker_config.get("poll_interval", 60))
+    except KeyboardInterrupt:
+        pass
+
+def get_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+# ===========================================
+#               daemon commands
+# ===========================================
+
+# jobs write to the database so the daemon runs them one at a time on its worker thread with the shared session - handler(context, params)
+DAEMON_JOB_HANDLERS = {
+    "download": lambda context, params: download_from_search_query(
+        None if params.get("youtube_only") else context.slskd_client, params["search_query"], context.output_path, params.get("youtube_only", False), context.hedge_delay
+    ),
+    "liked": lambda context, params: run_liked_job(context, params.get("youtube_only", False)),
+    "playlists": lambda context, params: command_playlists(context, None),
+    "scan": lambda context, params: scan_music_library(context.sql_session, context.output_path),
+}
+
+def run_liked_job(context: AppContext, youtube_only: bool):
+    download_liked_songs(None if youtube_only else context.slskd_client, context.spotify_client, context.sql_session, context.output_path, youtube_only, context.hedge_delay, context.download_priorities)
+    run_post_sync_stages(context)
+
+# queries are read only so the daemon runs them on the http threads with their own session - handler(sql_session, params)
+DAEMON_QUERY_HANDLERS = {
+    "search": lambda sql_session, params: [track_to_dict(track) for track in search_for_track(sql_session, params["query"], int(params.get("limit", 25)))],
+    "stats": lambda sql_session, params: {
+        query_function.__name__: rows_to_lists(query_function(sql_session))
+        for query_function in LIBRARY_STATS_QUERIES
+    },
+    "analytics": lambda sql_session, params: get_library_analytics(sql_session),
+}
+
+DAEMON_DELEGATED_COMMANDS = ("download", "liked", "playlists", "scan", "search", "stats", "analytics")
+
+def rows_to_lists(result) -> list:
+    # the stats queries return either a single row (fetchone) or a list of rows (fetchall)
+    if isinstance(result, sqla.Row):
+        return list(result)
+    return [list(row) for row in result]
+
+def load_daemon_config(config_filepath: str) -> Tuple[str, int]:
+    from daemon import DEFAULT_DAEMON_HOST, DEFAULT_DAEMON_PORT
+
+    daemon_config = load_config_section(config_filepath, "daemon")
+    return (daemon_config.get("host", DEFAULT_DAEMON_HOST), daemon_config.get("port", DEFAULT_DAEMON_PORT))
+
+def delegate_to_daemon(daemon_client, args):
+    match args.command:
+        case "search":
+            results = daemon_client.query("search", {"query": args.query, "limit": args.limit})
+            if len(results) == 0:
+                print("No matching tracks found...")
+            for track in results:
+                print_track(SimpleNamespace(**track))
+            return
+
+        case "stats":
+            for query_name, rows in daemon_client.query("stats", {}).items():
+                print(f"{query_name}: {rows}")
+            return
+
+        case "analytics":
+            pprint(daemon_client.query("analytics", {}))
+            return
+
+        case "download":
+            job = daemon_client.submit_job("download", {"search_query": args.search_query, "youtube_only": args.yt})
+        case "liked":
+            job = daemon_client.submit_job("liked", {"youtube_only": args.yt})
+        case _:
+            job = daemon_client.submit_job(args.command, {})
+
+    print(f"Queued job {job['id']} ({job['kind']}) on the running daemon")
+    if args.wait:
+        job = daemon_client.wait_for_job(job["id"])
+        print(f"Job {job['id']} {job['state']}: {job['error'] or job['result']}")
 
 # ===========================================
 #          main database functions
@@ -182,19 +609,21 @@ def scan_music_library(sql_session, music_dir: str):
     """
     print(f"Scanning music library at {music_dir}...")
 
-    for root, dirs, files in os.walk(music_dir):
-        for file in files:
-            # TODO: these extensions should be configured with the config file (still need to implement config file </3)
-            if file.endswith(".mp3") or file.endswith(".flac") or file.endswith(".wav"):
-                filepath = os.path.abspath(os.path.join(root, file))
-                existing_track = SoulDB.get_existing_track(sql_session, SoulDB.TrackData(filepath=filepath))
-                if existing_track is None:
-                    add_new_track_to_db(sql_session, filepath)
-                else:
-                    print(f"track with filepath: {filepath} already found in database, skipping")
-    sql_session.commit()
-
-def add_new_track_to_db(sql_session, filepath: str):
+    # one commit per batch of files instead of one per file, a file that fails to import is skipped without losing the rest of its batch
+    with SoulDB.UnitOfWork(sql_session) as unit_of_work:
+        for root, dirs, files in os.walk(music_dir):
+            for file in files:
+                # TODO: these extensions should be configured with the config file (still need to implement config file </3)
+                if file.endswith(".mp3") or file.endswith(".flac") or file.endswith(".wav"):
+                    filepath = os.path.abspath(os.path.join(root, file))
+                    existing_track = SoulDB.get_existing_track(sql_session, SoulDB.TrackData(filepath=filepath))
+                    if existing_track is None:
+                        with unit_of_work.item(filepath):
+                            add_new_track_to_db(sql_session, filepath, commit=False)
+                    else:
+                        print(f"track with filepath: {filepath} already found in database, skipping")
+
+def add_new_track_to_db(sql_session, filepath: str, commit: bool = True):
     if not os.path.exists(filepath):
         print(f"File {filepath} does not exist, skipping...")
         return
@@ -210,13 +639,14 @@ def add_new_track_to_db(sql_session, filepath: str):
     existing_track = SoulDB.get_existing_track(sql_session, file_track_data)
     if existing_track is None:
         SoulDB.Tracks.add_track(sql_session, file_track_data)
-        sql_session.commit()
+        if commit:
+            sql_session.commit()
 
 def update_db_with_spotify_playlist(sql_session, spotify_client, playlist_metadata):
     print(f"Updating database with tracks from playlist {playlist_metadata['name']}...")
 
-    playlist_tracks = spotify_client.get_playlist_tracks(playlist_metadata['id'])
-    relevant_tracks_data: list[SoulDB.TrackData] = spotify_client.get_data_from_playlist(playlist_tracks)
+    # the raw json pages are converted as they arrive so we only ever keep the compact TrackData
+    relevant_tracks_data: list[SoulDB.TrackData] = spotify_client.get_track_data_from_playlist(spotify_client.iter_playlist_tracks(playlist_metadata['id']))
 
     # create and flush the playlist since we need its id for the playlist_tracks association table
     playlist_row = sql_session.query(SoulDB.Playlists).filter_by(spotify_id=playlist_metadata['id']).first()
@@ -232,8 +662,7 @@ def update_db_with_spotify_playlist(sql_session, spotify_client, playlist_metada
 
 # TODO: this function takes a while to run, we should find a way to check if there any changes before calling it
 def update_db_with_spotify_liked_tracks(spotify_client: SpotifyClient, sql_session):
-    liked_tracks_data = spotify_client.get_liked_tracks()
-    relevant_tracks_data: list[SoulDB.TrackData] = spotify_client.get_track_data_from_playlist(liked_tracks_data)
+    relevant_tracks_data: list[SoulDB.TrackData] = spotify_client.get_track_data_from_playlist(spotify_client.iter_liked_tracks())
 
     liked_playlist = sql_session.query(SoulDB.Playlists).filter_by(name="SPOTIFY_LIKED_SONGS").first()
     if liked_playlist is None:
@@ -297,38 +726,93 @@ def add_track_data_to_playlist(sql_session, track_data_list: list[SoulDB.TrackDa
 #             downloading functions
 # ===========================================
 
-def download_liked_songs(slskd_client: SlskdUtils, spotify_client: SpotifyClient, sql_session: Session, output_path: str, youtube_only: bool):
+def download_liked_songs(
+    slskd_client: SlskdUtils,
+    spotify_client: SpotifyClient,
+    sql_session: Session,
+    output_path: str,
+    youtube_only: bool,
+    hedge_delay: float = None,
+    priorities: tuple[str, ...] = SoulDB.DOWNLOAD_PRIORITIES,
+):
     # TODO: this function takes a while to run, we should find a way to check if there any changes before calling it
     # add the users liked songs to the database
     liked_playlist = update_db_with_spotify_liked_tracks(spotify_client, sql_session)
 
     if liked_playlist is None:
         raise Exception("Error in update_db_with_spotify_liked_tracks(), the playlist row was not returned")
-    
-    liked_playlist_tracks_rows = sql_session.query(SoulDB.PlaylistTracks).filter_by(playlist_id=liked_playlist.id).all()
 
-    try:
-        # TODO: maybe we should be using the download_track function with a TrackData instead of the search query, hard to get TrackData though since also need to get artists
-        #    - we should write a get_trackdata classmethod that will do all this for us
-        for playlist_track_row in liked_playlist_tracks_rows:
-            track_id = playlist_track_row.track_id
-            track_row = sql_session.query(SoulDB.Tracks).filter_by(id=track_id).one()
+    # a local sync tries every liked song that is still missing like it always has, the lease and attempt cap are for workers sharing a database.
+    # tracks that fail during this run keep their claimed_at, so they aren't tried twice in the same run
+    SoulDB.release_failed_downloads(sql_session, playlist_id=liked_playlist.id)
+    download_pending_tracks(slskd_client, sql_session, output_path, youtube_only, hedge_delay, playlist_id=liked_playlist.id, max_attempts=None, priorities=priorities)
+
+def download_pending_tracks(
+    slskd_client: SlskdUtils,
+    sql_session: Session,
+    output_path: str,
+    youtube_only: bool,
+    hedge_delay: float = None,
+    playlist_id: int = None,
+    worker_id: str = None,
+    batch_size: int = 50,
+    lease_seconds: float = SoulDB.CLAIM_LEASE_SECONDS,
+    max_attempts: int = SoulDB.MAX_DOWNLOAD_ATTEMPTS,
+    priorities: tuple[str, ...] = SoulDB.DOWNLOAD_PRIORITIES,
+) -> int:
+    """
+    Downloads tracks that don't have a file yet until there are none left to claim. The tracks are claimed a batch at a time (see SoulDB.claim_pending_tracks)
+    so any number of workers on any number of hosts can share a postgres database without downloading the same track twice
 
-            if track_row.filepath is None:
-                track_artists_rows = sql_session.query(SoulDB.TrackArtist).filter_by(track_id=track_id).all()
-                artist_rows = [sql_session.query(SoulDB.Artists).filter_by(id=track_artists_row.artist_id).one() for track_artists_row in track_artists_rows]
-                track_artists = ", ".join([artist_row.name for artist_row in artist_rows])
+    Args:
+        playlist_id (int): only download tracks in this playlist, None downloads every pending track
+        worker_id (str): the name the claims are recorded under, defaults to get_worker_id()
+        batch_size (int): the number of tracks claimed at once, they are downloaded together like download_many_from_search_queries() does
+        lease_seconds (float): see SoulDB.CLAIM_LEASE_SECONDS
+        max_attempts (int): tracks that failed this many times are skipped, None tries them anyway
+        priorities (tuple[str]): which tracks are downloaded first, see SoulDB.DOWNLOAD_PRIORITIES
 
-                search_query = f"{track_row.title} - {track_artists}"
+    Returns:
+        int: the number of tracks that were downloaded
+    """
+    worker_id = worker_id or get_worker_id()
+    num_downloaded = 0
 
-                filepath = download_from_search_query(slskd_client, search_query, output_path, youtube_only)
-                track_row.filepath = filepath
-                sql_session.commit()
+    while True:
+        claimed_tracks = SoulDB.claim_pending_tracks(sql_session, worker_id, batch_size, playlist_id, lease_seconds, max_attempts, priorities)
+        if len(claimed_tracks) == 0:
+            return num_downloaded
+
+        # the artists were loaded with the claim, tracks that end up with the same query are downloaded once
+        track_rows_by_query: dict[str, list[SoulDB.Tracks]] = {}
+        for track_row in claimed_tracks:
+            search_query = build_track_search_query(track_repository.to_track_data(track_row))
+            track_rows_by_query.setdefault(search_query, []).append(track_row)
+
+        try:
+            # the soulseek downloads run on slskd_client's thread pool, the results come back here so the session is only ever used from this thread.
+            # the results are committed in batches, whatever finished before a crash or ctrl+c is still committed when the unit of work exits
+            with SoulDB.UnitOfWork(sql_session) as unit_of_work:
+                for search_query, filepath in download_many_from_search_queries(slskd_client, list(track_rows_by_query), output_path, youtube_only, hedge_delay):
+                    for track_row in track_rows_by_query.pop(search_query, []):
+                        with unit_of_work.item(search_query):
+                            track_row.finish_download(filepath)
+                            num_downloaded += 1 if filepath else 0
+        except BaseException:
+            # give the rest of the batch back straight away instead of making it wait out the lease
+            sql_session.rollback()
+            for track_rows in track_rows_by_query.values():
+                for track_row in track_rows:
+                    track_row.claimed_by = None
+                    track_row.claimed_at = None
+            sql_session.commit()
+            raise
+
+        for track_rows in track_rows_by_query.values():
+            for track_row in track_rows:
+                track_row.finish_download(None)
+        sql_session.commit()
 
-    except Exception as e:
-        sql_session.rollback()
-        raise e
-    
 # TODO: bruhhhhhhhhhhh the spotify api current_user_saved_tracks() function doesn't return local files FUCK SPOTIFYU there has to be a workaround
 def download_liked_tracks_from_spotify_data(slskd_client: SlskdUtils, spotify_client: SpotifyClient, sql_session, output_path: str):
     liked_tracks_data = spotify_client.get_liked_tracks()
@@ -387,19 +871,23 @@ def download_playlist_from_spotify_url(slskd_client: SlskdUtils, spotify_client:
         SoulDB.Playlists.add_playlist(sql_session, playlist_id, playlist_info["name"], playlist_info["description"], track_rows_and_data)
 
 # TODO: this is where better search will happen - construct query from trackdata
+def build_track_search_query(track: SoulDB.TrackData) -> str:
+    return build_search_query(track.title, [name for name, _ in track.artists or ()])
+
 def download_track(slskd_client: SlskdUtils, track: SoulDB.TrackData, output_path: str) -> str:
-    search_query = f"{track.title} - {', '.join([artist[0] for artist in track.artists])}"
+    search_query = build_track_search_query(track)
     download_path = download_from_search_query(slskd_client, search_query, output_path)
     return download_path
 
 # TODO: need to embed metadata into the file after it downloads
-def download_track_ytdlp(search_query: str, output_path: str) -> str :
+def download_track_ytdlp(search_query: str, output_path: str, cancel_event: threading.Event = None) -> str :
     """
     Downloads a track from youtube using yt-dlp
     
     Args:
         search_query (str): the query to search for
         output_path (str): the directory to download the song to
+        cancel_event (threading.Event): when set yt-dlp (and the ffmpeg it started) is killed and "" is returned, partial files are left for the caller to clean up
 
     Returns:
         str: the path to the downloaded song
@@ -411,41 +899,200 @@ def download_track_ytdlp(search_query: str, output_path: str) -> str :
 
     print(f"Downloading from yt-dlp: {search_query}")
 
-    # download the file using yt-dlp and necessary flags
-    process = subprocess.Popen([
-        "yt-dlp",
-        search_query,
-        # TODO: this should be better
-        # "--cookies-from-browser", "firefox:~/snap/firefox/common/.mozilla/firefox/fpmcru3a.default",
-        "--cookies", "assets/cookies.txt",
-        "-x", "--audio-format", "mp3",
-        "--embed-thumbnail", "--add-metadata",
-        "--paths", output_path,
-        "-o", "%(title)s.%(ext)s"
-    ], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-
-    # print and append the output of yt-dlp to the log file
-    for line in iter(process.stdout.readline, ''):
-        print(line, end='')
-        ytdlp_output += line
-
-    process.stdout.close()
-    process.wait()
-
-    # this extracts the filepath of the new file from the yt-dlp output, TODO: theres prolly a better way to do this
-    file_path_pattern = r'\[EmbedThumbnail\] ffmpeg: Adding thumbnail to "([^"]+)"'
-    match = re.search(file_path_pattern, ytdlp_output)
-    download_path = match.group(1) if match else ""
+    with METRICS.span("ytdlp_download", query=search_query) as ytdlp_span:
+        # download the file using yt-dlp and necessary flags
+        process = subprocess.Popen([
+            "yt-dlp",
+            search_query,
+            # TODO: this should be better
+            # "--cookies-from-browser", "firefox:~/snap/firefox/common/.mozilla/firefox/fpmcru3a.default",
+            "--cookies", "assets/cookies.txt",
+            "-x", "--audio-format", "mp3",
+            "--embed-thumbnail", "--add-metadata",
+            "--paths", output_path,
+            "-o", "%(title)s.%(ext)s"
+        ], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, start_new_session=cancel_event is not None)
+
+        # yt-dlp gets its own process group when it can be cancelled, so killing the group also stops the ffmpeg it spawns
+        if cancel_event is not None:
+            threading.Thread(target=_terminate_on_cancel, args=(process, cancel_event), daemon=True).start()
+
+        # print and append the output of yt-dlp to the log file
+        for line in iter(process.stdout.readline, ''):
+            print(line, end='')
+            ytdlp_output += line
+
+        process.stdout.close()
+        process.wait()
+
+        # this extracts the filepath of the new file from the yt-dlp output, TODO: theres prolly a better way to do this
+        file_path_pattern = r'\[EmbedThumbnail\] ffmpeg: Adding thumbnail to "([^"]+)"'
+        match = re.search(file_path_pattern, ytdlp_output)
+        download_path = match.group(1) if match else ""
+
+        ytdlp_span["return_code"] = process.returncode
+        if cancel_event is not None and cancel_event.is_set():
+            ytdlp_span["outcome"] = "cancelled"
+            download_path = ""
+        elif download_path == "":
+            ytdlp_span["outcome"] = "failed"
 
     return download_path
 
-def download_from_search_query(slskd_client: SlskdUtils, search_query: str, output_path: str, youtube_only: bool) -> str:
+def _terminate_on_cancel(process: subprocess.Popen, cancel_event: threading.Event):
+    while process.poll() is None:
+        if cancel_event.wait(timeout=0.5):
+            try:
+                os.killpg(process.pid, signal.SIGTERM)
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            return
+
+def download_many_from_search_queries(slskd_client: SlskdUtils, search_queries: list[str], output_path: str, youtube_only: bool, hedge_delay: float = None):
+    """
+    Downloads several tracks, the soulseek downloads run concurrently (see SlskdUtils.download_tracks) and anything soulseek couldn't find falls back to youtube.
+    With a hedge_delay each track is raced against youtube instead, see download_hedged(). Equivalent queries (see normalize_search_query) are only downloaded once
+
+    Yields:
+        tuple[str, str]: each search query and the path to its downloaded file, in the order they finish
+    """
+    equivalent_queries: dict[str, list[str]] = {}
+    for search_query in search_queries:
+        equivalent_queries.setdefault(normalize_search_query(search_query), []).append(search_query)
+    unique_queries = [queries[0] for queries in equivalent_queries.values()]
+
+    for search_query, download_path in _download_unique_queries(slskd_client, unique_queries, output_path, youtube_only, hedge_delay):
+        for equivalent_query in equivalent_queries[normalize_search_query(search_query)]:
+            yield equivalent_query, download_path
+
+def _download_unique_queries(slskd_client: SlskdUtils, search_queries: list[str], output_path: str, youtube_only: bool, hedge_delay: float = None):
+    if youtube_only:
+        for search_query in search_queries:
+            yield search_query, download_track_ytdlp(search_query, output_path)
+        return
+
+    if hedge_delay is not None:
+        hedged_download_function = lambda search_query, output_path, *args, **kwargs: download_hedged(slskd_client, search_query, output_path, hedge_delay, *args, **kwargs)
+        yield from slskd_client.download_tracks(search_queries, output_path, download_function=hedged_download_function)
+        return
+
+    for search_query, download_path in slskd_client.download_tracks(search_queries, output_path):
+        if download_path is None:
+            download_path = download_track_ytdlp(search_query, output_path)
+        yield search_query, download_path
+
+def download_hedged(slskd_client: SlskdUtils, search_query: str, output_path: str, hedge_delay: float, *soulseek_args, **soulseek_kwargs) -> str:
+    """
+    Downloads a track from soulseek, but if the soulseek transfer hasn't started receiving bytes after hedge_delay seconds a youtube download is started
+    alongside it. Whichever finishes first with a file wins and the other one is cancelled, so a track never waits the full inactive download timeout
+
+    Args:
+        slskd_client (SlskdUtils): the slskd client
+        search_query (str): the song to download
+        output_path (str): the directory to download the song to
+        hedge_delay (float): seconds to wait for the soulseek transfer to start before racing it against youtube
+        *soulseek_args, **soulseek_kwargs: passed through to SlskdUtils.download_track()
+
+    Returns:
+        str: the path to the downloaded file, or "" if both sources failed
+    """
+    soulseek_started, cancel_soulseek, cancel_youtube = threading.Event(), threading.Event(), threading.Event()
+    results: queue.Queue[tuple[str, str]] = queue.Queue()
+
+    def run_soulseek():
+        try:
+            download_path = slskd_client.download_track(search_query, output_path, *soulseek_args, started_event=soulseek_started, cancel_event=cancel_soulseek, **soulseek_kwargs)
+        except Exception as e:
+            print(f"Error downloading from Soulseek: {e}")
+            download_path = None
+        results.put(("soulseek", download_path))
+
+    # yt-dlp writes into its own temp folder so a cancelled download's partial files can be deleted without touching the library
+    youtube_dir = tempfile.mkdtemp(prefix=".soulripper-ytdlp-", dir=output_path)
+
+    def run_youtube():
+        try:
+            download_path = download_track_ytdlp(search_query, youtube_dir, cancel_youtube)
+        except Exception as e:
+            print(f"Error downloading from YouTube: {e}")
+            download_path = ""
+        results.put(("youtube", download_path))
+
+    with METRICS.span("hedged_download", query=search_query, hedge_delay=hedge_delay) as hedge_span:
+        soulseek_thread = threading.Thread(target=run_soulseek, name="soulripper-hedge-soulseek", daemon=True)
+        youtube_thread = threading.Thread(target=run_youtube, name="soulripper-hedge-youtube", daemon=True)
+        soulseek_thread.start()
+
+        # give soulseek hedge_delay seconds to start transferring, a soulseek failure before or after that goes straight to youtube like the normal fallback
+        deadline = time.monotonic() + hedge_delay
+        pending_sources = {"soulseek"}
+        youtube_started = False
+        winner, download_path = None, ""
+        while winner is None:
+            soulseek_stalled = "soulseek" in pending_sources and not soulseek_started.is_set() and time.monotonic() >= deadline
+            if not youtube_started and (soulseek_stalled or "soulseek" not in pending_sources):
+                if soulseek_stalled:
+                    print(f"Soulseek hasn't started downloading {search_query} after {hedge_delay}s, racing it against YouTube")
+                youtube_thread.start()
+                youtube_started = True
+                pending_sources.add("youtube")
+
+            if len(pending_sources) == 0:
+                break
+
+            try:
+                source, source_path = results.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            pending_sources.discard(source)
+            if source_path:
+                winner, download_path = source, source_path
+
+        # cancel whichever source lost, the winner is returned right away and the loser cleans up after itself in the background
+        cancel_soulseek.set()
+        cancel_youtube.set()
+        if winner == "youtube":
+            final_path = os.path.join(output_path, os.path.basename(download_path))
+            shutil.move(download_path, final_path)
+            download_path = final_path
+
+        def clean_up_loser():
+            if youtube_thread.is_alive():
+                youtube_thread.join()
+            shutil.rmtree(youtube_dir, ignore_errors=True)
+
+            # a soulseek transfer can finish just as youtube wins, its file would be an untracked duplicate of the track in the library
+            if soulseek_thread.is_alive():
+                soulseek_thread.join()
+            while not results.empty():
+                source, source_path = results.get_nowait()
+                if source == "soulseek" and source_path and source_path != download_path:
+                    source_path = slskd_client.placer.wait(source_path)
+                    if source_path is not None and os.path.exists(source_path):
+                        print(f"Removing the Soulseek download that lost to YouTube: {source_path}")
+                        os.remove(source_path)
+
+        # not a daemon thread, so the process doesn't exit before the losing files are deleted
+        threading.Thread(target=clean_up_loser, name="soulripper-hedge-cleanup").start()
+
+        hedge_span["winner"] = winner
+        hedge_span["hedged"] = youtube_started
+        if winner is None:
+            hedge_span["outcome"] = "failed"
+
+    return download_path or ""
+
+def download_from_search_query(slskd_client: SlskdUtils, search_query: str, output_path: str, youtube_only: bool, hedge_delay: float = None) -> str:
     """
     Downloads a track from soulseek or youtube, only downloading from youtube if the query is not found on soulseek
 
     Args:
         search_query (str): the song to download, can be a search query
         output_path (str): the directory to download the song to
+        hedge_delay (float): when set, youtube is started in parallel if soulseek hasn't started transferring after this many seconds (see download_hedged())
 
     Returns:
         str: the path to the downloaded file
@@ -453,6 +1100,9 @@ def download_from_search_query(slskd_client: SlskdUtils, search_query: str, outp
     if youtube_only:
         return download_track_ytdlp(search_query, output_path)
 
+    if hedge_delay is not None:
+        return download_hedged(slskd_client, search_query, output_path, hedge_delay)
+
     download_path = slskd_client.download_track(search_query, output_path)
 
     if download_path is None:
@@ -471,7 +1121,7 @@ def save_json(data, filename="debug/debug.json"):
     with open(f"debug/{filename}", "w") as file:
         json.dump(data, file)
 
-def load_config_file(config_filepath: str) -> Tuple[str, int, bool, bool, str]:
+def load_config_file(config_filepath: str) -> Tuple[str, int, bool, bool, str, str]:
     with open(config_filepath, "r") as file:
         config = yaml.safe_load(file)
 
@@ -483,15 +1133,27 @@ def load_config_file(config_filepath: str) -> Tuple[str, int, bool, bool, str]:
     YOUTUBE_ONLY = config["download_behavior"]["youtube_only"]
     LOG_ENABLED = config["debug"]["log"]
     LOG_FILEPATH = config["debug"]["log_filepath"]
+    METRICS_FILEPATH = config["debug"].get("metrics_filepath")
 
     return (
         OUTPUT_PATH, 
         MAX_RETRIES, 
         YOUTUBE_ONLY, 
         LOG_ENABLED,
-        LOG_FILEPATH
+        LOG_FILEPATH,
+        METRICS_FILEPATH
     )
 
+def load_config_section(config_filepath: str, section: str) -> dict:
+    """
+    Reads one optional section of the config file, missing files and sections are treated as empty so callers can fall back to defaults
+    """
+    try:
+        with open(config_filepath, "r") as file:
+            return (yaml.safe_load(file) or {}).get(section) or {}
+    except FileNotFoundError:
+        return {}
+
 # TODO: look at metadata to see what else we can extract - it's different for each file :( - need to find file with great metadata as example
 def extract_file_metadata(filepath: str) -> SoulDB.TrackData:
     """
@@ -504,6 +1166,9 @@ def extract_file_metadata(filepath: str) -> SoulDB.TrackData:
         dict: a dictionary of metadata
     """
 
+    # mutagen is only needed when we actually read files so it isn't imported at startup
+    import mutagen
+
     try:
         file_metadata = mutagen.File(filepath)
     except Exception as e:
@@ -596,17 +1261,15 @@ def get_tracks_by_album(sql_session, album_name):
     print(f"Found {len(result)} tracks in album {album_name}")
     return result
 
-# Grouping & aggregation
+# Grouping & aggregation - reads the artist_stats summary table which is maintained by triggers (see souldb.create_library_stats)
 def get_favorite_artists(sql_session):
     stmt = sqla.text("""
     SELECT
         a.name AS artist,
-        COUNT(*) AS count
-    FROM artists a
-    JOIN track_artists ta ON a.id = ta.artist_id
-    JOIN tracks t ON ta.track_id = t.id
-    GROUP BY a.name
-    ORDER BY count DESC
+        s.track_count AS count
+    FROM artist_stats s
+    JOIN artists a ON a.id = s.artist_id
+    ORDER BY s.track_count DESC
     LIMIT 10;
     """)
 
@@ -648,17 +1311,16 @@ def get_num_unique_albums(sql_session):
     print(f"Number of unique albums: {result[0]}")
     return result
 
-# Grouping & aggregation
+# Grouping & aggregation - reads the track_stats summary table
 def get_favorite_tracks(sql_session):
     query = """
     SELECT
         t.title,
-        COUNT(pt.playlist_id) AS num_playlists
-    FROM tracks t
-    LEFT JOIN playlist_tracks pt
-    ON t.id = pt.track_id
-    GROUP BY t.id, t.title
-    ORDER BY num_playlists DESC
+        s.playlist_count AS num_playlists
+    FROM track_stats s
+    JOIN tracks t
+    ON t.id = s.track_id
+    ORDER BY s.playlist_count DESC
     LIMIT 10;
     """
 
@@ -666,96 +1328,111 @@ def get_favorite_tracks(sql_session):
     print(f"Top 10 favorite tracks: {[result[0] for result in result]}")
     return result
 
-# Subquery
+# Aggregation - the library_stats counters give us the average without touching playlist_tracks
 def get_average_tracks_per_playlist(sql_session):
     query = """
-    SELECT AVG(sub.track_count) AS avg_tracks_per_playlist
-        FROM (
-            SELECT COUNT(*) AS track_count
-            FROM playlist_tracks
-            GROUP BY playlist_id
-        ) AS sub;
+    SELECT
+        CAST(playlist_track_count AS REAL) / NULLIF(nonempty_playlist_count, 0) AS avg_tracks_per_playlist
+    FROM library_stats
+    WHERE id = 1;
     """
 
     result = sql_session.execute(sqla.text(query)).fetchone()
     print(f"Average number of tracks per playlist: {result[0]}")
     return result
 
-# CTE 
+# Subquery - the average is a constant subquery over library_stats so this is just a range scan of the playlist_stats index
 def get_playlists_with_above_avg_track_count(sql_session):
     stmt = sqla.text("""
-    WITH playlist_counts AS (
-        SELECT
-            playlist_id,
-            COUNT(track_id) AS cnt
-        FROM playlist_tracks
-        GROUP BY playlist_id
-    ), average_count AS (
-        SELECT AVG(cnt) AS avg_cnt
-        FROM playlist_counts
-    )
     SELECT
         p.name AS playlist_name,
-        pc.cnt AS track_count
-    FROM playlist_counts pc
+        s.track_count AS track_count
+    FROM playlist_stats s
     JOIN playlists p
-    ON p.id = pc.playlist_id
-    CROSS JOIN average_count av
-    WHERE pc.cnt > av.avg_cnt
-    ORDER BY pc.cnt DESC;
+    ON p.id = s.playlist_id
+    WHERE s.track_count > (
+        SELECT CAST(playlist_track_count AS REAL) / NULLIF(nonempty_playlist_count, 0)
+        FROM library_stats
+        WHERE id = 1
+    )
+    ORDER BY s.track_count DESC;
     """)
 
     result = sql_session.execute(stmt).fetchall()
     print(f"Playlists with above-average track count: {[row.playlist_name for row in result]}")
     return result
 
-# Window function
+# Top n per group - artist_track_stats is indexed by (artist_id, playlist_count) and maintained by triggers (see souldb.create_library_stats), so each
+# artist's top 3 are the last 3 entries of its index range instead of a window over the whole track_artists/tracks join. the CROSS JOIN keeps sqlite
+# from reordering the joins, so it loops over the artists and runs the LIMIT 3 subquery once per artist instead of once per artist_track_stats row
 def get_top_3_tracks_per_artist(sql_session):
-    start_time = time.perf_counter()
     stmt = sqla.text("""
-    SELECT 
-        artist_name,
-        track_title,
-        num_playlists
-    FROM (
-        SELECT
-            a.name AS artist_name,
-            t.title AS track_title,
-            COUNT(pt.playlist_id) AS num_playlists,
-            ROW_NUMBER() OVER (
-                PARTITION BY a.id
-                ORDER BY COUNT(pt.playlist_id) DESC
-            ) AS rn
-        FROM artists a
-        JOIN track_artists ta ON a.id = ta.artist_id
-        JOIN tracks t ON ta.track_id = t.id
-        LEFT JOIN playlist_tracks pt ON t.id = pt.track_id
-        GROUP BY a.id, t.id
-    ) sub
-    WHERE rn <= 3
+    SELECT
+        a.name AS artist_name,
+        t.title AS track_title,
+        s.playlist_count AS num_playlists
+    FROM artists a
+    CROSS JOIN artist_track_stats s
+    JOIN tracks t ON t.id = s.track_id
+    WHERE s.artist_id = a.id AND s.track_id IN (
+        SELECT ranked.track_id
+        FROM artist_track_stats ranked
+        WHERE ranked.artist_id = a.id
+        ORDER BY ranked.playlist_count DESC
+        LIMIT 3
+    )
     ORDER BY artist_name, num_playlists DESC;
     """)
     
     rows = sql_session.execute(stmt).fetchall()
 
-# WHERE rn <= 3
     # Print each row as (artist, track, count)
     for artist, track, count in rows:
         if None not in (artist, track, count):
             print(f"{artist or '<Unknown Artist>':40} | {track:75} | in {count} playlists")
-    end_time = time.perf_counter()
-    execution_time = end_time - start_time
-    print("Seconds: ", execution_time)
     
     return rows
 
+def get_library_analytics(sql_session) -> dict:
+    """
+    Computes the statistics of the analytics command from the numpy arrays in analytics.py. The arrays are cached until the library changes, so in the
+    daemon only the first request reads the tables
+    """
+    import analytics
+    arrays = analytics.LIBRARY_ANALYTICS.get_arrays(sql_session)
+    artist_names, years, artist_year_counts = analytics.get_artist_tracks_per_year(arrays)
+
+    return {
+        "favorite_artists": analytics.get_favorite_artists(arrays),
+        "favorite_tracks": analytics.get_favorite_tracks(arrays),
+        "average_tracks_per_playlist": analytics.get_average_tracks_per_playlist(arrays),
+        "tracks_per_year": analytics.get_tracks_per_year(arrays),
+        "favorite_artists_tracks_per_year": {
+            artist_name: {year: int(count) for year, count in zip(years, counts) if count > 0}
+            for artist_name, counts in zip(artist_names, artist_year_counts)
+        },
+        "most_similar_playlists": analytics.get_most_similar_playlists(arrays),
+    }
+
+# the queries shown by the stats command, these are all cheap since they read the summary tables or a single column
+LIBRARY_STATS_QUERIES = (
+    get_missing_tracks,
+    get_num_unique_tracks,
+    get_num_unique_artists,
+    get_num_unique_albums,
+    get_favorite_artists,
+    get_favorite_tracks,
+    get_average_tracks_per_playlist,
+    get_playlists_with_above_avg_track_count,
+)
+
 # ===========================================
 #             user interaction
 # ===========================================
 
 # TODO: we need to figure out how user interaction will look lol
 
-def execute_user_interaction(sql_session, db_engine, spotify_client):
+def execute_user_interaction(context: AppContext):
         # this code is trash dw its okay :)
     prompt = """\n\nWelcome to SoulRipper, please select one of the following options:
 
@@ -772,6 +1449,8 @@ def execute_user_interaction(sql_session, db_engine, spotify_client):
 
 Enter your choice here: """
 
+    sql_session = context.sql_session
+
     while True:
         choice = input(prompt)
 
@@ -779,24 +1458,24 @@ Enter your choice here: """
             case "1":
                 sql_session.commit()
                 
-                all_playlists_metadata = spotify_client.get_all_playlists()
+                all_playlists_metadata = context.spotify_client.get_all_playlists()
                 for playlist_metadata in all_playlists_metadata:
-                    update_db_with_spotify_playlist(sql_session, spotify_client, playlist_metadata)
-                update_db_with_spotify_liked_tracks(spotify_client, sql_session)
+                    update_db_with_spotify_playlist(sql_session, context.spotify_client, playlist_metadata)
+                update_db_with_spotify_liked_tracks(context.spotify_client, sql_session)
                 sql_session.flush()
                 sql_session.commit()
                 continue
 
             case "2":
-                all_playlists_metadata = spotify_client.get_all_playlists()
+                all_playlists_metadata = context.spotify_client.get_all_playlists()
                 for playlist_metadata in all_playlists_metadata:
-                    update_db_with_spotify_playlist(sql_session, spotify_client, playlist_metadata)
+                    update_db_with_spotify_playlist(sql_session, context.spotify_client, playlist_metadata)
                 sql_session.flush()
                 sql_session.commit()
                 continue
 
             case "3":
-                update_db_with_spotify_liked_tracks(spotify_client, sql_session)
+                update_db_with_spotify_liked_tracks(context.spotify_client, sql_session)
                 sql_session.flush()
                 sql_session.commit()
                 continue
@@ -848,23 +1527,15 @@ Enter your choice here: """
                 continue
             
             case "7":
-                title = input("Enter the title of the track you'd like to search for: ")
-                results = search_for_track(sql_session, title)
+                query = input("Enter the title, album, or artist of the track you'd like to search for: ")
+                results = search_for_track(sql_session, query)
 
                 if results == []:
                     print("No matching tracks found...")
                     continue
 
                 for track in results:
-                    print(f"ID: {track.id}")
-                    print(f"Title: {track.title}")
-                    print(f"Filepath: {track.filepath}")
-                    print(f"Album: {track.album}")
-                    print(f"Release Date: {track.release_date}")
-                    print(f"Explicit: {track.explicit}")
-                    print(f"Date Liked: {track.date_liked_spotify}")
-                    print(f"Comments: {track.comments}")
-                    print("-" * 40)
+                    print_track(track)
 
                 continue
             
@@ -877,8 +1548,8 @@ Enter your choice here: """
                 if confirmation == "yes":
                     sql_session.close()
                     metadata = sqla.MetaData()
-                    metadata.reflect(bind=db_engine)
-                    metadata.drop_all(db_engine)
+                    metadata.reflect(bind=context.db_engine)
+                    metadata.drop_all(context.db_engine)
                     print("Database dropped successfully. Closing the program.")
                     return
                 else:
@@ -892,12 +1563,44 @@ Enter your choice here: """
                 print("Invalid input, try again")
                 continue
 
-def search_for_track(sql_session, track_title):
-    results = sql_session.query(SoulDB.Tracks).filter(
-        SoulDB.Tracks.title.ilike(f"%{track_title}%")
-    ).all()
+def search_for_track(sql_session, query: str, limit: int = 25) -> list[SoulDB.Tracks]:
+    """
+    Searches the library by title, album, and artist using the full-text search index
 
-    return results
+    Args:
+        query (str): the search query, each word is matched as a prefix
+        limit (int): the maximum number of results to return
+
+    Returns:
+        list[SoulDB.Tracks]: the matching tracks ordered by relevance
+    """
+    return SoulDB.search_tracks(sql_session, query, limit)
+
+def print_track(track: SoulDB.Tracks):
+    print(f"ID: {track.id}")
+    print(f"Title: {track.title}")
+    print(f"Filepath: {track.filepath}")
+    print(f"Album: {track.album}")
+    print(f"Release Date: {track.release_date}")
+    print(f"Explicit: {track.explicit}")
+    print(f"Date Liked: {track.date_liked_spotify}")
+    print(f"Comments: {track.comments}")
+    print("-" * 40)
+
+def track_to_dict(track: SoulDB.Tracks) -> dict:
+    return {
+        "id": track.id,
+        "spotify_id": track.spotify_id,
+        "title": track.title,
+        "filepath": track.filepath,
+        "album": track.album,
+        "release_date": track.release_date,
+        "explicit": track.explicit,
+        "date_liked_spotify": track.date_liked_spotify,
+        "comments": track.comments,
+        "duration_ms": track.duration_ms,
+        "isrc": track.isrc,
+    }
 
 def modify_track(sql_session, track_id, new_track_data: SoulDB.TrackData):
     existing_track = sql_session.query(SoulDB.Tracks).filter_by(id=track_id).one()
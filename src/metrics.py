@@ -0,0 +1,219 @@
+# instrumentation for finding out where the time goes in a sync
+#   - spans time a stage (spotify fetch, slskd search, enqueue, transfer, file move, yt-dlp, db flush/commit) and write one json line per span
+#   - counters and histograms are kept in memory and written out in the prometheus text format when the program exits
+#   - everything is recorded even when exporting is disabled, it's just dicts and a lock so it's basically free
+from contextlib import contextmanager
+import threading
+import bisect
+import atexit
+import json
+import time
+import os
+
+# histogram bucket upper bounds, prometheus adds the +Inf bucket for us
+STAGE_DURATION_BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800]
+SEARCH_LATENCY_BUCKETS = [0.5, 1, 2, 5, 10, 15, 20, 30, 45, 60, 120]
+TRANSFER_THROUGHPUT_BUCKETS = [10e3, 50e3, 100e3, 250e3, 500e3, 1e6, 2e6, 5e6, 10e6, 25e6, 50e6, 100e6]
+
+class Histogram:
+    def __init__(self, buckets: list[float]):
+        self.buckets = sorted(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+    def __init__(self):
+        self.enabled = False
+        self.jsonl_filepath = None
+        self.prometheus_filepath = None
+        self._jsonl_file = None
+        self._lock = threading.Lock()
+        self._counters: dict[tuple, float] = {}
+        self._histograms: dict[tuple, Histogram] = {}
+        self._histogram_buckets: dict[str, list[float]] = {
+            "soulripper_stage_duration_seconds": STAGE_DURATION_BUCKETS,
+            "soulripper_slskd_search_latency_seconds": SEARCH_LATENCY_BUCKETS,
+            "soulripper_transfer_throughput_bytes_per_second": TRANSFER_THROUGHPUT_BUCKETS,
+        }
+
+    def configure(self, enabled: bool, jsonl_filepath: str = None, prometheus_filepath: str = None):
+        """
+        Turns exporting on or off
+
+        Args:
+            enabled (bool): whether to write the span log and prometheus file
+            jsonl_filepath (str): the file each finished span is appended to as a json line
+            prometheus_filepath (str): the file the counters and histograms are written to on exit
+        """
+        self.close()
+        self.enabled = enabled
+        self.jsonl_filepath = jsonl_filepath
+        self.prometheus_filepath = prometheus_filepath
+
+        if enabled and jsonl_filepath:
+            os.makedirs(os.path.dirname(os.path.abspath(jsonl_filepath)), exist_ok=True)
+            self._jsonl_file = open(jsonl_filepath, "a", buffering=1)
+
+    def increment(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self._histogram_buckets.get(name, STAGE_DURATION_BUCKETS))
+            histogram.observe(value)
+
+    def event(self, name: str, **attributes):
+        """
+        Writes a single json line to the span log, use this for things that aren't timed like a download giving up
+        """
+        self._write_json_line({"ts": time.time(), "type": "event", "name": name, **attributes})
+
+    @contextmanager
+    def span(self, stage: str, **attributes):
+        """
+        Times the code inside the with block as one run of a stage. The duration goes into the stage duration histogram and a json line with the attributes is written to the span log
+
+        Args:
+            stage (str): the stage name, e.g. "slskd_search" - this is the only prometheus label so keep it low cardinality
+            **attributes: extra details for the span log, e.g. the search query. The yielded dict can be used to add more while the span is running
+
+        Example:
+            with METRICS.span("slskd_search", query=search_query) as span:
+                ...
+                span["num_results"] = len(results)
+        """
+        span_attributes = dict(attributes)
+        outcome = "ok"
+        start_time = time.perf_counter()
+        start_timestamp = time.time()
+
+        try:
+            yield span_attributes
+        except BaseException as e:
+            outcome = "error"
+            span_attributes["error"] = repr(e)
+            raise
+        finally:
+            outcome = span_attributes.pop("outcome", outcome)
+            self.record_span(stage, time.perf_counter() - start_time, outcome, start_timestamp, **span_attributes)
+
+    def record_span(self, stage: str, duration: float, outcome: str = "ok", start_timestamp: float = None, **attributes):
+        """
+        Records a stage run that was timed somewhere else, span() uses this under the hood
+        """
+        self.observe("soulripper_stage_duration_seconds", duration, stage=stage)
+        self.increment("soulripper_stage_total", stage=stage, outcome=outcome)
+        self._write_json_line({
+            "ts": start_timestamp if start_timestamp is not None else time.time() - duration,
+            "type": "span",
+            "name": stage,
+            "duration_s": round(duration, 6),
+            "outcome": outcome,
+            **attributes,
+        })
+
+    def _write_json_line(self, record: dict):
+        if self._jsonl_file is None:
+            return
+
+        line = json.dumps(record, default=str)
+        with self._lock:
+            self._jsonl_file.write(line + "\n")
+
+    def render_prometheus(self) -> str:
+        """
+        Renders every counter and histogram in the prometheus text exposition format
+        """
+        def format_labels(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if len(pairs) == 0:
+                return ""
+            return "{" + ",".join(f'{key}="{_escape_label_value(value)}"' for key, value in pairs) + "}"
+
+        lines = []
+        with self._lock:
+            for name in sorted({name for name, _ in self._counters}):
+                lines.append(f"# TYPE {name} counter")
+                for (counter_name, labels), value in sorted(self._counters.items()):
+                    if counter_name == name:
+                        lines.append(f"{name}{format_labels(labels)} {value}")
+
+            for name in sorted({name for name, _ in self._histograms}):
+                lines.append(f"# TYPE {name} histogram")
+                for (histogram_name, labels), histogram in sorted(self._histograms.items(), key=lambda item: item[0]):
+                    if histogram_name != name:
+                        continue
+                    cumulative = 0
+                    for upper_bound, count in zip(histogram.buckets + [float("inf")], histogram.counts):
+                        cumulative += count
+                        le = "+Inf" if upper_bound == float("inf") else f"{upper_bound:g}"
+                        lines.append(f"{name}_bucket{format_labels(labels, [('le', le)])} {cumulative}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum}")
+                    lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self):
+        if not self.enabled or self.prometheus_filepath is None:
+            return
+
+        # write to a temp file and rename so a scraper never reads a half written file
+        os.makedirs(os.path.dirname(os.path.abspath(self.prometheus_filepath)), exist_ok=True)
+        temp_filepath = f"{self.prometheus_filepath}.tmp"
+        with open(temp_filepath, "w") as file:
+            file.write(self.render_prometheus())
+        os.replace(temp_filepath, self.prometheus_filepath)
+
+    def close(self):
+        self.write_prometheus()
+        if self._jsonl_file is not None:
+            self._jsonl_file.close()
+            self._jsonl_file = None
+
+def _escape_label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def instrument_session_factory(sessionmaker):
+    """
+    Times every flush and commit made by sessions from this sessionmaker as the db_flush and db_commit stages
+
+    Args:
+        sessionmaker: the sqlalchemy sessionmaker
+    """
+    import sqlalchemy as sqla
+
+    @sqla.event.listens_for(sessionmaker, "before_flush")
+    def before_flush(session, flush_context, instances):
+        session.info["flush_started_at"] = time.perf_counter()
+        session.info["flush_num_new"] = len(session.new)
+
+    @sqla.event.listens_for(sessionmaker, "after_flush_postexec")
+    def after_flush(session, flush_context):
+        started_at = session.info.pop("flush_started_at", None)
+        if started_at is not None:
+            METRICS.record_span("db_flush", time.perf_counter() - started_at, num_new=session.info.pop("flush_num_new", None))
+
+    @sqla.event.listens_for(sessionmaker, "before_commit")
+    def before_commit(session):
+        session.info["commit_started_at"] = time.perf_counter()
+
+    @sqla.event.listens_for(sessionmaker, "after_commit")
+    def after_commit(session):
+        started_at = session.info.pop("commit_started_at", None)
+        if started_at is not None:
+            METRICS.record_span("db_commit", time.perf_counter() - started_at)
+
+# the whole program shares this one instance
+METRICS = Metrics()
+atexit.register(METRICS.close)
@@ -0,0 +1,228 @@
+# picks which soulseek peer to download each file from
+#   - every search response tells us the peer's upload speed, how many uploads it has queued, and whether it has a free slot right now. we use that and the
+#     file's size (or bitrate * length when the size is missing) to predict how long each candidate will take to finish
+#   - candidates are ranked by quality tier first and predicted time second, so a fast 320kbps mp3 isn't skipped for a flac sitting behind a 40 file queue
+#     but we also don't settle for a 128kbps file because it's quick
+#   - when several tracks download at once the scheduler limits how many transfers we run against each peer, so one slow user with a deep queue can't hold
+#     up the whole batch
+#   - peers we've downloaded from before are ranked with what actually happened (souldb.PeerStats): their observed throughput replaces the advertised
+#     upload speed and the predicted time is divided by their chance of success, so peers that stall or fail sink to the bottom
+from dataclasses import dataclass
+import threading
+import time
+import re
+
+import souldb as SoulDB
+
+AUDIO_EXTENSIONS = ("flac", "mp3")
+
+# slskd reports 0 for peers that haven't told the server their speed, assume they're slow rather than instant
+UNKNOWN_UPLOAD_SPEED = 50_000
+
+# how often a wait that can be cancelled with a threading.Event checks it
+CANCEL_POLL_SECONDS = 0.25
+
+@dataclass
+class PeerScore:
+    success_probability: float
+    throughput: float | None
+
+@dataclass
+class Candidate:
+    file: dict
+    username: str
+    upload_speed: int
+    queue_length: int
+    has_free_upload_slot: bool
+    size: int
+    quality_tier: int
+    predicted_seconds: float
+
+def get_file_extension(filename: str) -> str | None:
+    match = re.search(r'\.([a-zA-Z0-9]+)$', filename)
+    return match.group(1).lower() if match else None
+
+def get_quality_tier(file: dict, extension: str) -> int:
+    """
+    Buckets a file by audio quality, lower is better: 0 for lossless or 320kbps, 1 for 256kbps and up, 2 for everything else
+    """
+    if extension == "flac":
+        return 0
+
+    bit_rate = file.get("bitRate") or 0
+    if bit_rate >= 320:
+        return 0
+    if bit_rate >= 256:
+        return 1
+    return 2
+
+def estimate_file_size(file: dict) -> int:
+    if file.get("size"):
+        return file["size"]
+    # bitRate is in kbps and length is in seconds
+    if file.get("bitRate") and file.get("length"):
+        return file["bitRate"] * 1000 // 8 * file["length"]
+    return 0
+
+def predict_transfer_seconds(size: int, upload_speed: int, queue_length: int, has_free_upload_slot: bool, typical_queued_size: float) -> float:
+    """
+    Predicts how long a download from a peer will take to finish, including the time spent waiting in their upload queue
+
+    Args:
+        size (int): the size of the file in bytes
+        upload_speed (int): the peer's advertised upload speed in bytes per second
+        queue_length (int): the number of uploads the peer has queued
+        has_free_upload_slot (bool): whether the peer can start our upload right away
+        typical_queued_size (float): the size we assume each queued upload is, we use the average file size the peer returned
+
+    Returns:
+        float: the predicted number of seconds until the file is downloaded
+    """
+    upload_speed = upload_speed or UNKNOWN_UPLOAD_SPEED
+    queue_wait = 0 if has_free_upload_slot else queue_length * typical_queued_size / upload_speed
+    return queue_wait + size / upload_speed
+
+def rank_candidates(search_results: list[dict], peer_scores: dict[str, PeerScore] = None) -> list[Candidate]:
+    """
+    Turns slskd search responses into download candidates sorted from best to worst
+
+    Args:
+        search_results: search responses in the format of slskd.searches.search_responses()
+        peer_scores (dict[str, PeerScore]): what we know about some of the peers from earlier downloads, see PeerReputation.get_peer_scores()
+
+    Returns:
+        list[Candidate]: every downloadable mp3 and flac file, sorted by quality tier and then predicted time to complete
+    """
+    peer_scores = peer_scores or {}
+    candidates = []
+
+    for result in search_results:
+        files = result.get("files") or []
+        if len(files) == 0:
+            continue
+
+        typical_queued_size = sum(estimate_file_size(file) for file in files) / len(files)
+        peer_score = peer_scores.get(result["username"])
+        upload_speed = peer_score.throughput if peer_score is not None and peer_score.throughput else result.get("uploadSpeed")
+        success_probability = peer_score.success_probability if peer_score is not None else 0.5
+
+        for file in files:
+            extension = get_file_extension(file["filename"])
+            if extension not in AUDIO_EXTENSIONS or file.get("isLocked"):
+                continue
+
+            size = estimate_file_size(file)
+            candidates.append(Candidate(
+                file=file,
+                username=result["username"],
+                upload_speed=result.get("uploadSpeed") or 0,
+                queue_length=result.get("queueLength") or 0,
+                has_free_upload_slot=bool(result.get("hasFreeUploadSlot")),
+                size=size,
+                quality_tier=get_quality_tier(file, extension),
+                # a peer that fails half the time needs two tries on average, unknown peers are treated as 50/50 like PeerStats does
+                predicted_seconds=predict_transfer_seconds(size, upload_speed, result.get("queueLength") or 0, bool(result.get("hasFreeUploadSlot")), typical_queued_size) / success_probability,
+            ))
+
+    candidates.sort(key=lambda candidate: (candidate.quality_tier, candidate.predicted_seconds))
+    return candidates
+
+class PeerScheduler:
+    """
+    Hands out download candidates while limiting the number of concurrent transfers per peer. It's shared by every worker thread in a batch download
+    """
+    def __init__(self, max_transfers_per_peer: int = 1):
+        self.max_transfers_per_peer = max_transfers_per_peer
+        self._active_transfers: dict[str, int] = {}
+        self._condition = threading.Condition()
+
+    def get_effective_seconds(self, candidate: Candidate) -> float:
+        # our own transfers from the same peer share its upload bandwidth
+        return candidate.predicted_seconds * (1 + self._active_transfers.get(candidate.username, 0))
+
+    def reserve(self, candidates: list[Candidate], timeout: float = None, cancel_event: threading.Event = None) -> Candidate | None:
+        """
+        Waits until a peer with one of the best quality candidates has a free transfer slot and reserves it, the candidate with the lowest predicted time
+        (accounting for our own transfers) wins. Lower quality tiers are only used once the caller has removed every better candidate, i.e. after they failed
+
+        Args:
+            candidates (list[Candidate]): the candidates to choose from, as returned by rank_candidates()
+            timeout (float): the maximum number of seconds to wait for a free peer, None waits forever
+            cancel_event (threading.Event): when set the wait is given up
+
+        Returns:
+            Candidate|None: the reserved candidate, release() must be called once its transfer is over. None if there were no candidates, the wait timed
+            out or it was cancelled
+        """
+        if len(candidates) == 0:
+            return None
+
+        best_tier = min(candidate.quality_tier for candidate in candidates)
+        candidates = [candidate for candidate in candidates if candidate.quality_tier == best_tier]
+
+        is_cancelled = lambda: cancel_event is not None and cancel_event.is_set()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while not self._condition.wait_for(lambda: len(self._get_available(candidates)) > 0 or is_cancelled(), timeout=self._get_wait_seconds(deadline, cancel_event)):
+                if deadline is not None and time.monotonic() >= deadline:
+                    return None
+            if is_cancelled():
+                return None
+
+            candidate = min(self._get_available(candidates), key=self.get_effective_seconds)
+            self._active_transfers[candidate.username] = self._active_transfers.get(candidate.username, 0) + 1
+            return candidate
+
+    @staticmethod
+    def _get_wait_seconds(deadline: float | None, cancel_event: threading.Event | None) -> float | None:
+        # setting the cancel event doesn't notify the condition, so a cancellable wait wakes up now and then to check it
+        wait_seconds = None if deadline is None else max(deadline - time.monotonic(), 0)
+        if cancel_event is not None:
+            wait_seconds = CANCEL_POLL_SECONDS if wait_seconds is None else min(wait_seconds, CANCEL_POLL_SECONDS)
+        return wait_seconds
+
+    def _get_available(self, candidates: list[Candidate]) -> list[Candidate]:
+        return [candidate for candidate in candidates if self._active_transfers.get(candidate.username, 0) < self.max_transfers_per_peer]
+
+    def release(self, username: str):
+        with self._condition:
+            self._active_transfers[username] -= 1
+            if self._active_transfers[username] <= 0:
+                del self._active_transfers[username]
+            self._condition.notify_all()
+
+class PeerReputation:
+    """
+    Reads and updates souldb.PeerStats from the download threads. Every call uses its own short lived session, and a database error is printed instead of
+    failing the download
+    """
+    def __init__(self, sessionmaker):
+        self.sessionmaker = sessionmaker
+        # sqlite only allows one writer at a time, so the download threads take turns
+        self._write_lock = threading.Lock()
+
+    def get_peer_scores(self, usernames) -> dict[str, PeerScore]:
+        try:
+            with self.sessionmaker() as sql_session:
+                now = time.time()
+                return {
+                    username: PeerScore(peer_stats.get_success_probability(now), peer_stats.throughput_ewma)
+                    for username, peer_stats in SoulDB.PeerStats.get_peer_stats(sql_session, usernames).items()
+                }
+        except Exception as e:
+            print(f"Error reading peer stats, ranking without them: {e}")
+            return {}
+
+    def record_success(self, username: str, num_bytes: int = None, seconds: float = None):
+        self._record(username, True, num_bytes, seconds)
+
+    def record_failure(self, username: str):
+        self._record(username, False)
+
+    def _record(self, username: str, succeeded: bool, num_bytes: int = None, seconds: float = None):
+        try:
+            with self._write_lock, self.sessionmaker() as sql_session:
+                SoulDB.PeerStats.record_transfer(sql_session, username, succeeded, num_bytes, seconds)
+                sql_session.commit()
+        except Exception as e:
+            print(f"Error recording peer stats for {username}: {e}")
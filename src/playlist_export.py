@@ -0,0 +1,130 @@
+# writes every playlist as an .m3u8 file that players and DJ software can open
+#   - the paths in the files are relative to the export folder, so the folder and the music can be moved or mounted somewhere else together
+#   - the output folder is usually on a drvfs/network mount where every write is slow, so a playlist file is only rewritten when its content changed.
+#     the sha256 of each file is kept in souldb.PlaylistExports and compared with the content we would write
+#   - all playlists are read with one query ordered by playlist, and each file is written to a temp file that replaces the old one, so players never see
+#     a half written playlist
+from itertools import groupby
+import tempfile
+import hashlib
+import time
+import re
+import os
+
+import sqlalchemy as sqla
+
+import souldb as SoulDB
+
+def get_m3u8_filename(playlist_name: str) -> str:
+    return re.sub(r'[<>:"/\\|?*\x00-\x1f]', "_", playlist_name).strip() + ".m3u8"
+
+def write_file_atomically(filepath: str, content: str):
+    file_descriptor, temp_filepath = tempfile.mkstemp(dir=os.path.dirname(filepath), suffix=".tmp")
+    try:
+        with os.fdopen(file_descriptor, "w", encoding="utf-8") as file:
+            file.write(content)
+        os.replace(temp_filepath, filepath)
+    except BaseException:
+        os.remove(temp_filepath)
+        raise
+
+def build_m3u8(playlist_name: str, track_rows, artist_names_by_track: dict[int, list[str]], output_dir: str) -> str:
+    """
+    Args:
+        playlist_name (str): the name of the playlist
+        track_rows: (track id, filepath, title) of the downloaded tracks in the playlist, in playlist order
+        artist_names_by_track (dict[int, list[str]]): the artists of each track
+        output_dir (str): the folder the file is written to, the track paths are relative to it
+
+    Returns:
+        str: the content of the .m3u8 file
+    """
+    lines = ["#EXTM3U", f"#PLAYLIST:{playlist_name}"]
+    for track_id, filepath, title in track_rows:
+        artist_names = ", ".join(artist_names_by_track.get(track_id, []))
+        lines.append(f"#EXTINF:-1,{artist_names} - {title}" if artist_names else f"#EXTINF:-1,{title or os.path.basename(filepath)}")
+        lines.append(os.path.relpath(filepath, output_dir))
+    return "\n".join(lines) + "\n"
+
+def export_playlists(sql_session, output_dir: str) -> dict[str, int]:
+    """
+    Brings the .m3u8 files in output_dir up to date with the database: changed playlists are rewritten, unchanged ones are left alone, and the files of
+    renamed or deleted playlists are removed
+
+    Args:
+        sql_session: the sqlalchemy session
+        output_dir (str): the folder to write the playlists to
+
+    Returns:
+        dict[str, int]: the number of playlist files that were written, unchanged, and removed
+    """
+    output_dir = os.path.abspath(output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+
+    playlists = sql_session.query(SoulDB.Playlists.id, SoulDB.Playlists.name).order_by(SoulDB.Playlists.id).all()
+    exports = {export.playlist_id: export for export in sql_session.query(SoulDB.PlaylistExports)}
+
+    # playlists with the same name get their id appended so they don't overwrite each other
+    output_filepaths = {}
+    for playlist_id, playlist_name in playlists:
+        filepath = os.path.join(output_dir, get_m3u8_filename(playlist_name))
+        if filepath in output_filepaths.values():
+            filepath = os.path.join(output_dir, get_m3u8_filename(f"{playlist_name} ({playlist_id})"))
+        output_filepaths[playlist_id] = filepath
+
+    downloaded = sqla.and_(SoulDB.Tracks.filepath.isnot(None), SoulDB.Tracks.filepath != "")
+    artist_names_by_track: dict[int, list[str]] = {}
+    artist_rows = (
+        sql_session.query(SoulDB.TrackArtist.track_id, SoulDB.Artists.name)
+        .join(SoulDB.Artists, SoulDB.Artists.id == SoulDB.TrackArtist.artist_id)
+        .join(SoulDB.Tracks, SoulDB.Tracks.id == SoulDB.TrackArtist.track_id)
+        .filter(downloaded)
+        .order_by(SoulDB.TrackArtist.track_id, SoulDB.TrackArtist.id)
+    )
+    for track_id, artist_name in artist_rows:
+        artist_names_by_track.setdefault(track_id, []).append(artist_name)
+
+    track_rows = (
+        sql_session.query(SoulDB.PlaylistTracks.playlist_id, SoulDB.Tracks.id, SoulDB.Tracks.filepath, SoulDB.Tracks.title)
+        .join(SoulDB.Tracks, SoulDB.Tracks.id == SoulDB.PlaylistTracks.track_id)
+        .filter(downloaded)
+        .order_by(SoulDB.PlaylistTracks.playlist_id, SoulDB.PlaylistTracks.added_at, SoulDB.PlaylistTracks.id)
+        .yield_per(1000)
+    )
+    tracks_by_playlist = {playlist_id: [row[1:] for row in rows] for playlist_id, rows in groupby(track_rows, key=lambda row: row[0])}
+
+    counts = {"written": 0, "unchanged": 0, "removed": 0}
+    for playlist_id, playlist_name in playlists:
+        filepath = output_filepaths[playlist_id]
+        content = build_m3u8(playlist_name, tracks_by_playlist.pop(playlist_id, []), artist_names_by_track, output_dir)
+        content_hash = hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+        export = exports.pop(playlist_id, None)
+        if export is not None and export.filepath == filepath and export.content_hash == content_hash and os.path.exists(filepath):
+            counts["unchanged"] += 1
+            continue
+
+        write_file_atomically(filepath, content)
+        counts["written"] += 1
+
+        if export is None:
+            export = SoulDB.PlaylistExports(playlist_id=playlist_id)
+            sql_session.add(export)
+        elif export.filepath != filepath and export.filepath not in output_filepaths.values() and os.path.exists(export.filepath):
+            # the playlist was renamed
+            os.remove(export.filepath)
+            counts["removed"] += 1
+        export.filepath = filepath
+        export.content_hash = content_hash
+        export.exported_at = time.time()
+
+    # whatever is left belongs to playlists that were deleted
+    for export in exports.values():
+        if export.filepath not in output_filepaths.values() and os.path.exists(export.filepath):
+            os.remove(export.filepath)
+            counts["removed"] += 1
+        sql_session.delete(export)
+
+    sql_session.commit()
+    print(f"Exported playlists to {output_dir}: {counts['written']} written, {counts['unchanged']} unchanged, {counts['removed']} removed")
+    return counts
@@ -0,0 +1,101 @@
+# builds and normalizes the "<title> - <artist>, <artist>" search queries used for downloads, and makes equivalent queries share one search and download
+#   - the same song shows up in liked songs and several playlists, sometimes with different punctuation, "feat." spelled differently, or the artists in
+#     another order. normalize_search_query() maps all of those to the same key
+#   - SingleFlight runs a function once per key at a time, concurrent callers with the same key wait for the first one and get its result
+from dataclasses import dataclass, field
+from typing import Callable, Hashable
+import unicodedata
+import threading
+import re
+
+from metrics import METRICS
+
+# "(feat. X)", "[ft X]", "featuring X", etc - the featured artists are moved to the artist list so "Song (feat. X) - Y" and "Song - Y, X" match
+FEATURING_PATTERN = re.compile(r"[\(\[]?\s*\b(?:feat|ft|featuring)\b\.?\s+([^\)\]]*)[\)\]]?", re.IGNORECASE)
+ARTIST_SEPARATOR_PATTERN = re.compile(r"\s*[,&;]\s*")
+
+def build_search_query(title: str, artist_names: list[str]) -> str:
+    return f"{title} - {', '.join(name for name in artist_names if name)}"
+
+def split_search_query(search_query: str) -> tuple[str, list[str]]:
+    """
+    Splits a query built by build_search_query() back into its title and artist names, a query without " - " is all title
+    """
+    title, _, artists = search_query.rpartition(" - ")
+    if title == "":
+        return artists, []
+    return title, [artist.strip() for artist in artists.split(",") if artist.strip()]
+
+def normalize_text(text: str) -> str:
+    # strip accents, lowercase, and turn everything that isn't a letter or number into single spaces
+    text = "".join(char for char in unicodedata.normalize("NFKD", text) if not unicodedata.combining(char))
+    return " ".join(re.findall(r"\w+", text.lower()))
+
+def normalize_search_query(search_query: str) -> str:
+    """
+    Maps equivalent search queries to the same key, ignoring case, accents, punctuation, "feat." variants, and the order of the artists
+
+    Example:
+        normalize_search_query("Señorita (feat. Camila) - Shawn Mendes") == normalize_search_query("senorita - camila, Shawn Mendes")
+    """
+    title, artists = split_search_query(search_query)
+
+    artists = list(artists)
+    for featured in FEATURING_PATTERN.findall(title):
+        artists.extend(ARTIST_SEPARATOR_PATTERN.split(featured))
+    title = FEATURING_PATTERN.sub(" ", title)
+
+    artist_names = set()
+    for artist in artists:
+        for name in ARTIST_SEPARATOR_PATTERN.split(FEATURING_PATTERN.sub(" ", artist)):
+            if normalize_text(name):
+                artist_names.add(normalize_text(name))
+
+    return f"{normalize_text(title)} - {', '.join(sorted(artist_names))}"
+
+@dataclass
+class _Flight:
+    done: threading.Event = field(default_factory=threading.Event)
+    result: object = None
+    error: BaseException = None
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key into one
+    """
+    def __init__(self, name: str):
+        """
+        Args:
+            name (str): what is being coalesced, e.g. "slskd_search" - it's the label on the soulripper_coalesced_total counter
+        """
+        self.name = name
+        self._flights: dict[Hashable, _Flight] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Hashable, function: Callable):
+        """
+        Calls function unless a call with the same key is already running, in which case this waits for that call and returns its result (or raises its error)
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            is_leader = flight is None
+            if is_leader:
+                flight = self._flights[key] = _Flight()
+
+        if not is_leader:
+            METRICS.increment("soulripper_coalesced_total", kind=self.name)
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = function()
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
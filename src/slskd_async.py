@@ -0,0 +1,378 @@
+# asyncio version of SlskdUtils that talks to slskd's REST API directly with aiohttp instead of going through the blocking slskd_api client
+#   - one event loop can drive hundreds of searches and transfers at once, no threads needed
+#   - instead of every search/download polling slskd on its own, one poller per kind fetches all search states (GET /searches) or all downloads (GET /transfers/downloads)
+#     each interval and wakes up whoever is waiting on them, so the number of requests doesn't grow with the number of concurrent transfers
+#   - the api url is configurable so this can be pointed at a local stub server
+from urllib.parse import quote
+import asyncio
+import time
+import uuid
+import os
+import re
+
+import aiohttp
+
+from peer_scheduler import rank_candidates
+from file_placement import place_file
+from metrics import METRICS
+
+class SlskdApiError(Exception):
+    pass
+
+class AsyncSlskdUtils:
+    def __init__(self, api_key: str, host: str = "http://slskd:5030", poll_interval: float = 0.5, max_connections: int = 50, max_concurrent_searches: int = 20):
+        """
+        Args:
+            api_key (str): the slskd api key
+            host (str): the slskd host, e.g. http://slskd:5030 inside docker or http://127.0.0.1:<port> for a stub server
+            poll_interval (float): seconds between polls of slskd for search and download states
+            max_connections (int): the maximum number of open http connections to slskd
+            max_concurrent_searches (int): the maximum number of searches running on slskd at once, the soulseek server throttles clients that search too much
+        """
+        self.api_url = f"{host.rstrip('/')}/api/v0"
+        self.api_key = api_key
+        self.poll_interval = poll_interval
+        self.max_connections = max_connections
+        self.search_semaphore = asyncio.Semaphore(max_concurrent_searches)
+        self.session: aiohttp.ClientSession = None
+
+        # search id -> future resolved with the final search state
+        self._search_waiters: dict[str, asyncio.Future] = {}
+        self._search_poller: asyncio.Task = None
+
+        # download id -> latest download data, refreshed by the download poller
+        self._download_states: dict[str, dict] = {}
+        self._download_update_event = asyncio.Event()
+        self._download_poller: asyncio.Task = None
+        self._num_download_waiters = 0
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def open(self):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                headers={"X-API-Key": self.api_key, "accept": "*/*"},
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                timeout=aiohttp.ClientTimeout(total=60),
+            )
+
+    async def close(self):
+        for poller in (self._search_poller, self._download_poller):
+            if poller is not None:
+                poller.cancel()
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def _request(self, method: str, path: str, **kwargs):
+        if self.session is None:
+            await self.open()
+
+        async with self.session.request(method, self.api_url + path, **kwargs) as response:
+            if response.status >= 400:
+                raise SlskdApiError(f"{method} {path} failed with status {response.status}: {await response.text()}")
+            if response.content_type == "application/json":
+                return await response.json()
+            return None
+
+    # ===========================================
+    #             raw api operations
+    # ===========================================
+
+    async def search_text(self, search_query: str, search_id: str = None, search_timeout_ms: int = 15000, response_limit: int = 100, file_limit: int = 10000) -> dict:
+        data = {
+            "id": search_id or str(uuid.uuid4()),
+            "searchText": search_query,
+            "searchTimeout": search_timeout_ms,
+            "responseLimit": response_limit,
+            "fileLimit": file_limit,
+            "filterResponses": True,
+            "minimumResponseFileCount": 1,
+        }
+        return await self._request("POST", "/searches", json=data)
+
+    async def search_state(self, search_id: str) -> dict:
+        return await self._request("GET", f"/searches/{search_id}")
+
+    async def get_all_search_states(self) -> list[dict]:
+        return await self._request("GET", "/searches")
+
+    async def search_responses(self, search_id: str) -> list[dict]:
+        return await self._request("GET", f"/searches/{search_id}/responses")
+
+    async def delete_search(self, search_id: str):
+        await self._request("DELETE", f"/searches/{search_id}")
+
+    async def enqueue(self, username: str, files: list[dict]) -> bool:
+        await self._request("POST", f"/transfers/downloads/{quote(username)}", json=files)
+        return True
+
+    async def get_download(self, username: str, download_id: str) -> dict:
+        return await self._request("GET", f"/transfers/downloads/{quote(username)}/{download_id}")
+
+    async def get_all_downloads(self) -> list[dict]:
+        return await self._request("GET", "/transfers/downloads/")
+
+    async def cancel_download(self, username: str, download_id: str, remove: bool = False):
+        await self._request("DELETE", f"/transfers/downloads/{quote(username)}/{download_id}", params={"remove": str(remove).lower()})
+
+    # ===========================================
+    #                 pollers
+    # ===========================================
+
+    async def _poll_searches(self):
+        # runs while anyone is waiting on a search, one GET /searches covers all of them
+        try:
+            while len(self._search_waiters) > 0:
+                await asyncio.sleep(self.poll_interval)
+                try:
+                    search_states = await self.get_all_search_states()
+                except (aiohttp.ClientError, SlskdApiError, asyncio.TimeoutError) as e:
+                    print(f"Error polling slskd searches, retrying: {e}")
+                    continue
+
+                for search_state in search_states:
+                    waiter = self._search_waiters.get(search_state["id"])
+                    if waiter is not None and search_state.get("isComplete") and not waiter.done():
+                        waiter.set_result(search_state)
+                        del self._search_waiters[search_state["id"]]
+        except Exception as e:
+            # e.g. a malformed response, the searches fail instead of waiting on a poller that is gone
+            print(f"Search poller stopped: {e!r}")
+            for waiter in self._search_waiters.values():
+                if not waiter.done():
+                    waiter.set_exception(SlskdApiError(f"Polling slskd searches failed: {e!r}"))
+        finally:
+            self._search_poller = None
+
+    async def _poll_downloads(self):
+        # runs while anyone is waiting on a download, one GET /transfers/downloads covers every user and file
+        try:
+            while self._num_download_waiters > 0:
+                await asyncio.sleep(self.poll_interval)
+                try:
+                    all_downloads = await self.get_all_downloads()
+                except (aiohttp.ClientError, SlskdApiError, asyncio.TimeoutError) as e:
+                    print(f"Error polling slskd downloads, retrying: {e}")
+                    continue
+
+                self._download_states = {
+                    file["id"]: file
+                    for user_downloads in all_downloads
+                    for directory in user_downloads["directories"]
+                    for file in directory["files"]
+                }
+
+                # wake up every waiter, each one checks its own download
+                self._download_update_event.set()
+                self._download_update_event = asyncio.Event()
+        except Exception as e:
+            # the waiters start a new poller the next time they wake up
+            print(f"Download poller stopped: {e!r}")
+        finally:
+            self._download_poller = None
+
+    def _ensure_download_poller(self):
+        if self._download_poller is None:
+            self._download_poller = asyncio.create_task(self._poll_downloads())
+
+    async def wait_for_search(self, search_id: str, timeout: float = None) -> dict:
+        """
+        Waits until a search is complete
+
+        Args:
+            search_id (str): the slskd id of the search
+            timeout (float): seconds to wait before raising asyncio.TimeoutError, None waits as long as it takes
+
+        Returns:
+            dict: the final search state
+        """
+        waiter = asyncio.get_running_loop().create_future()
+        self._search_waiters[search_id] = waiter
+        if self._search_poller is None:
+            self._search_poller = asyncio.create_task(self._poll_searches())
+
+        try:
+            return await asyncio.wait_for(waiter, timeout)
+        finally:
+            self._search_waiters.pop(search_id, None)
+
+    async def wait_for_download(self, download_id: str, inactive_download_timeout: float = 10) -> dict:
+        """
+        Waits until a download reaches a Completed state or stops making progress
+
+        Args:
+            download_id (str): the slskd id of the download
+            inactive_download_timeout (float): the number of minutes a download can go without any new bytes before we give up on it
+
+        Returns:
+            dict: the last download data seen from slskd
+        """
+        self._num_download_waiters += 1
+        self._ensure_download_poller()
+
+        try:
+            last_progress_time = time.monotonic()
+            last_bytes_transferred = -1
+            while True:
+                # the timeout keeps the inactivity check running while slskd can't be reached and no updates come in
+                try:
+                    await asyncio.wait_for(self._download_update_event.wait(), timeout=max(self.poll_interval * 10, 1))
+                except asyncio.TimeoutError:
+                    self._ensure_download_poller()
+                download = self._download_states.get(download_id, {"id": download_id, "state": "Unknown"})
+
+                if download["state"].startswith("Completed"):
+                    return download
+
+                if download.get("bytesTransferred", 0) != last_bytes_transferred:
+                    last_bytes_transferred = download.get("bytesTransferred", 0)
+                    last_progress_time = time.monotonic()
+                elif time.monotonic() - last_progress_time > inactive_download_timeout * 60:
+                    print(f"Download was inactive for {inactive_download_timeout} minutes, skipping")
+                    return download
+        finally:
+            self._num_download_waiters -= 1
+
+    # ===========================================
+    #        same operations as SlskdUtils
+    # ===========================================
+
+    async def search(self, search_query: str, search_timeout_ms: int = 15000) -> list | None:
+        """
+        Searches for a track on soulseek
+
+        Args:
+            search_query (str): the query to search for
+            search_timeout_ms (int): how long slskd searches for
+
+        Returns:
+            list|None: a list of relevant (file, username) search results
+        """
+        async with self.search_semaphore:
+            with METRICS.span("slskd_search", query=search_query, backend="async") as search_span:
+                search_start_time = time.perf_counter()
+                search = await self.search_text(search_query, search_timeout_ms=search_timeout_ms)
+                # slskd completes the search itself after search_timeout_ms, the extra minute is for a slskd that stopped answering
+                await self.wait_for_search(search["id"], timeout=search_timeout_ms / 1000 + 60)
+                search_results = await self.search_responses(search["id"])
+                # finished searches are deleted so that GET /searches in the poller stays small
+                await self.delete_search(search["id"])
+                METRICS.observe("soulripper_slskd_search_latency_seconds", time.perf_counter() - search_start_time)
+                search_span["num_responses"] = len(search_results)
+
+        # the same ranking as SlskdUtils.filter_search_results(), without importing the blocking slskd_api client
+        relevant_results = [(candidate.file, candidate.username) for candidate in rank_candidates(search_results)]
+        return relevant_results if len(relevant_results) > 0 else None
+
+    async def find_download_id(self, username: str, filename: str) -> str | None:
+        for user_downloads in await self.get_all_downloads():
+            if user_downloads["username"] != username:
+                continue
+            for directory in user_downloads["directories"]:
+                for file in directory["files"]:
+                    if file["filename"] == filename:
+                        return file["id"]
+        return None
+
+    async def start_download(self, search_results: list, max_retries: int) -> tuple:
+        for attempt_count, (file_data, file_user) in enumerate(search_results):
+            if attempt_count > max_retries:
+                print(f"Max retries ({max_retries}) reached for your query, giving up on SoulSeek...")
+                return (None, None, None)
+
+            try:
+                with METRICS.span("slskd_enqueue", username=file_user, filename=file_data["filename"], backend="async"):
+                    await self.enqueue(file_user, [file_data])
+            except (aiohttp.ClientError, SlskdApiError, asyncio.TimeoutError) as e:
+                print(f"Error during transfer: {e}")
+                continue
+
+            file_id = await self.find_download_id(file_user, file_data["filename"])
+            return (file_id, file_data["filename"], file_user)
+
+        return (None, None, None)
+
+    async def download_track(self, search_query: str, output_path: str, max_retries: int = 5, inactive_download_timeout: int = 10) -> str | None:
+        """
+        Attempts to download a track from soulseek
+
+        Args:
+            search_query (str): the song to download, can be a search query
+            output_path (str): the directory to download the song to
+            max_retries (int): the maximum number of times to retry the download from SoulSeek before giving up
+            inactive_download_timeout (int): the number of minutes a download can go without progress before giving up
+
+        Returns:
+            str|None: the path to the downloaded song
+        """
+        search_results = await self.search(search_query)
+        if search_results is None:
+            print(f"No results found on Soulseek for {search_query}")
+            return None
+
+        download_file_id, download_filepath, download_username = await self.start_download(search_results, max_retries)
+        if None in (download_file_id, download_filepath, download_username):
+            print(f"None field returned by start_download, cannot continue: {(download_file_id, download_filepath, download_username)}")
+            return None
+
+        with METRICS.span("slskd_transfer", username=download_username, filename=download_filepath, backend="async") as transfer_span:
+            transfer_start_time = time.perf_counter()
+            slskd_download = await self.wait_for_download(download_file_id, inactive_download_timeout)
+            transfer_span["state"] = slskd_download["state"]
+
+            if slskd_download["state"] != "Completed, Succeeded":
+                transfer_span["outcome"] = "failed"
+                print(f"Download failed: {slskd_download['state']}")
+                if not slskd_download["state"].startswith("Completed"):
+                    await self.cancel_download(download_username, download_file_id)
+                return None
+
+            elapsed_time = time.perf_counter() - transfer_start_time
+            if slskd_download.get("size") and elapsed_time > 0:
+                METRICS.observe("soulripper_transfer_throughput_bytes_per_second", slskd_download["size"] / elapsed_time)
+
+        # by default slskd places downloads in assets/downloads/<containing folder name of file from user>/<file from user>
+        download_filename = re.split(r'[\\/]', download_filepath)[-1]
+        containing_dir_name = os.path.basename(os.path.dirname(download_filepath.replace("\\", "/")))
+        source_path = os.path.join(f"assets/downloads/{containing_dir_name}/{download_filename}")
+        dest_path = os.path.join(f"{output_path}/{download_filename}")
+
+        if not os.path.exists(source_path):
+            print(f"ERROR: slskd download state is 'Completed, Succeeded' but the file was not found: {source_path}")
+            return None
+
+        # rename/link/reflink before falling back to a copy, see file_placement.py
+        await asyncio.to_thread(place_file, source_path, dest_path)
+        return dest_path
+
+    async def download_tracks(self, search_queries: list[str], output_path: str, max_concurrent_downloads: int = 50, **download_kwargs) -> dict[str, str | None]:
+        """
+        Downloads many tracks concurrently on the current event loop
+
+        Args:
+            search_queries (list[str]): the songs to download
+            output_path (str): the directory to download the songs to
+            max_concurrent_downloads (int): the maximum number of tracks being searched for or transferred at once
+            **download_kwargs: passed through to download_track()
+
+        Returns:
+            dict[str, str|None]: each search query mapped to its downloaded filepath, or None if it failed
+        """
+        download_semaphore = asyncio.Semaphore(max_concurrent_downloads)
+
+        async def download_one(search_query):
+            async with download_semaphore:
+                try:
+                    return await self.download_track(search_query, output_path, **download_kwargs)
+                except (aiohttp.ClientError, SlskdApiError, asyncio.TimeoutError) as e:
+                    print(f"Error downloading {search_query}: {e}")
+                    return None
+
+        download_paths = await asyncio.gather(*(download_one(search_query) for search_query in search_queries))
+        return dict(zip(search_queries, download_paths))
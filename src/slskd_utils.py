@@ -1,17 +1,44 @@
 import slskd_api
-from rich.console import Console
-from rich.progress import Progress, TextColumn, BarColumn, TaskProgressColumn, TimeRemainingColumn
-import shutil
+from metrics import METRICS
+from peer_scheduler import PeerScheduler, PeerReputation, PeerScore, Candidate, rank_candidates
+from folder_batcher import FolderBatcher, FolderClaim, RETRY, get_folder
+from search_queries import SingleFlight, normalize_search_query
+from file_placement import FilePlacer
+from dashboard import DASHBOARD, TransferStatus, SearchStatus
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Iterator, Callable
+import contextlib
+import threading
 import time
 import os
 import re
 
 class SlskdUtils:
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, max_concurrent_downloads: int = 1, max_transfers_per_peer: int = 1, peer_reputation: PeerReputation = None, batch_folder_downloads: bool = True, placer: FilePlacer = None):
+        """
+        Args:
+            api_key (str): the slskd api key
+            max_concurrent_downloads (int): the number of tracks download_tracks() searches for and transfers at once
+            max_transfers_per_peer (int): the maximum number of those transfers that can come from the same soulseek user
+            peer_reputation (PeerReputation): where every download's outcome is recorded and read back to rank peers, None ranks on search results alone
+            batch_folder_downloads (bool): whether download_tracks() browses the chosen peer's folder for other tracks in the batch (see folder_batcher.py)
+            placer (FilePlacer): moves finished downloads to the output path in the background (see file_placement.py)
+        """
         self.client = slskd_api.SlskdClient("http://slskd:5030", api_key)
+        self.max_concurrent_downloads = max_concurrent_downloads
+        self.max_transfers_per_peer = max_transfers_per_peer
+        self.peer_reputation = peer_reputation
+        self.placer = placer or FilePlacer()
+        self.batch_folder_downloads = batch_folder_downloads
+
+        # equivalent queries (see search_queries.normalize_search_query) that run at the same time share one slskd search and one download,
+        # and a song that was already downloaded into the same folder isn't downloaded again for the next playlist it's in
+        self._search_flights = SingleFlight("slskd_search")
+        self._download_flights = SingleFlight("slskd_download")
+        self._downloaded_paths: dict[tuple[str, str], str] = {}
 
     # TODO: the output filename is wrong also ERROR HANDLING
-    def download_track(self, search_query: str, output_path: str, max_retries: int = 5, inactive_download_timeout: int = 10) -> str:       
+    def download_track(self, search_query: str, output_path: str, max_retries: int = 5, inactive_download_timeout: int = 10, scheduler: PeerScheduler = None, show_progress: bool = True, started_event: threading.Event = None, cancel_event: threading.Event = None, batcher: FolderBatcher = None, wait_for_placement: bool = True) -> str:       
         """
         Attempts to download a track from soulseek
 
@@ -20,56 +47,126 @@ class SlskdUtils:
             output_path (str): the directory to download the song to
             max_retries (int): the maximum number of times to retry the download from SoulSeek before giving up
             inactive_download_timeout (int): the number of minutes to wait for a download to complete before giving up
+            scheduler (PeerScheduler): when downloading several tracks at once, the scheduler that limits transfers per peer
+            show_progress (bool): whether the search and transfer are shown on the shared dashboard (see dashboard.py)
+            started_event (threading.Event): set once the transfer has actually started receiving bytes
+            cancel_event (threading.Event): when set the download is cancelled on slskd and None is returned
+            batcher (FolderBatcher): when downloading several tracks at once, lets this track be downloaded along with another one from the same folder
+            wait_for_placement (bool): whether to wait for the file to be moved to output_path, without waiting the path has to be passed to self.placer.wait() before it's used
 
         Returns:
             str|None: the path to the downloaded song
         """
+        # the same song downloaded into another folder (e.g. a playlist with its own output path) is a different download
+        download_key = (normalize_search_query(search_query), os.path.abspath(output_path))
+        downloaded_path = self._downloaded_paths.get(download_key)
+        if downloaded_path is not None and (self.placer.is_pending(downloaded_path) or os.path.exists(downloaded_path)):
+            print(f"Already downloaded {search_query}: {downloaded_path}")
+            return self.placer.wait(downloaded_path) if wait_for_placement else downloaded_path
+
+        download = lambda: self._download_track(search_query, output_path, max_retries, inactive_download_timeout, scheduler, show_progress, started_event, cancel_event, batcher)
+        with DASHBOARD.running() if show_progress else contextlib.nullcontext():
+            # if an equivalent query is already downloading we wait for that one. a call with its own started/cancel events (a hedged race) isn't
+            # coalesced, since the events of a download it only waits on would never be set or checked
+            if started_event is None and cancel_event is None:
+                download_path = self._download_flights.do(download_key, download)
+            else:
+                download_path = download()
+        if download_path is not None:
+            self._downloaded_paths[download_key] = download_path
+        return self.placer.wait(download_path) if wait_for_placement else download_path
+
+    def _download_track(self, search_query: str, output_path: str, max_retries: int, inactive_download_timeout: int, scheduler: PeerScheduler, show_progress: bool, started_event: threading.Event, cancel_event: threading.Event, batcher: FolderBatcher) -> str | None:
+        # another worker may have already enqueued this track together with its own
+        while batcher is not None and (claim := batcher.begin(search_query)) is not None:
+            if started_event is not None:
+                started_event.set()
+            download_path = claim.wait(cancel_event=cancel_event)
+            if download_path is not RETRY:
+                return download_path
+            if cancel_event is not None and cancel_event.is_set():
+                return None
 
         # search slskd using the passed in query
-        search_results = self.search(search_query)
-        if search_results is None:
-            print("No results found on Soulseek")
+        search_responses = self.get_search_responses(search_query, show_progress)
+        candidates = rank_candidates(search_responses, self.get_peer_scores(search_responses))
+        if len(candidates) == 0:
+            print(f"No relevant results found on Soulseek for: {search_query}")
+            return None
+
+        if cancel_event is not None and cancel_event.is_set():
             return None
         
         # attempt to start the download
-        download_file_id, download_filepath, download_username = self.start_download(search_results, max_retries)
+        folder_claims: list[FolderClaim] = []
+        if scheduler is None:
+            download_file_id, download_filepath, download_username = self.start_download([(candidate.file, candidate.username) for candidate in candidates], max_retries, cancel_event)
+        else:
+            download_file_id, download_filepath, download_username, folder_claims = self.start_scheduled_download(candidates, max_retries, scheduler, batcher, cancel_event)
+
         if None in (download_file_id, download_filepath, download_username):
             print(f"None field returned by attempt_downloads, cannot continue: {(download_file_id, download_filepath, download_username)}")
+            for folder_claim in folder_claims:
+                batcher.resolve(folder_claim, None)
+            if scheduler is not None and download_username is not None:
+                scheduler.release(download_username)
             return None
 
+        try:
+            download_path = self.wait_for_download(download_file_id, download_filepath, download_username, output_path, inactive_download_timeout, show_progress, started_event, cancel_event)
+
+            # the files that were enqueued along with ours come from the same peer in the same queue, so they finish right after it
+            for folder_claim in folder_claims:
+                claim_path = None
+                try:
+                    claim_file_id = self.search_file_id_from_filename(folder_claim.file["filename"])
+                    if claim_file_id is not None:
+                        claim_path = self.wait_for_download(claim_file_id, folder_claim.file["filename"], download_username, output_path, inactive_download_timeout, show_progress)
+                finally:
+                    batcher.resolve(folder_claim, claim_path)
+
+            return download_path
+        finally:
+            # claims that weren't reached because of an exception go back to their own workers
+            for folder_claim in folder_claims:
+                if not folder_claim.is_resolved():
+                    batcher.resolve(folder_claim, None)
+            if scheduler is not None:
+                scheduler.release(download_username)
+
+    def wait_for_download(self, download_file_id: str, download_filepath: str, download_username: str, output_path: str, inactive_download_timeout: int = 10, show_progress: bool = True, started_event: threading.Event = None, cancel_event: threading.Event = None) -> str | None:
+        """
+        Waits for an enqueued download to finish and moves it to the output path, see download_track() for the arguments
+
+        Returns:
+            str|None: the path to the downloaded song
+        """
         download_filename = re.split(r'[\\/]', download_filepath)[-1]
 
-        # this is just style config for the rich progress bar
-        rich_console = Console()
-        rich_progress_bar = Progress(
-            TextColumn(f"[light_steel_blue]Downloading:[/light_steel_blue] [bright_white]{download_filename}"),
-            BarColumn(
-                bar_width=None,
-                complete_style="green",
-                finished_style="green",
-                pulse_style="deep_pink4",
-                style="deep_pink4"
-            ),
-            TaskProgressColumn(style="green"),
-            TimeRemainingColumn(),
-            expand=True,
-            console=rich_console
-        )     
-
-        # this scope is just for the rich progress bar idk exactly how it works 
-        with rich_progress_bar as rich_progress:
-            task = rich_progress.add_task("", total=100)
-
-            # continuously check on the download while it is incomplete, update the progress bar, and break if it takes too long or an exception occurs
+        # the transfer shows up on the shared dashboard until the with block ends
+        transfer_display = DASHBOARD.transfer(download_filename, download_username) if show_progress else contextlib.nullcontext(TransferStatus(download_filename, download_username))
+
+        with transfer_display as transfer_status, METRICS.span("slskd_transfer", username=download_username, filename=download_filepath) as transfer_span:
+            # continuously check on the download while it is incomplete, update the dashboard, and break if it takes too long or an exception occurs
             start_time = time.time()
             percent_complete = 0.0
             while percent_complete < 100:
-                # update the download, progress bar, and timer
+                # update the download, dashboard, and timer
                 slskd_download = self.client.transfers.get_download(download_username, download_file_id)
                 percent_complete = round(slskd_download["percentComplete"], 2)
-                rich_progress.update(task, completed=percent_complete)
+                DASHBOARD.update_transfer(transfer_status, slskd_download)
                 elapsed_time = time.time() - start_time
 
+                if started_event is not None and slskd_download.get("bytesTransferred", 0) > 0:
+                    started_event.set()
+
+                # another source finished first, stop the transfer so slskd doesn't keep downloading a file nobody wants
+                if cancel_event is not None and cancel_event.is_set():
+                    print(f"Cancelling Soulseek download: {download_filename}")
+                    self.client.transfers.cancel_download(download_username, download_file_id)
+                    transfer_span["outcome"] = "cancelled"
+                    return None
+
                 # if the download has taken longer than the timeout time AND the download is still at 0%, give up and break
                 # TODO: we prolly need a better way of doing this, what if the download goes stale at 50%? i think there is way to look at transfer rates
                 if elapsed_time > inactive_download_timeout * 60 and percent_complete == 0.0:
@@ -82,7 +179,23 @@ class SlskdUtils:
                     break
 
                 time.sleep(.1)
+
+            transfer_span["state"] = slskd_download["state"]
+            if slskd_download["state"] == "Completed, Succeeded":
+                transfer_status.succeeded = True
+                transfer_span["size"] = slskd_download.get("size")
+                if slskd_download.get("size") and elapsed_time > 0:
+                    METRICS.observe("soulripper_transfer_throughput_bytes_per_second", slskd_download["size"] / elapsed_time)
+                self.record_peer_result(download_username, True, slskd_download.get("size"), elapsed_time)
+            else:
+                transfer_span["outcome"] = "failed"
+                self.record_peer_result(download_username, False)
     
+        # the transfer can reach 100% right as another source wins, the file is left in slskd's download folder instead of becoming a duplicate in the library
+        if slskd_download["state"] == "Completed, Succeeded" and cancel_event is not None and cancel_event.is_set():
+            print(f"Another source finished first, not moving the Soulseek download: {download_filename}")
+            return None
+
         # move the file from where it was downloaded to the specified output path
         if slskd_download["state"] == "Completed, Succeeded":
             # by default slskd places downloads in assets/downloads/<containing folder name of file from user>/<file from user>
@@ -94,8 +207,8 @@ class SlskdUtils:
                 print(f"ERROR: slskd download state is 'Completed, Succeeded' but the file was not found: {source_path}")
                 return None
 
-            shutil.move(source_path, dest_path)
-            return dest_path
+            # the move can be a full copy across mounts, it runs on the placer so this worker's peer slot is released right away
+            return self.placer.submit(source_path, dest_path)
         else:
             print(f"Download failed: {slskd_download['state']}")
 
@@ -104,17 +217,21 @@ class SlskdUtils:
 
             return None
     
-    def start_download(self, search_results, max_retries):
+    def start_download(self, search_results, max_retries, cancel_event: threading.Event = None):
         # attempt to download the each best search result until we reach max_retries or we run out of search_results
         for attempt_count, (file_data, file_user) in enumerate(search_results):
             if attempt_count > max_retries:
                 print(f"Max retries ({max_retries}) reached for your query, giving up on SoulSeek...")
                 return (None, None, None)
+            if cancel_event is not None and cancel_event.is_set():
+                return (None, None, None)
             
             try:
-                self.client.transfers.enqueue(file_user, [file_data])
+                with METRICS.span("slskd_enqueue", username=file_user, filename=file_data["filename"]):
+                    self.client.transfers.enqueue(file_user, [file_data])
             except Exception as e:
                 print(f"Error during transfer: {e}")
+                self.record_peer_result(file_user, False)
                 continue
 
             filename = file_data["filename"]
@@ -123,6 +240,132 @@ class SlskdUtils:
     
         return (None, None, None)
 
+    def start_scheduled_download(self, candidates: list[Candidate], max_retries: int, scheduler: PeerScheduler, batcher: FolderBatcher = None, cancel_event: threading.Event = None) -> tuple:
+        """
+        Same as start_download() but the scheduler picks each attempt's peer. The returned user's slot stays reserved until the caller releases it.
+        With a batcher, other pending tracks from the chosen file's folder are enqueued in the same request. Setting cancel_event gives up before the
+        next enqueue
+
+        Returns:
+            tuple: (file_id, filename, username, folder_claims), or (None, None, None, []) if every attempt failed. The caller has to resolve every claim
+        """
+        remaining_candidates = list(candidates)
+        for attempt_count in range(max_retries + 1):
+            candidate = scheduler.reserve(remaining_candidates, cancel_event=cancel_event)
+            if cancel_event is not None and cancel_event.is_set():
+                if candidate is not None:
+                    scheduler.release(candidate.username)
+                return (None, None, None, [])
+            if candidate is None:
+                break
+
+            # other files from a peer that just failed are unlikely to work either
+            remaining_candidates = [remaining for remaining in remaining_candidates if remaining.username != candidate.username]
+
+            folder_claims = []
+            if batcher is not None:
+                folder_files = self.browse_folder(candidate.username, get_folder(candidate.file["filename"]))
+                folder_claims = batcher.claim_folder(candidate.username, folder_files, candidate.file["filename"])
+
+            # the browse can take a while too, a race that was lost in the meantime shouldn't start a transfer
+            if cancel_event is not None and cancel_event.is_set():
+                for folder_claim in folder_claims:
+                    batcher.resolve(folder_claim, None)
+                scheduler.release(candidate.username)
+                return (None, None, None, [])
+
+            try:
+                with METRICS.span("slskd_enqueue", username=candidate.username, filename=candidate.file["filename"], predicted_seconds=round(candidate.predicted_seconds, 1), num_folder_files=len(folder_claims)):
+                    self.client.transfers.enqueue(candidate.username, [candidate.file] + [folder_claim.file for folder_claim in folder_claims])
+            except Exception as e:
+                print(f"Error during transfer: {e}")
+                for folder_claim in folder_claims:
+                    batcher.resolve(folder_claim, None)
+                self.record_peer_result(candidate.username, False)
+                scheduler.release(candidate.username)
+                continue
+
+            if len(folder_claims) > 0:
+                print(f"Enqueued {len(folder_claims)} more track(s) from the same folder: {', '.join(folder_claim.search_query for folder_claim in folder_claims)}")
+            return (self.search_file_id_from_filename(candidate.file["filename"]), candidate.file["filename"], candidate.username, folder_claims)
+
+        print(f"Max retries ({max_retries}) reached or no peers left for your query, giving up on SoulSeek...")
+        return (None, None, None, [])
+
+    def browse_folder(self, username: str, folder: str) -> list[dict]:
+        """
+        Lists the files in one of a peer's shared folders
+
+        Returns:
+            list[dict]: the files with their full paths as filenames like in search results, empty if the peer couldn't be browsed
+        """
+        try:
+            with METRICS.span("slskd_browse", username=username, folder=folder):
+                directories = self.client.users.directory(username, folder)
+        except Exception as e:
+            print(f"Could not browse {username}'s folder, downloading just the one file: {e}")
+            return []
+
+        folder_files = []
+        for directory in directories or []:
+            for file in directory.get("files") or []:
+                # slskd only gives the file name for files in a directory listing, enqueue needs the full path
+                filename = file["filename"] if "\\" in file["filename"] else f"{directory.get('name', folder)}\\{file['filename']}"
+                folder_files.append({**file, "filename": filename})
+        return folder_files
+
+    def get_peer_scores(self, search_responses: list[dict]) -> dict[str, PeerScore]:
+        if self.peer_reputation is None:
+            return {}
+        return self.peer_reputation.get_peer_scores(response["username"] for response in search_responses)
+
+    def record_peer_result(self, username: str, succeeded: bool, num_bytes: int = None, seconds: float = None):
+        if self.peer_reputation is None:
+            return
+        if succeeded:
+            self.peer_reputation.record_success(username, num_bytes, seconds)
+        else:
+            self.peer_reputation.record_failure(username)
+
+    def download_tracks(self, search_queries: list[str], output_path: str, max_retries: int = 5, inactive_download_timeout: int = 10, download_function: Callable = None) -> Iterator[tuple[str, str | None]]:
+        """
+        Downloads several tracks at once on a thread pool, spreading the transfers across peers with a PeerScheduler
+
+        Args:
+            search_queries (list[str]): the songs to download
+            output_path (str): the directory to download the songs to
+            max_retries (int): the maximum number of peers to try for each song
+            inactive_download_timeout (int): the number of minutes to wait for a download to start before giving up
+            download_function (Callable): called instead of download_track() for each song with the same arguments, e.g. to race it against youtube
+
+        Yields:
+            tuple[str, str|None]: each search query and its downloaded filepath (None if it failed) in the order they finish
+        """
+        scheduler = PeerScheduler(self.max_transfers_per_peer)
+        batcher = FolderBatcher(search_queries) if self.batch_folder_downloads else None
+        download_function = download_function or self.download_track
+
+        def run_download(search_query):
+            DASHBOARD.add_queued(-1)
+            return download_function(search_query, output_path, max_retries, inactive_download_timeout, scheduler=scheduler, show_progress=True, batcher=batcher, wait_for_placement=False)
+
+        # every worker's searches and transfers share one dashboard, the tracks that are waiting for a worker are the queue
+        DASHBOARD.add_queued(len(search_queries))
+        with DASHBOARD.running(), ThreadPoolExecutor(max_workers=self.max_concurrent_downloads, thread_name_prefix="soulripper-download") as executor:
+            futures = {executor.submit(run_download, search_query): search_query for search_query in search_queries}
+
+            for future in as_completed(futures):
+                search_query = futures[future]
+                try:
+                    # the workers don't wait for their files to be moved, the consumer of this generator does
+                    download_path = self.placer.wait(future.result())
+                except Exception as e:
+                    print(f"Error downloading {search_query}: {e}")
+                    download_path = None
+
+                print(f"{'Downloaded' if download_path else 'Failed on Soulseek'}: {search_query}")
+                yield search_query, download_path
+
     # TODO: better searching - need to extract artist and title from returned search data somehow - maybe from filepath 
     def search(self, search_query: str) -> list:
         """
@@ -134,12 +377,35 @@ class SlskdUtils:
         Returns:
             list: a list of relevant search results
         """
-        search = self.client.searches.search_text(search_query)
-        search_id = search["id"]
+        with DASHBOARD.running():
+            search_results = self.get_search_responses(search_query)
 
-        rich_console = Console()
+        # filter for just relevant results - audio files that are downloadable from the user
+        relevant_results = self.filter_search_results(search_results, self.get_peer_scores(search_results))
+        if relevant_results is None:
+            print("No relevant results found on Soulseek")
+            return None
+
+        print(f"Search complete for: {search_query} | Relevant files found: {len(relevant_results)}")
+        return relevant_results
+
+    def get_search_responses(self, search_query: str, show_progress: bool = True) -> list[dict]:
+        """
+        Runs a search on slskd and waits for it to finish, concurrent searches for equivalent queries share one slskd search
+
+        Returns:
+            list[dict]: the raw search responses, one per user
+        """
+        return self._search_flights.do(normalize_search_query(search_query), lambda: self._get_search_responses(search_query, show_progress))
+
+    def _get_search_responses(self, search_query: str, show_progress: bool) -> list[dict]:
+        search_display = DASHBOARD.search(search_query) if show_progress else contextlib.nullcontext(SearchStatus(search_query))
+
+        with METRICS.span("slskd_search", query=search_query) as search_span, search_display as search_status:
+            search_start_time = time.perf_counter()
+            search = self.client.searches.search_text(search_query)
+            search_id = search["id"]
 
-        with rich_console.status(f"[light_steel_blue]Searching SoulSeek for:[/light_steel_blue] [bright_white]{search_query}[/bright_white]", spinner="earth") as status:
             while True:
                 search_state = self.client.searches.state(search_id)
                 num_found_files = search_state["fileCount"]
@@ -148,54 +414,35 @@ class SlskdUtils:
                 if is_complete:
                     break
 
-                status.update(f"[light_steel_blue]Searching SoulSeek for:[/light_steel_blue] [bright_white]{search_query}[/bright_white] [light_steel_blue]| Total Files found[/light_steel_blue]: [bright_white]{num_found_files}[/bright_white]")
+                search_status.num_files = num_found_files
                 time.sleep(.1)
 
-        search_results = self.client.searches.search_responses(search_id)
-
-        # filter for just relevant results - audio files that are downloadable from the user
-        relevant_results = self.filter_search_results(search_results)
-        if relevant_results is None:
-            print("No relevant results found on Soulseek")
-            return None
+            search_results = self.client.searches.search_responses(search_id)
+            METRICS.observe("soulripper_slskd_search_latency_seconds", time.perf_counter() - search_start_time)
+            search_span["num_responses"] = len(search_results)
+            search_span["num_files"] = num_found_files
 
-        rich_console.print(f"[light_steel_blue]Search complete for:[/light_steel_blue] [bright_white]{search_query}[/bright_white] [light_steel_blue]| Relevant Files found[/light_steel_blue]: [bright_white]{len(relevant_results)}[/bright_white]")
-        return relevant_results
+        return search_results
 
     # TODO: we need to analyze the relevance of the results somehow
     #   - we are incorrectly downloading a lot of shit results
     #       - need relevance metric
     #   - for example, if the new file contains "remix" and the original file does not, we may want to remove it from the results
-    #   - currently files are sorted in order of size - this is a mid way to do it 
     #   - we should give more options to the user - file types, size, quality, etc
-    def filter_search_results(self, search_results):
+    @staticmethod
+    def filter_search_results(search_results, peer_scores: dict[str, PeerScore] = None):
         """
-        Filters the search results to only include downloadable mp3 and flac files sorted by size
+        Filters the search results to only include downloadable mp3 and flac files, sorted by quality and then by how long each peer is predicted to
+        take (see peer_scheduler.rank_candidates)
 
         Args:
             search_results: search responses in the format of slskd.searches.search_responses()
+            peer_scores (dict[str, PeerScore]): what we know about the peers from earlier downloads, see SlskdUtils.get_peer_scores()
         
         Returns:
-            List((highest_quality_file, highest_quality_file_user: str)): The file data for the best candidate, and the username of its owner
+            List((file, file_user: str)): The file data for each candidate, and the username of its owner, best first
         """
-
-        relevant_results = []
-
-        for result in search_results:
-            for file in result["files"]:
-                # this extracts the file extension
-                match = re.search(r'\.([a-zA-Z0-9]+)$', file["filename"])
-
-                if match is None:
-                    print(f"Skipping due to invalid file extension: {file['filename']}")
-                    continue
-
-                file_extension = match.group(1)
-
-                if file_extension in ["flac", "mp3"] and result["fileCount"] > 0 and result["hasFreeUploadSlot"] == True:
-                    relevant_results.append((file, result["username"]))
-                
-        relevant_results.sort(key=lambda candidate : candidate[0]["size"], reverse=True)
+        relevant_results = [(candidate.file, candidate.username) for candidate in rank_candidates(search_results, peer_scores)]
 
         if len(relevant_results) > 0:
             return relevant_results
@@ -2,12 +2,17 @@ import spotipy
 from spotipy.oauth2 import SpotifyOAuth
 from dotenv import load_dotenv
 from souldb import TrackData
+from metrics import METRICS
 from dataclasses import dataclass
+from typing import Iterable
 import yaml
 import time
 import re
 import os
 
+# the most ids spotify's several tracks / several artists endpoints take per request
+MAX_IDS_PER_REQUEST = 50
+
 # immutable dataclass containg the users spotify config information
 @dataclass(frozen=True)
 class SpotifyUserData:
@@ -53,7 +58,12 @@ class SpotifyClient():
             )
         )
 
-        self.USER_ID = self.spotipy_client.current_user()["id"]
+        with METRICS.span("spotify_fetch", endpoint="current_user"):
+            self.USER_ID = self.spotipy_client.current_user()["id"]
+
+        # what get_tracks() and get_artists() already looked up, only the fields we store are kept so a whole library's worth stays small
+        self._track_details: dict[str, dict | None] = {}
+        self._artist_details: dict[str, dict | None] = {}
 
     def get_playlist_id(self, playlist_name):
         for playlist in self.get_all_playlists():
@@ -63,21 +73,24 @@ class SpotifyClient():
         return -1
 
     def get_all_playlists(self):
-        playlists_info = self.spotipy_client.user_playlists(self.USER_ID, limit=1)
+        with METRICS.span("spotify_fetch", endpoint="user_playlists", offset=0):
+            playlists_info = self.spotipy_client.user_playlists(self.USER_ID, limit=1)
         num_playlists = playlists_info["total"]
 
         all_playlists = []
         offset = 0
 
         while offset < num_playlists:
-            new_playlists = self.spotipy_client.user_playlists(self.USER_ID, limit=50, offset=offset)
+            with METRICS.span("spotify_fetch", endpoint="user_playlists", offset=offset):
+                new_playlists = self.spotipy_client.user_playlists(self.USER_ID, limit=50, offset=offset)
             all_playlists.extend(new_playlists["items"])
             offset += 50
 
         return all_playlists
     
     def get_playlist_info(self, playlist_id):
-        playlist_info = self.spotipy_client.playlist(playlist_id)
+        with METRICS.span("spotify_fetch", endpoint="playlist", playlist_id=playlist_id):
+            playlist_info = self.spotipy_client.playlist(playlist_id)
         playlist_name = playlist_info["name"]
         playlist_description = playlist_info["description"]
 
@@ -87,23 +100,28 @@ class SpotifyClient():
         }
 
     def get_playlist_tracks(self, playlist_id):
-        all_tracks = []
+        return list(self.iter_playlist_tracks(playlist_id))
+
+    def iter_playlist_tracks(self, playlist_id):
+        """
+        Yields the playlist items one page at a time, so callers that convert them to TrackData as they go never hold the whole playlist's raw json
+        """
         offset = 0
 
         while True:
             try:
-                response = self.spotipy_client.playlist_items(offset=offset, playlist_id=playlist_id)
-                all_tracks.extend(response["items"])
-                offset += 100
-
-                if len(response["items"]) < 100:
-                    break
+                with METRICS.span("spotify_fetch", endpoint="playlist_items", playlist_id=playlist_id, offset=offset):
+                    response = self.spotipy_client.playlist_items(offset=offset, playlist_id=playlist_id)
             except Exception as e:
                 print(f"Spotify error, sleeping and trying again: {e}")
                 time.sleep(5)
                 continue
-            
-        return all_tracks
+
+            yield from response["items"]
+            offset += 100
+
+            if len(response["items"]) < 100:
+                break
 
     def get_playlist_id_from_url(self, playlist_url: str):
         match = re.search(r"playlist/([a-zA-Z0-9]+)", playlist_url)
@@ -116,43 +134,121 @@ class SpotifyClient():
         return playlist_id
     
     def get_liked_tracks(self):
-        all_tracks = []
+        return list(self.iter_liked_tracks())
+
+    def iter_liked_tracks(self):
+        """
+        Yields the users liked tracks one page at a time, see iter_playlist_tracks()
+        """
         offset = 0
 
         while True:
             try:
-                response = self.spotipy_client.current_user_saved_tracks(limit=50, offset=offset)
-                all_tracks.extend(response["items"])
-                offset += 50
-
-                if len(response["items"]) < 50:
-                    break
-
+                with METRICS.span("spotify_fetch", endpoint="current_user_saved_tracks", offset=offset):
+                    response = self.spotipy_client.current_user_saved_tracks(limit=50, offset=offset)
             except Exception as e:
                 print(f"Spotify API error: {e}\nSleeping and retrying...")
                 time.sleep(5)
                 continue
-            
-        return all_tracks
+
+            yield from response["items"]
+            offset += 50
+
+            if len(response["items"]) < 50:
+                break
     
     def get_track(self, id):
-        return self.spotipy_client.track(id)
+        with METRICS.span("spotify_fetch", endpoint="track", track_id=id):
+            return self.spotipy_client.track(id)
+
+    def _get_many(self, endpoint: str, fetch, ids: Iterable[str], cache: dict, extract, max_attempts: int = 3) -> dict[str, dict]:
+        """
+        Looks ids up through one of spotify's multi id endpoints, MAX_IDS_PER_REQUEST ids per request. Duplicate ids and ids that were looked up
+        before by this client don't cost a request
+
+        Args:
+            endpoint (str): "tracks" or "artists", the key of the list in the response
+            fetch (Callable): the spotipy function that takes a list of ids
+            ids (Iterable[str]): the spotify ids
+            cache (dict): the cache for this endpoint
+            extract (Callable): turns a spotify object into the dict that is cached and returned
+            max_attempts (int): a chunk that keeps failing is skipped, its ids are tried again on the next call
+
+        Returns:
+            dict[str, dict]: the extracted details of each id spotify knows
+        """
+        unique_ids = list(dict.fromkeys(spotify_id for spotify_id in ids if spotify_id))
+        missing_ids = [spotify_id for spotify_id in unique_ids if spotify_id not in cache]
+
+        for start in range(0, len(missing_ids), MAX_IDS_PER_REQUEST):
+            chunk = missing_ids[start:start + MAX_IDS_PER_REQUEST]
+            for attempt in range(1, max_attempts + 1):
+                try:
+                    with METRICS.span("spotify_fetch", endpoint=endpoint, num_ids=len(chunk)):
+                        response = fetch(chunk)
+                    break
+                except Exception as e:
+                    print(f"Spotify error looking up {len(chunk)} {endpoint} (attempt {attempt}/{max_attempts}): {e}")
+                    response = None
+                    if attempt < max_attempts:
+                        time.sleep(5)
+
+            if response is None:
+                continue
+
+            # the objects come back in the order of the ids, unknown ids are null
+            for spotify_id, spotify_object in zip(chunk, response[endpoint]):
+                cache[spotify_id] = extract(spotify_object) if spotify_object is not None else None
+
+        return {spotify_id: cache[spotify_id] for spotify_id in unique_ids if cache.get(spotify_id) is not None}
+
+    def get_tracks(self, track_ids: Iterable[str]) -> dict[str, dict]:
+        """
+        Returns:
+            dict[str, dict]: {"duration_ms": int, "isrc": str|None} for each track id, see _get_many()
+        """
+        # market="from_token" leaves out available_markets, which is most of every track object
+        return self._get_many(
+            "tracks",
+            lambda chunk: self.spotipy_client.tracks(chunk, market="from_token"),
+            track_ids,
+            self._track_details,
+            lambda track: {"duration_ms": track.get("duration_ms"), "isrc": (track.get("external_ids") or {}).get("isrc")},
+        )
+
+    def get_artists(self, artist_ids: Iterable[str]) -> dict[str, dict]:
+        """
+        Returns:
+            dict[str, dict]: {"genres": list[str]} for each artist id, see _get_many()
+        """
+        return self._get_many(
+            "artists",
+            self.spotipy_client.artists,
+            artist_ids,
+            self._artist_details,
+            lambda artist: {"genres": artist.get("genres") or []},
+        )
     
     def get_user_info(self):
         profile = self.spotipy_client.current_user()
 
         return (profile["id"], profile["display_name"])
     
-    def get_track_data_from_playlist(self, tracks) -> list[TrackData]:
+    # this doesn't touch the api so it is static - the benchmarks use it on fixture payloads without a logged in client
+    @staticmethod
+    def get_track_data_from_playlist(tracks: Iterable[dict]) -> list[TrackData]:
         relevant_data = []
         for track in tracks:
             spotify_id = track["track"]["id"]
             title = track["track"]["name"]
-            artists = [(artist["name"], artist["id"]) for artist in track["track"]["artists"]]
+            artists = tuple((artist["name"], artist["id"]) for artist in track["track"]["artists"])
             album = track["track"]["album"]["name"]
             release_date = track["track"]["album"]["release_date"]
             track_added_date = track["added_at"]
             explicit = track["track"]["explicit"]
+            # the playlist items are full track objects, so these come for free instead of costing a tracks() lookup later
+            duration_ms = track["track"].get("duration_ms")
+            isrc = (track["track"].get("external_ids") or {}).get("isrc")
 
             track_data = TrackData(
                 spotify_id=spotify_id,
@@ -161,7 +257,9 @@ class SpotifyClient():
                 album=album,
                 release_date=release_date,
                 date_liked_spotify=track_added_date,
-                explicit=explicit
+                explicit=explicit,
+                duration_ms=duration_ms,
+                isrc=isrc,
             )
 
             relevant_data.append(track_data)
@@ -0,0 +1,85 @@
+# fills in the spotify details that the playlist and liked songs pages don't give us (artist genres) or that older rows are missing (duration, isrc)
+#   - spotify's several tracks / several artists endpoints take 50 ids per request, so the whole library costs about 1/50th of the requests that
+#     looking up every track and artist on its own would. SpotifyClient also skips duplicate ids and remembers what it already looked up
+#   - only rows that haven't been enriched yet are looked up: tracks without a duration_ms and artists whose genres are still NULL
+#   - the rows are handled a chunk at a time, each chunk is written back with one executemany UPDATE and committed like virtualdj.import_database()
+from typing import TYPE_CHECKING
+
+import sqlalchemy as sqla
+
+import souldb as SoulDB
+
+if TYPE_CHECKING:
+    from spotify_client import SpotifyClient
+
+CHUNK_SIZE = 1000
+
+def enrich_tracks(sql_session, spotify_client: "SpotifyClient", chunk_size: int = CHUNK_SIZE) -> int:
+    """
+    Looks up duration_ms and isrc for the spotify tracks that don't have a duration yet
+
+    Returns:
+        int: the number of tracks that were updated
+    """
+    # the ids are read up front since the updates change which rows match the filter
+    track_rows = (
+        sql_session.query(SoulDB.Tracks.id, SoulDB.Tracks.spotify_id)
+        .filter(SoulDB.Tracks.spotify_id.isnot(None), SoulDB.Tracks.duration_ms.is_(None))
+        .order_by(SoulDB.Tracks.id)
+        .all()
+    )
+
+    num_updated = 0
+    for start in range(0, len(track_rows), chunk_size):
+        chunk = track_rows[start:start + chunk_size]
+        track_details = spotify_client.get_tracks(spotify_id for _, spotify_id in chunk)
+
+        updates = [
+            {"id": track_id, "duration_ms": track_details[spotify_id]["duration_ms"], "isrc": track_details[spotify_id]["isrc"]}
+            for track_id, spotify_id in chunk
+            if spotify_id in track_details
+        ]
+        if len(updates) > 0:
+            sql_session.execute(sqla.update(SoulDB.Tracks), updates)
+        sql_session.commit()
+        num_updated += len(updates)
+
+    return num_updated
+
+def enrich_artists(sql_session, spotify_client: "SpotifyClient", chunk_size: int = CHUNK_SIZE) -> int:
+    """
+    Looks up the genres of the spotify artists that haven't been looked up yet
+
+    Returns:
+        int: the number of artists that were updated
+    """
+    artist_rows = (
+        sql_session.query(SoulDB.Artists.id, SoulDB.Artists.spotify_id)
+        .filter(SoulDB.Artists.spotify_id.isnot(None), SoulDB.Artists.genres.is_(None))
+        .order_by(SoulDB.Artists.id)
+        .all()
+    )
+
+    num_updated = 0
+    for start in range(0, len(artist_rows), chunk_size):
+        chunk = artist_rows[start:start + chunk_size]
+        artist_details = spotify_client.get_artists(spotify_id for _, spotify_id in chunk)
+
+        updates = [{"id": artist_id, "genres": artist_details[spotify_id]["genres"]} for artist_id, spotify_id in chunk if spotify_id in artist_details]
+        if len(updates) > 0:
+            sql_session.execute(sqla.update(SoulDB.Artists), updates)
+        sql_session.commit()
+        num_updated += len(updates)
+
+    return num_updated
+
+def enrich_library(sql_session, spotify_client: "SpotifyClient") -> dict[str, int]:
+    """
+    Runs enrich_tracks() and enrich_artists()
+
+    Returns:
+        dict[str, int]: the number of tracks and artists that were updated
+    """
+    counts = {"tracks": enrich_tracks(sql_session, spotify_client), "artists": enrich_artists(sql_session, spotify_client)}
+    print(f"Added spotify details to {counts['tracks']} tracks and genres to {counts['artists']} artists")
+    return counts
@@ -0,0 +1,91 @@
+# reads tracks out of the database as TrackData with their artists filled in
+#   - going through track_row.artists one track at a time lazy loads the track_artists and artists rows separately for every track. here the artists
+#     are loaded with selectinload, which is one extra query per batch of tracks (an IN over the batch's ids) instead of one or more per track
+#   - the tracks are streamed with yield_per, so going through a backlog of 100k tracks only ever holds one batch of rows and artists in the session
+from typing import Iterator
+
+import sqlalchemy as sqla
+
+import souldb as SoulDB
+
+TRACK_BATCH_SIZE = 500
+
+def to_track_data(track_row: SoulDB.Tracks) -> SoulDB.TrackData:
+    """
+    Converts a Tracks row to a TrackData, the artists should already be loaded (see query_tracks()) or each call lazy loads them
+    """
+    return SoulDB.TrackData(
+        filepath=track_row.filepath,
+        spotify_id=track_row.spotify_id,
+        title=track_row.title,
+        artists=[(artist_row.name, artist_row.spotify_id) for artist_row in track_row.artists],
+        album=track_row.album,
+        release_date=track_row.release_date,
+        date_liked_spotify=track_row.date_liked_spotify,
+        explicit=track_row.explicit,
+        comments=track_row.comments,
+        duration_ms=track_row.duration_ms,
+        isrc=track_row.isrc,
+    )
+
+def query_tracks(sql_session, *criteria, order_by=None):
+    """
+    Args:
+        sql_session: the sqlalchemy session
+        criteria: filters on the tracks, e.g. SoulDB.Tracks.album == "Blonde"
+        order_by: the ORDER BY clause(s), defaults to the track id
+
+    Returns:
+        Query: the Tracks query with the artists eager loaded
+    """
+    order_by = order_by if order_by is not None else [SoulDB.Tracks.id]
+    if not isinstance(order_by, (list, tuple)):
+        order_by = [order_by]
+
+    return (
+        sql_session.query(SoulDB.Tracks)
+        .options(sqla.orm.selectinload(SoulDB.Tracks.artists))
+        .filter(*criteria)
+        .order_by(*order_by)
+    )
+
+def iter_tracks(sql_session, *criteria, order_by=None, batch_size: int = TRACK_BATCH_SIZE) -> Iterator[SoulDB.Tracks]:
+    """
+    Streams the Tracks rows matching criteria with their artists loaded, batch_size rows at a time. See query_tracks()
+    """
+    yield from query_tracks(sql_session, *criteria, order_by=order_by).yield_per(batch_size)
+
+def iter_track_data(sql_session, *criteria, order_by=None, batch_size: int = TRACK_BATCH_SIZE) -> Iterator[tuple[int, SoulDB.TrackData]]:
+    """
+    Streams the tracks matching criteria as TrackData, two queries per batch no matter how many artists each track has
+
+    Yields:
+        tuple[int, SoulDB.TrackData]: the track's id and its data
+    """
+    for track_row in iter_tracks(sql_session, *criteria, order_by=order_by, batch_size=batch_size):
+        yield track_row.id, to_track_data(track_row)
+
+def get_track_data(sql_session, track_ids: list[int]) -> dict[int, SoulDB.TrackData]:
+    """
+    Returns:
+        dict[int, SoulDB.TrackData]: the data of each track id that exists
+    """
+    track_data_by_id = {}
+    for start in range(0, len(track_ids), TRACK_BATCH_SIZE):
+        chunk = track_ids[start:start + TRACK_BATCH_SIZE]
+        track_data_by_id.update(iter_track_data(sql_session, SoulDB.Tracks.id.in_(chunk)))
+    return track_data_by_id
+
+def iter_pending_track_data(sql_session, playlist_id: int = None, priorities: tuple[str, ...] = SoulDB.DOWNLOAD_PRIORITIES, batch_size: int = TRACK_BATCH_SIZE) -> Iterator[tuple[int, SoulDB.TrackData]]:
+    """
+    Streams the tracks that still need to be downloaded in the order the downloaders claim them, claimed and failed tracks included
+
+    Args:
+        playlist_id (int): only tracks in this playlist
+        priorities (tuple[str]): see SoulDB.DOWNLOAD_PRIORITIES
+    """
+    criteria = [sqla.or_(SoulDB.Tracks.filepath.is_(None), SoulDB.Tracks.filepath == ""), SoulDB.Tracks.title.isnot(None)]
+    if playlist_id is not None:
+        criteria.append(SoulDB.Tracks.id.in_(sqla.select(SoulDB.PlaylistTracks.track_id).where(SoulDB.PlaylistTracks.playlist_id == playlist_id)))
+
+    yield from iter_track_data(sql_session, *criteria, order_by=SoulDB.get_download_order(priorities), batch_size=batch_size)
@@ -0,0 +1,188 @@
+# reads key and bpm from a VirtualDJ database.xml and writes our playlists out as VirtualDJ .vdjfolder files
+#   - database.xml for a big DJ library is hundreds of MB, so it is read with iterparse and every <Song> element is cleared once it has been handled.
+#     memory stays flat no matter how big the file is
+#   - songs are matched to Tracks by filepath a chunk at a time, each chunk is one IN query and one executemany UPDATE
+#   - VirtualDJ usually runs on windows while soulripper runs in wsl/docker, so paths can be mapped with prefix pairs like ("D:\\", "/mnt/d/")
+#   - the playlists are written a row at a time from a yield_per query into a temp file that replaces the old .vdjfolder when it's done
+from xml.etree.ElementTree import iterparse
+from xml.sax.saxutils import quoteattr
+import tempfile
+import re
+import os
+
+import sqlalchemy as sqla
+
+import souldb as SoulDB
+
+IMPORT_CHUNK_SIZE = 1000
+EXPORT_CHUNK_SIZE = 1000
+
+def parse_path_map(path_map: list[str] | None) -> list[tuple[str, str]]:
+    """
+    Parses "VIRTUALDJ_PREFIX=LOCAL_PREFIX" arguments, e.g. "D:\\=/mnt/d/"
+
+    Returns:
+        list[tuple[str, str]]: the (virtualdj prefix, local prefix) pairs with forward slashes
+    """
+    pairs = []
+    for mapping in path_map or []:
+        if "=" not in mapping:
+            raise ValueError(f"Invalid path map '{mapping}', expected VIRTUALDJ_PREFIX=LOCAL_PREFIX")
+        virtualdj_prefix, local_prefix = mapping.split("=", 1)
+        pairs.append((virtualdj_prefix.replace("\\", "/"), local_prefix))
+    return pairs
+
+def to_local_path(virtualdj_path: str, path_map: list[tuple[str, str]]) -> str:
+    path = virtualdj_path.replace("\\", "/")
+    for virtualdj_prefix, local_prefix in path_map:
+        if path.lower().startswith(virtualdj_prefix.lower()):
+            return local_prefix + path[len(virtualdj_prefix):]
+    return path
+
+def to_virtualdj_path(local_path: str, path_map: list[tuple[str, str]]) -> str:
+    for virtualdj_prefix, local_prefix in path_map:
+        if local_path.startswith(local_prefix):
+            path = virtualdj_prefix + local_path[len(local_prefix):]
+            # a windows drive prefix means virtualdj wants backslashes
+            return path.replace("/", "\\") if re.match(r"^[A-Za-z]:", virtualdj_prefix) else path
+    return local_path
+
+def parse_bpm(value: str | None) -> float | None:
+    """
+    VirtualDJ stores the analyzed tempo in <Scan Bpm=".."> as seconds per beat (0.46875 is 128 bpm), while a bpm typed into the tags is in beats per minute
+    """
+    try:
+        bpm = float(value)
+    except (TypeError, ValueError):
+        return None
+    if bpm <= 0:
+        return None
+    return round(60 / bpm, 2) if bpm < 10 else round(bpm, 2)
+
+def iter_database_songs(database_filepath: str):
+    """
+    Streams the songs in a VirtualDJ database.xml
+
+    Yields:
+        tuple[str, str|None, float|None]: the song's FilePath, key, and bpm. The scan results are preferred over the tags
+    """
+    context = iterparse(database_filepath, events=("start", "end"))
+    _, root = next(context)
+
+    for event, element in context:
+        if event != "end" or element.tag != "Song":
+            continue
+
+        scan = element.find("Scan")
+        tags = element.find("Tags")
+        key = (scan is not None and scan.get("Key")) or (tags is not None and tags.get("Key")) or None
+        bpm = parse_bpm(scan.get("Bpm") if scan is not None else None) or parse_bpm(tags.get("Bpm") if tags is not None else None)
+        filepath = element.get("FilePath")
+
+        # the parsed songs would otherwise pile up under the root element
+        element.clear()
+        root.clear()
+
+        if filepath:
+            yield filepath, key, bpm
+
+def import_database(sql_session, database_filepath: str, path_map: list[tuple[str, str]] = None, chunk_size: int = IMPORT_CHUNK_SIZE) -> int:
+    """
+    Copies key and bpm from a VirtualDJ database.xml to the tracks with the same filepath. Songs that aren't in our library are skipped
+
+    Args:
+        sql_session: the sqlalchemy session
+        database_filepath (str): the path to database.xml
+        path_map (list[tuple[str, str]]): see parse_path_map()
+        chunk_size (int): the number of songs matched and updated at once
+
+    Returns:
+        int: the number of tracks that were updated
+    """
+    path_map = path_map or []
+    num_updated = 0
+    chunk: dict[str, tuple[str | None, float | None]] = {}
+
+    def flush_chunk():
+        track_rows = sql_session.query(SoulDB.Tracks.id, SoulDB.Tracks.filepath).filter(SoulDB.Tracks.filepath.in_(list(chunk))).all()
+        updates = [{"id": track_id, "key": chunk[filepath][0], "bpm": chunk[filepath][1]} for track_id, filepath in track_rows]
+        if len(updates) > 0:
+            sql_session.execute(sqla.update(SoulDB.Tracks), updates)
+        sql_session.commit()
+        chunk.clear()
+        return len(updates)
+
+    for virtualdj_path, key, bpm in iter_database_songs(database_filepath):
+        if key is None and bpm is None:
+            continue
+
+        chunk[to_local_path(virtualdj_path, path_map)] = (key, bpm)
+        if len(chunk) >= chunk_size:
+            num_updated += flush_chunk()
+
+    if len(chunk) > 0:
+        num_updated += flush_chunk()
+
+    print(f"Updated the key and bpm of {num_updated} tracks from {database_filepath}")
+    return num_updated
+
+def get_vdjfolder_filename(playlist_name: str) -> str:
+    return re.sub(r'[<>:"/\\|?*\x00-\x1f]', "_", playlist_name).strip() + ".vdjfolder"
+
+def export_playlist(sql_session, playlist_row: SoulDB.Playlists, output_dir: str, path_map: list[tuple[str, str]] = None, chunk_size: int = EXPORT_CHUNK_SIZE) -> str:
+    """
+    Writes a playlist as a VirtualDJ .vdjfolder file, tracks that haven't been downloaded are left out
+
+    Args:
+        sql_session: the sqlalchemy session
+        playlist_row (SoulDB.Playlists): the playlist to export
+        output_dir (str): the folder to write to, e.g. VirtualDJ's Playlists folder
+        path_map (list[tuple[str, str]]): see parse_path_map(), the paths are mapped from local to virtualdj
+        chunk_size (int): the number of rows fetched from the database at once
+
+    Returns:
+        str: the path of the written file
+    """
+    path_map = path_map or []
+    output_filepath = os.path.join(output_dir, get_vdjfolder_filename(playlist_row.name))
+
+    rows = (
+        sql_session.query(SoulDB.Tracks.filepath, SoulDB.Tracks.title, SoulDB.Tracks.key, SoulDB.Tracks.bpm)
+        .join(SoulDB.PlaylistTracks, SoulDB.PlaylistTracks.track_id == SoulDB.Tracks.id)
+        .filter(SoulDB.PlaylistTracks.playlist_id == playlist_row.id, SoulDB.Tracks.filepath.isnot(None), SoulDB.Tracks.filepath != "")
+        .order_by(SoulDB.PlaylistTracks.added_at, SoulDB.PlaylistTracks.id)
+        .yield_per(chunk_size)
+    )
+
+    # a crash halfway through leaves the old file in place instead of a truncated one
+    file_descriptor, temp_filepath = tempfile.mkstemp(dir=output_dir, suffix=".vdjfolder.tmp")
+    try:
+        with os.fdopen(file_descriptor, "w", encoding="utf-8") as file:
+            file.write('<?xml version="1.0" encoding="UTF-8"?>\n<VirtualFolder>\n')
+            for index, (filepath, title, key, bpm) in enumerate(rows):
+                attributes = {"path": to_virtualdj_path(filepath, path_map), "title": title, "key": key, "bpm": bpm, "idx": index}
+                file.write(" <song " + " ".join(f"{name}={quoteattr(str(value))}" for name, value in attributes.items() if value is not None) + " />\n")
+            file.write("</VirtualFolder>\n")
+        os.replace(temp_filepath, output_filepath)
+    except BaseException:
+        os.remove(temp_filepath)
+        raise
+
+    return output_filepath
+
+def export_playlists(sql_session, output_dir: str, playlist_names: list[str] = None, path_map: list[tuple[str, str]] = None) -> list[str]:
+    """
+    Exports every playlist, or only the ones named in playlist_names, see export_playlist()
+
+    Returns:
+        list[str]: the paths of the written files
+    """
+    os.makedirs(output_dir, exist_ok=True)
+
+    query = sql_session.query(SoulDB.Playlists).order_by(SoulDB.Playlists.id)
+    if playlist_names:
+        query = query.filter(SoulDB.Playlists.name.in_(playlist_names))
+
+    output_filepaths = [export_playlist(sql_session, playlist_row, output_dir, path_map) for playlist_row in query.all()]
+    print(f"Exported {len(output_filepaths)} playlists to {output_dir}")
+    return output_filepaths
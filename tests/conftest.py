@@ -0,0 +1,5 @@
+# the modules in src/ import each other by name (main.py is run as a script), so the tests put src/ on the path the same way
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
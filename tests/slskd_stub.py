@@ -0,0 +1,143 @@
+# a tiny stand in for slskd's REST API, just enough of it for AsyncSlskdUtils: searches finish on the first poll and every enqueued download goes
+# Queued -> InProgress -> Completed, Succeeded over the next polls, at which point the file is written where slskd would put it
+import uuid
+import os
+
+from aiohttp import web
+
+API_PREFIX = "/api/v0"
+
+class SlskdStub:
+    def __init__(self, downloads_dir: str, username: str = "stub_peer"):
+        """
+        Args:
+            downloads_dir (str): slskd's download folder, finished files go in <downloads_dir>/<remote folder name>/<file name>
+            username (str): the peer that shares every search result
+        """
+        self.downloads_dir = downloads_dir
+        self.username = username
+        self.searches: dict[str, dict] = {}
+        self.downloads: dict[str, dict] = {}
+        self.requests: list[tuple[str, str]] = []
+
+        # set these to make the next GET /transfers/downloads calls fail with a 500 or return a response without "directories"
+        self.num_download_polls_to_fail = 0
+        self.num_malformed_download_polls = 0
+
+        self.base_url: str = None
+        self._runner: web.AppRunner = None
+
+    async def start(self) -> str:
+        """
+        Returns:
+            str: the host to pass to AsyncSlskdUtils, e.g. http://127.0.0.1:12345
+        """
+        app = web.Application()
+        app.router.add_post(f"{API_PREFIX}/searches", self.post_search)
+        app.router.add_get(f"{API_PREFIX}/searches", self.get_searches)
+        app.router.add_get(f"{API_PREFIX}/searches/{{id}}/responses", self.get_search_responses)
+        app.router.add_delete(f"{API_PREFIX}/searches/{{id}}", self.delete_search)
+        app.router.add_post(f"{API_PREFIX}/transfers/downloads/{{username}}", self.post_downloads)
+        app.router.add_get(f"{API_PREFIX}/transfers/downloads/", self.get_downloads)
+        app.router.add_delete(f"{API_PREFIX}/transfers/downloads/{{username}}/{{id}}", self.delete_download)
+
+        @web.middleware
+        async def record_requests(request, handler):
+            self.requests.append((request.method, request.path))
+            return await handler(request)
+        app.middlewares.append(record_requests)
+
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://127.0.0.1:{port}"
+        return self.base_url
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+    # ===========================================
+    #                 searches
+    # ===========================================
+
+    async def post_search(self, request):
+        data = await request.json()
+        self.searches[data["id"]] = {"id": data["id"], "searchText": data["searchText"], "isComplete": False}
+        return web.json_response(self.searches[data["id"]])
+
+    async def get_searches(self, request):
+        search_states = list(self.searches.values())
+        for search_state in self.searches.values():
+            search_state["isComplete"] = True
+        return web.json_response(search_states)
+
+    async def get_search_responses(self, request):
+        search_text = self.searches[request.match_info["id"]]["searchText"]
+        return web.json_response([{
+            "username": self.username,
+            "hasFreeUploadSlot": True,
+            "queueLength": 0,
+            "uploadSpeed": 1_000_000,
+            "files": [{"filename": f"Music\\Stub Album\\{search_text}.mp3", "size": 4_000_000, "bitRate": 320, "isLocked": False}],
+        }])
+
+    async def delete_search(self, request):
+        del self.searches[request.match_info["id"]]
+        return web.Response(status=204)
+
+    # ===========================================
+    #                 transfers
+    # ===========================================
+
+    async def post_downloads(self, request):
+        for file in await request.json():
+            download_id = str(uuid.uuid4())
+            self.downloads[download_id] = {
+                "id": download_id,
+                "username": request.match_info["username"],
+                "filename": file["filename"],
+                "size": file["size"],
+                "state": "Queued, Remotely",
+                "bytesTransferred": 0,
+            }
+        return web.Response(status=201)
+
+    async def get_downloads(self, request):
+        if self.num_download_polls_to_fail > 0:
+            self.num_download_polls_to_fail -= 1
+            return web.Response(status=500, text="stub failure")
+        if self.num_malformed_download_polls > 0:
+            self.num_malformed_download_polls -= 1
+            return web.json_response([{"username": self.username}])
+
+        for download in self.downloads.values():
+            self._advance(download)
+
+        files_by_user: dict[str, list[dict]] = {}
+        for download in self.downloads.values():
+            files_by_user.setdefault(download["username"], []).append(download)
+        return web.json_response([
+            {"username": username, "directories": [{"directory": "Music\\Stub Album", "files": files}]}
+            for username, files in files_by_user.items()
+        ])
+
+    async def delete_download(self, request):
+        self.downloads.pop(request.match_info["id"], None)
+        return web.Response(status=204)
+
+    def _advance(self, download: dict):
+        match download["state"]:
+            case "Queued, Remotely":
+                download["state"] = "InProgress"
+                download["bytesTransferred"] = download["size"] // 2
+            case "InProgress":
+                download["state"] = "Completed, Succeeded"
+                download["bytesTransferred"] = download["size"]
+
+                remote_path = download["filename"].split("\\")
+                local_dir = os.path.join(self.downloads_dir, remote_path[-2])
+                os.makedirs(local_dir, exist_ok=True)
+                with open(os.path.join(local_dir, remote_path[-1]), "wb") as file:
+                    file.write(b"\0" * download["size"])
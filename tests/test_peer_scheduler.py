@@ -0,0 +1,39 @@
+import threading
+import time
+
+from peer_scheduler import PeerScheduler, Candidate
+from folder_batcher import FolderClaim, RETRY
+
+def make_candidate(username: str) -> Candidate:
+    return Candidate({"filename": f"Music\\{username}\\song.flac", "size": 1_000_000}, username, 1_000_000, 0, True, 1_000_000, 0, 1.0)
+
+def cancel_after(seconds: float) -> threading.Event:
+    cancel_event = threading.Event()
+    threading.Timer(seconds, cancel_event.set).start()
+    return cancel_event
+
+def test_reserve_gives_up_when_cancelled():
+    scheduler = PeerScheduler(max_transfers_per_peer=1)
+    candidate = make_candidate("busy_peer")
+    assert scheduler.reserve([candidate]) is candidate
+
+    # the peer's only slot is taken, without the cancel this would wait forever
+    start_time = time.monotonic()
+    assert scheduler.reserve([candidate], cancel_event=cancel_after(0.1)) is None
+    assert time.monotonic() - start_time < 5
+
+    scheduler.release(candidate.username)
+    assert scheduler.reserve([candidate], cancel_event=threading.Event()) is candidate
+
+def test_reserve_still_times_out_with_a_cancel_event():
+    scheduler = PeerScheduler(max_transfers_per_peer=1)
+    candidate = make_candidate("busy_peer")
+    scheduler.reserve([candidate])
+    assert scheduler.reserve([candidate], timeout=0.1, cancel_event=threading.Event()) is None
+
+def test_folder_claim_wait_gives_up_when_cancelled():
+    claim = FolderClaim("Song - Artist", "peer", {"filename": "Music\\Album\\Song.flac"})
+
+    start_time = time.monotonic()
+    assert claim.wait(cancel_event=cancel_after(0.1)) is RETRY
+    assert time.monotonic() - start_time < 5
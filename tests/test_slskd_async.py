@@ -0,0 +1,67 @@
+import asyncio
+import time
+import os
+
+import pytest
+
+from slskd_async import AsyncSlskdUtils
+from slskd_stub import SlskdStub
+
+@pytest.fixture
+def output_dir(tmp_path, monkeypatch):
+    # slskd_async looks for finished downloads in assets/downloads relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    output_dir = tmp_path / "music"
+    output_dir.mkdir()
+    return str(output_dir)
+
+# a regression in the pollers shows up as a hang, so every test gets a deadline
+TEST_TIMEOUT_SECONDS = 30
+
+async def run_with_stub(test, stub: SlskdStub = None):
+    stub = stub or SlskdStub(os.path.join("assets", "downloads"))
+    host = await stub.start()
+    try:
+        async with AsyncSlskdUtils("stub-api-key", host=host, poll_interval=0.01) as slskd:
+            return await asyncio.wait_for(test(slskd, stub), TEST_TIMEOUT_SECONDS)
+    finally:
+        await stub.stop()
+
+def test_download_tracks_searches_enqueues_and_places_files(output_dir):
+    async def test(slskd, stub):
+        return await slskd.download_tracks(["Song A", "Song B"], output_dir), stub
+
+    download_paths, stub = asyncio.run(run_with_stub(test))
+
+    assert download_paths == {"Song A": f"{output_dir}/Song A.mp3", "Song B": f"{output_dir}/Song B.mp3"}
+    for download_path in download_paths.values():
+        assert os.path.getsize(download_path) == 4_000_000
+    assert stub.searches == {}
+    assert sum(1 for method, path in stub.requests if method == "POST" and path.startswith("/api/v0/transfers/downloads/")) == 2
+
+def test_wait_for_download_survives_failed_and_malformed_polls(output_dir):
+    async def test(slskd, stub):
+        search_results = await slskd.search("Song C")
+        download_id, _, _ = await slskd.start_download(search_results, max_retries=1)
+
+        # the malformed response stops the poller, the waiter has to start a new one
+        stub.num_download_polls_to_fail = 3
+        stub.num_malformed_download_polls = 1
+        return await slskd.wait_for_download(download_id), stub
+
+    download, stub = asyncio.run(run_with_stub(test))
+    assert download["state"] == "Completed, Succeeded"
+    assert stub.num_download_polls_to_fail == 0 and stub.num_malformed_download_polls == 0
+
+def test_wait_for_download_gives_up_while_slskd_is_failing(output_dir):
+    stub = SlskdStub(os.path.join("assets", "downloads"))
+    stub.num_download_polls_to_fail = 1_000_000
+
+    async def test(slskd, stub):
+        start_time = time.monotonic()
+        download = await slskd.wait_for_download("missing-download", inactive_download_timeout=0.02)
+        return download, time.monotonic() - start_time
+
+    download, elapsed_time = asyncio.run(run_with_stub(test, stub))
+    assert download["state"] == "Unknown"
+    assert elapsed_time < 10
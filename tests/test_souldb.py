@@ -0,0 +1,129 @@
+import threading
+import sqlite3
+import time
+
+import pytest
+import sqlalchemy as sqla
+
+import souldb as SoulDB
+from peer_scheduler import PeerReputation
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "soul.db")
+
+@pytest.fixture
+def sql_session(db_path):
+    db_engine = SoulDB.create_db_engine(f"sqlite:///{db_path}")
+    SoulDB.init_db(db_engine)
+    session = sqla.orm.sessionmaker(bind=db_engine)()
+    yield session
+    session.close()
+    db_engine.dispose()
+
+def count_tracks_from_another_connection(db_path: str) -> int:
+    with sqlite3.connect(db_path) as conn:
+        return conn.execute("SELECT COUNT(*) FROM tracks").fetchone()[0]
+
+def test_unit_of_work_commits_once_per_batch(sql_session, db_path):
+    with SoulDB.UnitOfWork(sql_session, batch_size=3, batch_seconds=999) as unit_of_work:
+        for i in range(5):
+            with unit_of_work.item(f"track {i}"):
+                SoulDB.Tracks.add_track(sql_session, SoulDB.TrackData(title=f"track {i}", filepath=f"/music/{i}.mp3"))
+
+            # the rows of a batch only show up for other connections once the whole batch is committed
+            assert count_tracks_from_another_connection(db_path) == (3 if i >= 2 else 0)
+
+    assert count_tracks_from_another_connection(db_path) == 5
+    assert unit_of_work.num_committed == 5
+
+def test_unit_of_work_skips_failed_items(sql_session, db_path):
+    with SoulDB.UnitOfWork(sql_session, batch_size=100, batch_seconds=999) as unit_of_work:
+        for i in range(4):
+            with unit_of_work.item(f"track {i}"):
+                SoulDB.Tracks.add_track(sql_session, SoulDB.TrackData(title=f"track {i}", filepath=f"/music/{i}.mp3"))
+                if i == 1:
+                    raise ValueError("broken tag")
+
+        assert count_tracks_from_another_connection(db_path) == 0
+
+    assert unit_of_work.num_failed == 1
+    assert sorted(title for (title,) in sql_session.query(SoulDB.Tracks.title)) == ["track 0", "track 2", "track 3"]
+
+def test_init_db_on_in_memory_sqlite():
+    # an in memory database has a single connection, so init_db() can't open a second one while its transaction is running
+    db_engine = SoulDB.create_db_engine("sqlite://")
+    SoulDB.init_db(db_engine)
+    SoulDB.init_db(db_engine)
+    assert "tracks" in sqla.inspect(db_engine).get_table_names()
+
+def test_writers_are_not_blocked_by_a_reader(sql_session, db_path):
+    # another process in the middle of a long read, e.g. a --no-daemon search or export
+    reader = sqlite3.connect(db_path, isolation_level=None)
+    reader.execute("BEGIN")
+    reader.execute("SELECT COUNT(*) FROM tracks").fetchone()
+
+    db_engine = sql_session.get_bind()
+    errors = []
+
+    def write_tracks(worker_num: int):
+        try:
+            with sqla.orm.Session(db_engine) as writer_session:
+                for i in range(5):
+                    SoulDB.Tracks.add_track(writer_session, SoulDB.TrackData(title=f"worker {worker_num} track {i}", filepath=f"/music/{worker_num}/{i}.mp3"))
+                    writer_session.commit()
+        except Exception as e:
+            errors.append(e)
+
+    start_time = time.monotonic()
+    writers = [threading.Thread(target=write_tracks, args=(worker_num,)) for worker_num in range(2)]
+    for writer in writers:
+        writer.start()
+    for writer in writers:
+        writer.join()
+    reader.execute("COMMIT")
+    reader.close()
+
+    assert errors == []
+    assert time.monotonic() - start_time < 5
+    assert count_tracks_from_another_connection(db_path) == 10
+
+def test_claimed_batch_does_not_lock_out_peer_stats(sql_session):
+    for i in range(3):
+        SoulDB.Tracks.add_track(sql_session, SoulDB.TrackData(title=f"track {i}", artists=[(f"artist {i}", None)]))
+    sql_session.commit()
+
+    # the downloader keeps its session and the claimed rows while the batch downloads, the download threads record peer stats meanwhile
+    claimed_tracks = SoulDB.claim_pending_tracks(sql_session, "worker-1", limit=10)
+    assert [artist.name for track in claimed_tracks for artist in track.artists] == ["artist 0", "artist 1", "artist 2"]
+
+    peer_reputation = PeerReputation(sqla.orm.sessionmaker(bind=sql_session.get_bind()))
+    start_time = time.monotonic()
+    recorder = threading.Thread(target=peer_reputation.record_success, args=("peer", 1000, 1.0))
+    recorder.start()
+    recorder.join()
+
+    assert time.monotonic() - start_time < 5
+    with sqla.orm.Session(sql_session.get_bind()) as other_session:
+        assert other_session.query(SoulDB.PeerStats).filter_by(username="peer").count() == 1
+
+def test_artist_track_stats_follow_playlist_changes(sql_session):
+    def get_artist_track_stats():
+        return sql_session.execute(sqla.text("SELECT artist_id, track_id, playlist_count FROM artist_track_stats ORDER BY artist_id, track_id")).all()
+
+    sql_session.execute(sqla.text("INSERT INTO artists (id, name) VALUES (1, 'a'), (2, 'b')"))
+    sql_session.execute(sqla.text("INSERT INTO tracks (id, title) VALUES (1, 'x'), (2, 'y')"))
+    sql_session.execute(sqla.text("INSERT INTO playlists (id, name) VALUES (1, 'p'), (2, 'q')"))
+    sql_session.execute(sqla.text("INSERT INTO playlist_tracks (playlist_id, track_id, added_at) VALUES (1, 1, '2024-01-01'), (2, 1, '2024-01-01')"))
+
+    # an artist added after the track is already in playlists starts from the track's count
+    sql_session.execute(sqla.text("INSERT INTO track_artists (track_id, artist_id) VALUES (1, 1), (1, 2), (2, 2)"))
+    assert get_artist_track_stats() == [(1, 1, 2), (2, 1, 2), (2, 2, 0)]
+
+    sql_session.execute(sqla.text("INSERT INTO playlist_tracks (playlist_id, track_id, added_at) VALUES (1, 2, '2024-01-01')"))
+    sql_session.execute(sqla.text("DELETE FROM playlist_tracks WHERE playlist_id = 2"))
+    assert get_artist_track_stats() == [(1, 1, 1), (2, 1, 1), (2, 2, 1)]
+
+    sql_session.execute(sqla.text("DELETE FROM track_artists WHERE artist_id = 1"))
+    sql_session.execute(sqla.text("DELETE FROM tracks WHERE id = 2"))
+    assert get_artist_track_stats() == [(2, 1, 1)]